@@ -6,6 +6,11 @@
 
 # Sets ECG_FED variable to FED1 by default. This is used for the address for an agent, e.g. FED1_AgentUI
 export ECG_FED=FED1
+# Wire codec for Transport messages: "json" (default) or "binary".
+export ECG_CODEC=json
+# How agents find each other. Unset uses UDP beacons; where broadcast
+# doesn't work (e.g. containers), use a registry directory instead.
+#export ECG_DISCOVERY=registry:/tmp/ecg-$ECG_FED
 # Initializes core solver, runs as a background process.
 python3 src/main/nluas/app/core_solver.py ProblemSolver &
 # Initializes core UI-Agent, also runs as a background process.
@@ -0,0 +1,420 @@
+######################################################################
+#
+# File: AsyncTransport.py
+#
+# An asyncio version of Transport, for agents embedded in asyncio
+# services. Uses the same Pyre groups, prefixes, codecs and QUIT
+# protocol as Transport, so the two can be mixed freely in one
+# federation.
+#
+# Example:
+#
+# t = AsyncTransport('AgentUI', prefix='FED1_')
+# await t.send('ProblemSolver', ntuple)
+# async for ntuple in t.subscribe('ProblemSolver'):
+#     ...
+# envelope = await t.get('ProblemSolver', timeout=5)
+#
+# NOTES:
+#
+# There's no reader thread. Pyre's inbox socket is read directly from
+# the event loop using zmq's asyncio support. Pyre itself still runs
+# its node in a background thread.
+#
+# Each subscription has a bounded queue (maxsize). When a queue is
+# full, the reader stops reading from Pyre until the consumer catches
+# up, so a slow consumer slows down delivery for this AsyncTransport
+# rather than growing memory without bound.
+#
+# Message headers are handled as Transport handles them, except for
+# what AsyncTransport doesn't do itself. A message whose deadline has
+# passed on arrival is dropped and the sender is told, as Transport
+# does (see notes on deadlines in Transport.py). Deadlines aren't
+# checked again while a message waits in a subscription's queue.
+# Expiry reports are ignored, since AsyncTransport never sends a
+# deadline. Shared memory handles are dropped with a warning;
+# AsyncTransport doesn't advertise a host id, so a Transport never
+# sends it one directly.
+#
+# A message that can't be decoded is logged and dropped. Any other
+# error stops the reader task. Pending and later get() calls, and
+# subscriptions once they are drained, then raise a TransportError
+# whose __cause__ is that error. Each gets its own, since an exception
+# raised in several tasks would share (and keep alive) one traceback.
+#
+# Python 3 only.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import asyncio
+import datetime
+import logging
+import time
+import uuid
+
+from pyre import Pyre
+import zmq
+import zmq.asyncio
+
+from nluas import transport_codec
+from nluas import transport_discovery
+from nluas.Transport import TransportError, TransportProtocolError, TransportEnvelope, enter_ip
+
+logger = logging.getLogger('Transport')
+
+# Put in a subscription's queue to end iteration.
+_CLOSED = object()
+
+class AsyncSubscription(object):
+    '''Async iterator over the ntuples sent by one remote. Returned by AsyncTransport.subscribe().'''
+
+    def __init__(self, transport, remote, maxsize):
+        self._transport = transport
+        self.remote = remote
+        self._queue = asyncio.Queue(maxsize)
+        self._closed = False
+        # The exception that stopped the reader, if one did. Iteration
+        # then ends with AsyncTransport._reader_error(). See _fail().
+        self._error = None
+    # __init__()
+
+    def __aiter__(self):
+        return self
+    # __aiter__()
+
+    async def __anext__(self):
+        if self._closed and self._queue.empty():
+            self._end()
+        item = await self._queue.get()
+        if item is _CLOSED:
+            self._end()
+        return item
+    # __anext__()
+
+    def _end(self):
+        if self._error is not None:
+            raise self._transport._reader_error()
+        raise StopAsyncIteration
+    # _end()
+
+    def close(self):
+        '''Stop receiving messages and end iteration. Messages not yet consumed are discarded.'''
+        if self._closed:
+            return
+        self._closed = True
+        self._transport._remove_subscription(self)
+        # Empty the queue so a reader waiting for room is released.
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(_CLOSED)
+    # close()
+
+    def _fail(self, error):
+        '''Close, and raise error once the messages already queued have been consumed.'''
+        self._error = error
+        if self._closed:
+            return
+        self._closed = True
+        self._transport._remove_subscription(self)
+        # Keep what's queued. If it's full, nobody is waiting in
+        # __anext__(), which ends once the queue is empty.
+        if not self._queue.full():
+            self._queue.put_nowait(_CLOSED)
+    # _fail()
+# class AsyncSubscription
+
+class AsyncTransport(object):
+    '''asyncio message transport for LCAS'''
+
+    def __init__(self, myname, prefix=None, codec='json', compress_threshold=None, discovery=None):
+        # How peers are found, as for Transport: a
+        # transport_discovery.Discovery, a spec string, or None for
+        # Pyre's own UDP beacons.
+        if discovery is not None:
+            try:
+                discovery = transport_discovery.get_discovery(discovery)
+            except transport_discovery.DiscoveryError as e:
+                raise TransportError(None, str(e))
+        try:
+            self._codec = transport_codec.get_codec(codec)
+        except transport_codec.CodecError as e:
+            raise TransportError(None, str(e))
+        # See Transport.set_compression().
+        self._compressor = transport_codec.Compressor(compress_threshold)
+
+        self._prefix = prefix
+        if prefix is not None:
+            myname = prefix + myname
+            self._globalchannel = prefix + "GLOBAL"
+        else:
+            self._globalchannel = "GLOBAL"
+
+        # dict of remote name => list of AsyncSubscription
+        self._subscribers = {}
+
+        # dict of remote name => list of futures waiting in get()
+        self._getters = {}
+
+        # Dict of (UUIDs => IP addresses) that have sent a valid ENTER message
+        self._uuid2ip = {}
+
+        if discovery is None:
+            self._pyre = Pyre(myname)
+        else:
+            self._pyre = transport_discovery.DiscoveryPyre(myname, discovery)
+        self._pyre.join(myname)
+        self._pyre.join(self._globalchannel)
+        try:
+            self._pyre.start()
+        except transport_discovery.DiscoveryError as e:
+            self._pyre.stop()
+            raise TransportError(None, str(e))
+        self._sock = zmq.asyncio.Socket.from_socket(self._pyre.socket())
+
+        self._run = True
+        # The reader task is started on first use, since that's the
+        # first time we're sure to be inside the event loop.
+        self._reader = None
+        # The exception that stopped the reader task, if one did. See
+        # notes above.
+        self._error = None
+    # __init__()
+
+    async def __aenter__(self):
+        self._start_reader()
+        return self
+    # __aenter__()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+    # __aexit__()
+
+    async def send(self, dest, ntuple):
+        '''Send given ntuple to Transport named dest.'''
+        if self._prefix is not None:
+            dest = self._prefix + dest
+        self._pyre.shout(dest, transport_codec.encode_message(self._codec, ntuple, compressor=self._compressor))
+    # send()
+
+    async def send_many(self, dest, ntuples):
+        '''Send a list of ntuples to Transport named dest as a single message.'''
+        if not ntuples:
+            return
+        if self._prefix is not None:
+            dest = self._prefix + dest
+        self._pyre.shout(dest, transport_codec.encode_batch(self._codec, ntuples, self._compressor))
+    # send_many()
+
+    async def broadcast(self, ntuple):
+        '''Send given ntuple to all Transports in the federation.'''
+        self._pyre.shout(self._globalchannel, transport_codec.encode_message(self._codec, ntuple, compressor=self._compressor))
+    # broadcast()
+
+    def subscribe(self, remote, maxsize=1000):
+        '''Return an async iterator over ntuples sent by the Transport named remote. Several subscriptions to the same remote each get every message.'''
+        if self._prefix is not None:
+            remote = self._prefix + remote
+        self._start_reader()
+        sub = AsyncSubscription(self, remote, maxsize)
+        self._subscribers.setdefault(remote, []).append(sub)
+        if self._error is not None:
+            sub._fail(self._error)
+        return sub
+    # subscribe()
+
+    async def get(self, remote, timeout=None):
+        '''Wait for the next message from the Transport named remote and return a TransportEnvelope. Subscriptions to remote still see the message. Raises asyncio.TimeoutError if nothing arrives within timeout seconds, and the reader task's error if it stopped on one (see notes above).'''
+        if self._prefix is not None:
+            remote = self._prefix + remote
+        self._start_reader()
+        if self._error is not None:
+            raise self._reader_error()
+        fut = asyncio.get_running_loop().create_future()
+        self._getters.setdefault(remote, []).append(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            getters = self._getters.get(remote)
+            if getters is not None and fut in getters:
+                getters.remove(fut)
+                if not getters:
+                    del self._getters[remote]
+    # get()
+
+    async def quit_federation(self):
+        '''Send a quit message to all agents in this federation, and then close down this AsyncTransport.'''
+        if self._run:
+            self._pyre.shouts(self._globalchannel, u"QUIT")
+            await self.close()
+    # quit_federation()
+
+    async def close(self):
+        '''Close down this AsyncTransport without telling the rest of the federation.'''
+        if not self._run:
+            return
+        self._run = False
+        if self._reader is not None and self._reader is not asyncio.current_task():
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+        self._close_subscriptions()
+        # Pyre.stop() waits for the node thread, so don't block the loop.
+        await asyncio.get_running_loop().run_in_executor(None, self._pyre.stop)
+    # close()
+
+    def compression_stats(self):
+        '''Return a dict of compression counters, as Transport.compression_stats().'''
+        return self._compressor.stats()
+    # compression_stats()
+
+    def is_running(self):
+        '''Return the status of this AsyncTransport.'''
+        return self._run
+    # is_running()
+
+    ######################################################################
+    # All private methods below here
+
+    def _start_reader(self):
+        if self._reader is None and self._run:
+            self._reader = asyncio.ensure_future(self._readworker())
+    # _start_reader()
+
+    def _remove_subscription(self, sub):
+        subs = self._subscribers.get(sub.remote)
+        if subs is not None and sub in subs:
+            subs.remove(sub)
+            if not subs:
+                del self._subscribers[sub.remote]
+    # _remove_subscription()
+
+    def _close_subscriptions(self):
+        for subs in list(self._subscribers.values()):
+            for sub in list(subs):
+                sub.close()
+        for getters in self._getters.values():
+            for fut in getters:
+                if not fut.done():
+                    fut.cancel()
+    # _close_subscriptions()
+
+    async def _readworker(self):
+        '''Read and handle Pyre events until closed. Runs as a task in the event loop.'''
+        try:
+            await self._read_events()
+        except Exception as e:
+            logger.exception('AsyncTransport %s reader stopped'%(self._pyre.name()))
+            self._fail(e)
+            await asyncio.get_running_loop().run_in_executor(None, self._pyre.stop)
+    # _readworker()
+
+    def _fail(self, error):
+        '''Stop, and pass error on to everything waiting for messages.'''
+        self._run = False
+        self._error = error
+        for subs in list(self._subscribers.values()):
+            for sub in list(subs):
+                sub._fail(error)
+        for getters in self._getters.values():
+            for fut in getters:
+                if not fut.done():
+                    fut.set_exception(self._reader_error())
+    # _fail()
+
+    def _reader_error(self):
+        '''Return a new exception to raise in place of the one that stopped the reader task (see notes above).'''
+        error = TransportError(self, 'Reader stopped: %s'%(self._error))
+        error.__cause__ = self._error
+        return error
+    # _reader_error()
+
+    async def _read_events(self):
+        while self._run:
+            event = await self._sock.recv_multipart()
+            eventtype = event[0].decode('utf-8')
+            sid = uuid.UUID(bytes=event[1])
+            name = event[2].decode('utf-8')
+            if eventtype != 'ENTER' and sid not in self._uuid2ip:
+                raise TransportProtocolError(self, 'Received event %s with no matching ENTER.'%(event))
+
+            if eventtype == 'ENTER':
+                self._uuid2ip[sid] = enter_ip(self, sid, name, event[4].decode('utf-8'))
+            elif eventtype == 'SHOUT':
+                channel = event[3].decode('utf-8')
+                message = event[4:]
+                if channel == self._globalchannel and message == [b'QUIT']:
+                    await self.close()
+                    break
+                await self._handle(sid, name, channel, message)
+            elif eventtype == 'WHISPER':
+                # Transport whispers to destinations with a single
+                # peer, so this is the same as a SHOUT to our name.
+                await self._handle(sid, name, None, event[3:])
+            elif eventtype == 'EXIT':
+                del self._uuid2ip[sid]
+            elif eventtype in ('JOIN', 'LEAVE'):
+                pass
+            else:
+                raise TransportProtocolError(self, 'Unexpected event type in event %s'%(event))
+    # _read_events()
+
+    async def _handle(self, sid, name, channel, message):
+        try:
+            await self._SHOUT(sid, name, channel, message)
+        except TransportProtocolError as e:
+            logger.warning('Dropping message: %s'%(e))
+    # _handle()
+
+    async def _SHOUT(self, sid, name, channel, message):
+        try:
+            header = transport_codec.unpack_header(message)
+        except transport_codec.CodecError as e:
+            raise TransportProtocolError(self, 'Bad header from %s %s: %s'%(sid, name, e))
+        if header.flags & (transport_codec.FLAG_REPLY | transport_codec.FLAG_EXPIRED):
+            # Replies to requests and expiry reports, neither of which
+            # AsyncTransport sends.
+            return
+        if header.deadline is not None and time.time() > header.deadline:
+            # Too late. Tell the sender, as Transport._expire() does.
+            late = time.time() - header.deadline
+            logger.debug('Dropping message from %s that is %.3f seconds late'%(name, late))
+            self._pyre.shout(name, transport_codec.encode_message(self._codec, {'late': late}, transport_codec.FLAG_EXPIRED))
+            return
+        if header.codec_id == transport_codec.CODEC_SHM:
+            logger.warning('Dropping shared memory message from %s, which AsyncTransport can\'t map'%(name))
+            return
+        if header.flags & transport_codec.FLAG_REQUEST:
+            # AsyncTransport doesn't serve requests. Fail the request
+            # now rather than letting the requester time out.
+            error = 'No request handler in %s'%(self._pyre.name())
+            flags = transport_codec.FLAG_REPLY | transport_codec.FLAG_ERROR
+            self._pyre.shout(name, transport_codec.encode_message(self._codec, error, flags, header.correlation_id))
+            return
+        subs = self._subscribers.get(name)
+        getters = self._getters.pop(name, None)
+        if not subs and not getters:
+            return
+        try:
+            ntuples = transport_codec.decode_messages(header, message, self._compressor)
+        except (transport_codec.CodecError, ValueError) as e:
+            raise TransportProtocolError(self, 'Undecodable message from %s %s: %s'%(sid, name, e))
+        if getters:
+            # get() takes the first ntuple of a batch.
+            envelope = TransportEnvelope(ntuples[0], sid, name, self._uuid2ip[sid], datetime.datetime.now())
+            for fut in getters:
+                if not fut.done():
+                    fut.set_result(envelope)
+        if subs:
+            for ntuple in ntuples:
+                for sub in list(subs):
+                    # Waits if the subscriber is behind. This is where
+                    # backpressure comes from.
+                    if not sub._closed:
+                        await sub._queue.put(ntuple)
+    # _SHOUT()
+# class AsyncTransport
@@ -7,7 +7,9 @@
 #
 # TODO:
 #
-# Figure out what to do if you try to send a message and nobody's listening.
+# Figure out what to do if you try to send a message and nobody's
+# listening. (Partly addressed: see set_send_buffer() and
+# wait_for_peers().)
 #
 # Add TransportWarning exception for stuff that should be safely ignorable.
 #
@@ -27,9 +29,32 @@
 # logger.setLevel(logging.DEBUG)
 # logger.addHandler(ch)
 #
-# Pyre.set_port() is broken in the current Pyre implementation. If
-# you want to do multiple federations, use e.g.:
+# Pyre.set_port() is broken in the current Pyre implementation, but
+# port works (through transport_discovery.py). To run multiple
+# federations, use e.g. any of:
 # t = Transport(name, prefix='foo')
+# t = Transport(name, port=5671)
+# t = Transport(name, discovery='registry:/tmp/foo')
+#
+# Pyre finds peers with UDP beacons by default. Where that's slow or
+# unavailable (e.g. containers without broadcast), discovery picks
+# another way, e.g. a static table of endpoints:
+# t = Transport(name, discovery='static:A=tcp://10.0.0.1:5701,B=tcp://10.0.0.2:5701')
+# See transport_discovery.py.
+#
+# Messages are JSON encoded by default. A federation can pick a
+# compact binary codec instead, e.g.:
+# t = Transport(name, codec='binary')
+# See transport_codec.py for the wire format. Receivers detect the
+# codec from the message itself, so agents with different codecs can
+# share a federation as long as each can decode what it's sent.
+#
+# Agents that run in the same process can skip Pyre, zmq and
+# encoding entirely:
+# t = Transport(name, backend='inproc')
+# Messages are then delivered by reference (or as a deep copy with
+# copy=True) to other inproc Transports in the process. See
+# transport_loopback.py.
 
 
 # ------
@@ -48,13 +73,33 @@ import os
 import re
 import sys
 import threading
+import time
 import uuid
 
 from pyre import Pyre
 import zmq
 
+from nluas import transport_codec
+from nluas import transport_coalesce
+from nluas import transport_discovery
+from nluas import transport_dispatch
+from nluas import transport_loopback
+from nluas import transport_record
+from nluas import transport_shm
+from nluas import transport_stats
+
 VERSION = 0.1
 
+# Most normal messages the reader holds back for urgent ones, and
+# most urgent messages that can go ahead of them. See notes on
+# priorities.
+LANE_WINDOW = 64
+
+# Most messages a Transport keeps per remote nobody has subscribed to
+# yet, and how many seconds it keeps them. See notes on startup.
+EARLY_MAX = 1000
+EARLY_AGE = 30.0
+
 logger = logging.getLogger('Transport')
 
 def is_valid_ip(ipstr):
@@ -65,6 +110,99 @@ def is_valid_ip(ipstr):
     return ip.is_loopback or ip.is_private or ip in ipaddress.ip_network(u'192.150.186.0/24')
 # is_valid_ip()
 
+def enter_ip(t, sid, name, url):
+    '''Return the IP address of the peer that sent an ENTER event with the given url. Raises an error (attributed to Transport t) if the url is malformed or the IP isn't valid.'''
+    # We expect all connections to be tcp on some port. This regular
+    # expression is used to extract the ip part.
+    urlmatch = re.match('tcp://([0-9.]+):[0-9]+$', url)
+    if urlmatch:
+        ip = urlmatch.group(1)
+        if is_valid_ip(ip):
+            return ip
+        raise TransportSecurityError(t, 'Message from invalid IP address %s in ENTER %s %s %s. Check the function is_valid_ip() in Transport.py.'%(ip, sid, name, url))
+    raise TransportProtocolError(t, 'Malformed URL in ENTER %s %s %s'%(sid, name, url))
+# enter_ip()
+
+def takes_keywords(cb):
+    '''Return true if callable cb takes **kw.'''
+    # inspect.getargspec() is gone in python 3.11.
+    try:
+        if hasattr(inspect, 'getfullargspec'):
+            return inspect.getfullargspec(cb).varkw is not None
+        return inspect.getargspec(cb).keywords is not None
+    except TypeError:
+        # Some builtins can't be inspected. None of them take **kw.
+        return False
+# takes_keywords()
+
+# How a subscribed callback is called (_Subscription.kind): with just
+# the ntuple, with the ntuple and metadata keywords, or with a
+# TransportEnvelope. Decided when it's subscribed.
+_PLAIN = 0
+_KEYWORDS = 1
+_ENVELOPE = 2
+
+def _callback_kind(callback, envelope):
+    if envelope:
+        return _ENVELOPE
+    if takes_keywords(callback):
+        return _KEYWORDS
+    return _PLAIN
+# _callback_kind()
+
+def _urgent_event(event, first):
+    '''Return true if the message in a SHOUT or WHISPER event, whose frames start at index first, is urgent.'''
+    return len(event) > first + 1 and transport_codec.is_urgent(event[first])
+# _urgent_event()
+
+def _plain(ntuple):
+    '''Return ntuple, decoded if it's a LazyNtuple.'''
+    if isinstance(ntuple, transport_codec.LazyNtuple):
+        return ntuple.value
+    return ntuple
+# _plain()
+
+# What Transport.get() returns, and what callbacks subscribed with
+# envelope=True get: the ntuple plus information about the sender.
+TransportEnvelope = collections.namedtuple('TransportEnvelope', ['object', 'uuid', 'name', 'ip', 'datetime'])
+
+# A subscribed callback and the dispatcher that decides which thread
+# runs it (see transport_dispatch.py). lazy is true if the callback
+# gets transport_codec.LazyNtuples. where is None or a dict of
+# top-level fields the ntuple must have (see add_subscriber()).
+# Subscriptions to one remote are called in (order, seq) order. remote
+# is the (prefixed) remote, or None for every remote, and label names
+# the subscription in stats(). kind is how to call the callback
+# (_PLAIN, _KEYWORDS or _ENVELOPE).
+_Subscription = collections.namedtuple('_Subscription', ['callback', 'dispatcher', 'lazy', 'where', 'order', 'seq', 'remote', 'label', 'kind'])
+
+def _subscription_key(sub):
+    return (sub.order, sub.seq)
+# _subscription_key()
+
+# Default for LazyNtuple.peek(), so a where filter can tell a missing
+# field from one that is None.
+_MISSING = object()
+
+def _matches(where, lazy):
+    '''Return true if LazyNtuple lazy has every field in where, with the same value.'''
+    for (key, value) in where.items():
+        if lazy.peek(key, _MISSING) != value:
+            return False
+    return True
+# _matches()
+
+class _PendingRequest(object):
+    '''A request() waiting for its reply.'''
+    __slots__ = ['event', 'reply', 'error']
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.reply = None
+        self.error = None
+    # __init__()
+# class _PendingRequest
+
 # Base class for exceptions from a Transport. Should probably also
 # have TransportWarning since many of the errors could be safely
 # ignored.
@@ -91,6 +229,14 @@ class TransportSecurityError(TransportError):
     '''Raised if a sender's IP address isn't valid according to Transport.is_valid_ip()'''
     pass
 
+class TransportTimeoutError(TransportError):
+    '''Raised by Transport.request() if no reply arrives in time'''
+    pass
+
+class TransportRemoteError(TransportError):
+    '''Raised by Transport.request() if the remote handler failed. The message is the remote error.'''
+    pass
+
 ######################################################################
 #
 # The main class for Transport. On creation, sets up a thread to
@@ -100,72 +246,276 @@ class TransportSecurityError(TransportError):
 class Transport():
     '''Message transport mechanisms for LCAS'''
 
-    def send(self, dest, ntuple):
-        '''Send given ntuple to Transport named dest. If dest isn't listening for messages from this Transport, the message will (currently) be silently ignored.'''
+    # Notes on priorities
+    #
+    # send() and broadcast() take priority='normal' (the default) or
+    # 'high'. A high priority message (an application QUIT, a
+    # clarification request) is flagged as urgent on the wire, and the
+    # receiver handles it before normal messages that are waiting:
+    #
+    # - While a burst of events is waiting, the reader thread holds
+    #   back the normal messages it reads and handles urgent ones right
+    #   away. The held back messages are handled, in order, as soon as
+    #   the burst ends, before any other event (ENTER, EXIT, ...), or
+    #   once LANE_WINDOW are held back or LANE_WINDOW urgent messages
+    #   have gone ahead of them, whichever comes first.
+    #
+    # - Thread and pool subscriptions queue urgent messages in a lane
+    #   of their own, which goes first, but at most max_overtake (see
+    #   transport_dispatch.py) times in a row while normal messages
+    #   wait.
+    #
+    # So urgent traffic can't starve normal traffic, and what it costs
+    # normal traffic is in stats(): 'lanes' for the reader, and
+    # 'queued_urgent' and 'overtaken' per subscription.
+    #
+    # A high priority send() isn't coalesced. Messages from one
+    # sender with the same priority arrive in order, but a high
+    # priority message can overtake normal ones.
+    #
+    # Notes on deadlines
+    #
+    # send() can give an ntuple a deadline (seconds since the epoch),
+    # or a ttl (seconds from now), after which it's useless. The
+    # receiving Transport drops it instead of calling the callbacks if
+    # it arrives late, or if it's still queued for a thread or pool
+    # callback when the deadline passes (in which case it's dropped
+    # for that callback only). Each late ntuple is counted once as
+    # 'expired' in the receiver's stats(), however many callbacks
+    # dropped it, and reported back to the sender once, which counts
+    # them as 'expired_reported' and calls the callback given
+    # to set_expiry_callback(). An agent can use that to slow down or
+    # tell its user that the receiver is falling behind.
+    #
+    # Deadlines are compared with the receiver's clock, so the hosts'
+    # clocks must agree (e.g. with NTP) to well within the ttl. A
+    # send() with a deadline isn't coalesced.
+
+    def send(self, dest, ntuple, priority='normal', ttl=None, deadline=None):
+        '''Send given ntuple to Transport named dest. If dest isn't listening for messages from this Transport, the message will (currently) be silently ignored. If coalescing is on, the message may be held back briefly (see set_coalescing()). priority is 'normal' or 'high', and ttl or deadline limit how late the ntuple can be handled (see notes above).'''
+        flags = self._priority_flags(priority)
+        if ttl is not None:
+            expires = time.time() + ttl
+            deadline = expires if deadline is None else min(deadline, expires)
+        if self._recorder is not None:
+            self._recorder.record(transport_record.SENT, self._myname, dest, _plain(ntuple))
         if self._prefix is not None:
             dest = self._prefix + dest
-        self._pyre.shout(dest, json.dumps(ntuple).encode('utf-8'))
+        (codec_id, payload) = self._encode(ntuple)
+        coalescer = self._coalescer
+        shm = self._shm
+        if shm is not None and transport_codec.frame_size(payload) >= shm.threshold:
+            peers = self._local_peers(dest)
+            if peers is not None:
+                if coalescer is not None and not flags:
+                    coalescer.flush(dest)
+                handle = shm.put(codec_id, payload, len(peers))
+                self._send_frames(dest, transport_codec.pack_payloads(transport_codec.CODEC_SHM, [handle], flags, deadline=deadline))
+                return
+        if flags or deadline is not None:
+            if coalescer is not None and not flags:
+                # Same priority as what's buffered, so it must not
+                # overtake it.
+                coalescer.flush(dest)
+            self._send_frames(dest, transport_codec.pack_payloads(codec_id, [payload], flags, compressor=self._compressor, deadline=deadline))
+        elif coalescer is not None and codec_id == self._codec.codec_id:
+            coalescer.add(dest, payload)
+        else:
+            if coalescer is not None:
+                # Forwarding a payload in another codec, which can't
+                # join our batches.
+                coalescer.flush(dest)
+            self._send_frames(dest, transport_codec.pack_payloads(codec_id, [payload], compressor=self._compressor))
     # send()
 
-    def broadcast(self, ntuple):
-        '''Send given ntuple to Transport all destinations. If the destination isn't listening then the message will (currently) be silently ignored.'''
-        self._pyre.shout(self._globalchannel, json.dumps(ntuple).encode('utf-8'))
+    def send_many(self, dest, ntuples):
+        '''Send a list of ntuples to Transport named dest as a single message. The receiver's callback is called once per ntuple, in order.'''
+        if not ntuples:
+            return
+        ntuples = [_plain(ntuple) for ntuple in ntuples]
+        if self._recorder is not None:
+            for ntuple in ntuples:
+                self._recorder.record(transport_record.SENT, self._myname, dest, _plain(ntuple))
+        if self._prefix is not None:
+            dest = self._prefix + dest
+        if self._coalescer is not None:
+            # Anything already buffered for dest must go first.
+            self._coalescer.flush(dest)
+        self._send_frames(dest, transport_codec.encode_batch(self._codec, ntuples, self._compressor))
+    # send_many()
+
+    def relay(self, dest, frames):
+        '''Send a message exactly as another Transport sent it: frames is the list of Pyre frames of its SHOUT (or WHISPER), and dest the group it went to, prefix included. Nothing is decoded or encoded. Used by bridge_client.py.'''
+        if self._coalescer is not None:
+            self._coalescer.flush(dest)
+        self._send_frames(dest, list(frames))
+    # relay()
+
+    def broadcast(self, ntuple, priority='normal'):
+        '''Send given ntuple to Transport all destinations. If the destination isn't listening then the message will (currently) be silently ignored. priority is as in send().'''
+        flags = self._priority_flags(priority)
+        if self._recorder is not None:
+            self._recorder.record(transport_record.SENT, self._myname, 'GLOBAL', _plain(ntuple))
+        # Broadcasts are typically QUITs, which shouldn't overtake
+        # messages still waiting to be coalesced.
+        self.flush()
+        (codec_id, payload) = self._encode(ntuple)
+        self._shout(self._globalchannel, transport_codec.pack_payloads(codec_id, [payload], flags, compressor=self._compressor))
     # broadcast()
 
+    # Notes on coalescing
+    #
+    # Agents that send many small ntuples pay per-message overhead on
+    # both ends. With coalescing on, send() buffers ntuples per
+    # destination and sends each buffer as one message when it holds
+    # max_count ntuples or max_bytes encoded bytes, or max_delay
+    # seconds after the first ntuple went in. Receivers unpack the
+    # batch and call the callback once per ntuple, in order. See
+    # transport_coalesce.py.
+    #
+    # The cost is up to max_delay seconds of extra latency. Call
+    # flush() to send everything buffered right away.
+
+    def set_coalescing(self, enabled, max_delay=0.005, max_count=64, max_bytes=65536):
+        '''Turn coalescing of send() on or off. Turning it off flushes anything buffered.'''
+        old = self._coalescer
+        self._coalescer = None
+        if old is not None:
+            old.close()
+        if enabled:
+            try:
+                self._coalescer = transport_coalesce.Coalescer(self._send_payloads, max_delay, max_count, max_bytes)
+            except ValueError as e:
+                raise TransportError(self, str(e))
+    # set_coalescing()
+
+    def set_expiry_callback(self, callback):
+        '''Call callback(dest, late) when the Transport named dest drops an ntuple from this Transport because it missed its deadline by late seconds (see notes on deadlines). Called from the reader thread, so it must be quick. None turns it off.'''
+        self._expiry_callback = callback
+    # set_expiry_callback()
+
+    def flush(self):
+        '''Send all ntuples held back by coalescing.'''
+        coalescer = self._coalescer
+        if coalescer is not None:
+            coalescer.flush()
+    # flush()
+
     # Notes on subscribe
     #
-    # The callback is called in the same thread that listens for pyre
-    # messages, so the callback should start a new thread if it's
-    # going to block or take a long time to run.
+    # By default (policy='inline'), the callback is called in the same
+    # thread that listens for pyre messages, so a callback that blocks
+    # or takes a long time to run stalls every other channel. Use
+    # policy='thread' to give the subscription its own thread, or
+    # policy='pool' to share a pool of pool_size threads (see the
+    # constructor) among subscriptions. Either way, the callbacks for
+    # one subscription are called one at a time, in order.
+    #
+    # Thread and pool subscriptions buffer up to maxsize messages.
+    # overflow decides what to do when the buffer is full: 'block'
+    # the reader thread, 'drop_oldest' pending message, or 'reject'
+    # the new one. See transport_dispatch.py.
     #
     # The callback must take one positional argument, the tuple, and
     # can OPTIONALLY take a keyword argument (e.g. **kw). I use the
-    # inspect module to detect this. May be too clever for my own
-    # good.
+    # inspect module to detect this, once, when it's subscribed. May
+    # be too clever for my own good. With envelope=True, the callback
+    # instead gets a TransportEnvelope (see get()) holding the ntuple
+    # and the metadata.
     #
-    # There can be only one callback for a given remote. If you call
-    # subscribe again with the same remote, it raises an error.
-
-    def subscribe(self, remote, callback):
-        '''When a message is sent from a Transport named remote to this transport, call the passed callback with the ntuple as the first argument. If the callback takes **kw, it will also pass additional metadata such as the Transport name, UUID, and IP of the sender.'''
+    # There can be only one subscribe() callback for a given remote. If
+    # you call subscribe again with the same remote, it raises an
+    # error. Use add_subscriber() for more (see below).
+    #
+    # With lazy=True, the callback gets a transport_codec.LazyNtuple
+    # instead of the ntuple. It's decoded only when the callback uses
+    # it, and peek('type') reads one top-level field of a JSON ntuple
+    # without decoding the rest. Passing a LazyNtuple that hasn't been
+    # decoded to send() or broadcast() forwards the original bytes
+    # without encoding them again. This is for monitors, filters and
+    # bridges that look at few of the messages they get.
+
+    def subscribe(self, remote, callback, policy='inline', maxsize=transport_dispatch.DEFAULT_MAXSIZE, overflow='block', lazy=False, envelope=False):
+        '''When a message is sent from a Transport named remote to this transport, call the passed callback with the ntuple as the first argument. If the callback takes **kw, it will also pass additional metadata such as the Transport name, UUID, and IP of the sender; with envelope, it gets a TransportEnvelope instead. policy, maxsize and overflow control which thread runs the callback, and lazy whether it gets a LazyNtuple (see notes above).'''
         if self._prefix is not None:
             remote = self._prefix + remote
-        if remote in self._subscribers:
+        if remote in self._subscribed:
             raise TransportError(self, 'Transport.subscribe() was called a second time with the same remote (\"%s\"). You must call Transport.unsubscribe() before setting a new callback.'%(remote))
-        self._subscribers[remote] = callback
+        self._subscribed[remote] = self._add_subscription(callback, policy, maxsize, overflow, lazy, None, 0, remote, remote, envelope)
     # subscribe()
 
     def unsubscribe(self, remote):
-        '''Stop listening for messages from remote.'''
+        '''Stop listening for messages from remote. Messages already queued for a thread or pool callback are still delivered. Subscribers added with add_subscriber() are left alone.'''
         if self._prefix is not None:
             remote = self._prefix + remote
-        if remote in self._subscribers:
-            del self._subscribers[remote]
+        sub = self._subscribed.pop(remote, None)
+        if sub is not None:
+            self._remove_subscription(sub)
     # unsubscribe()
 
-    def subscribe_all(self, callback):
-        '''Call callback every time a message is sent from any remote Transport to this Transport.'''
-        if self._subscribe_all is not None:
+    def subscribe_all(self, callback, policy='inline', maxsize=transport_dispatch.DEFAULT_MAXSIZE, overflow='block', lazy=False, envelope=False):
+        '''Call callback every time a message is sent from any remote Transport to this Transport. policy, maxsize, overflow, lazy and envelope are as in subscribe().'''
+        if self._subscribed_all is not None:
             raise TransportError(self, 'Transport.subscribe_all() was called a second time. You must call Transport.unsubscribe_all() before setting a new callback.')
-        self._subscribe_all = callback
+        self._subscribed_all = self._add_subscription(callback, policy, maxsize, overflow, lazy, None, 0, None, '*', envelope)
     # subscribe_all()
 
     def unsubscribe_all(self):
-        self._subscribe_all = None
+        sub = self._subscribed_all
+        self._subscribed_all = None
+        if sub is not None:
+            self._remove_subscription(sub)
     # unsubscribe_all()
 
+    # Notes on add_subscriber
+    #
+    # add_subscriber() adds one more callback for remote (or for every
+    # remote, if remote is None), next to the subscribe() one, so
+    # logging, metrics and the agent's own logic can each have their
+    # own callback instead of one that does everything. Each one has
+    # its own policy, maxsize and overflow, lazy and envelope, as in
+    # subscribe().
+    #
+    # The callbacks for a message are called (or queued, for thread
+    # and pool subscriptions) in order of the order argument, and in
+    # the order they were added for the same order. subscribe() and
+    # subscribe_all() callbacks have order 0. Callbacks for one remote
+    # and for every remote are merged into the same order.
+    #
+    # where is a dict of top-level fields and the values they must
+    # have, e.g. {'predicate_type': 'query'}. Other ntuples, and ntuples
+    # that aren't dicts, aren't passed to the callback. The fields are
+    # read with LazyNtuple.peek(), so if only lazy and where
+    # subscribers listen, a JSON message that matches no filter isn't
+    # decoded at all. Either way, a message is decoded at most once and
+    # the same ntuple is passed to every callback, so callbacks must
+    # not modify it.
+
+    def add_subscriber(self, remote, callback, policy='inline', maxsize=transport_dispatch.DEFAULT_MAXSIZE, overflow='block', lazy=False, where=None, order=0, label=None, envelope=False):
+        '''Also call callback for messages from the Transport named remote (any Transport if remote is None), if they match where. Returns a handle for remove_subscriber(). label names the subscription in stats(). See notes above.'''
+        if remote is not None and self._prefix is not None:
+            remote = self._prefix + remote
+        if where is not None and not isinstance(where, dict):
+            raise TransportError(self, 'Transport.add_subscriber() where must be a dict of fields and values, not %r'%(where))
+        if label is None:
+            label = '%s#%d'%(remote if remote is not None else '*', self._subseq + 1)
+        return self._add_subscription(callback, policy, maxsize, overflow, lazy, where, order, remote, label, envelope)
+    # add_subscriber()
+
+    def remove_subscriber(self, handle):
+        '''Remove a subscriber added with add_subscriber(). Messages already queued for it are still delivered.'''
+        self._remove_subscription(handle)
+    # remove_subscriber()
+
     # Notes on get()
     #
-    # If you already subscribe to remote, temporarly overrides
-    # the subscribe. The subscribed callback will NOT be called.
-    # The subscription is replaced after get() returns.
+    # get() adds a temporary subscriber for remote, so callbacks
+    # already subscribed to remote are still called for the message
+    # get() returns.
 
     def get(self, remote):
         '''Block waiting for a message from a Transport named remote. Returns python namedtuple containing fields object, uuid, name, ip, datetime.'''
 
-        if self._prefix is not None:
-            remote = self._prefix + remote
-
         # The final python namedtuple to be returned needs to be shared
         # between get_callback() and get(). In python3, you can use
         # nonlocal, but in python2 you need a trick (storing in a
@@ -178,63 +528,459 @@ class Transport():
         e = threading.Event()
 
         # This function is a callback used to detect the next message.
-        # It stores the message in a Python namedtuple and sets the
+        # It gets the message in a Python namedtuple and sets the
         # event.
 
-        def get_callback(tup, **kw):
-            ret[0] = collections.namedtuple('TransportEnvelope', ['object', 'uuid', 'name', 'ip', 'datetime'])(tup, kw['uuid'], kw['name'], kw['ip'], kw['datetime'])
+        def get_callback(envelope):
+            # Only the first ntuple of a batch is returned.
+            if e.is_set():
+                return
+            ret[0] = envelope
             # Inform get() that ret is ready to be returned.
             e.set()
         # get_callback()
 
-        # Store the old callback, if any
-        oldcb = self._subscribers.get(remote, None)
-
-        # Set the subscription
-        self._subscribers[remote] = get_callback
-
-        # Wait for the callback to be called.
-        e.wait()
-
-        # Restore the old subscription, if any.
-        if oldcb is not None:
-            self._subscribers[remote] = oldcb
-        else:
-            del self._subscribers[remote]
+        handle = self.add_subscriber(remote, get_callback, label='get', envelope=True)
+        try:
+            # Wait for the callback to be called.
+            e.wait()
+        finally:
+            self.remove_subscriber(handle)
 
         # Return the namedtuple.
         return ret[0]
     # get()
 
+    # Notes on request() and serve()
+    #
+    # request() sends the ntuple with a fresh correlation id and waits
+    # for the reply carrying the same id. Any number of requests can
+    # be outstanding at once, from any number of threads. Replies go
+    # straight to the waiting request and never reach subscribe()
+    # callbacks, and requests never reach subscribe() callbacks either,
+    # so request/serve can share a remote with normal messages.
+    #
+    # request() can't be called from an inline callback, since the
+    # reply would have to be read by the very thread that's waiting.
+    # Use policy='thread' or 'pool' for callbacks that make requests.
+    #
+    # serve() registers one handler for requests from any remote. The
+    # handler is called like a subscribe() callback and its return
+    # value is sent back as the reply. With policy='pool', up to
+    # pool_size requests are handled concurrently. If it raises, the requester
+    # gets a TransportRemoteError. If there's no handler, requests fail
+    # right away with TransportRemoteError.
+
+    def request(self, dest, ntuple, timeout=None):
+        '''Send ntuple to the Transport named dest, wait for the handler dest registered with serve() to reply, and return the reply. Raises TransportTimeoutError if no reply arrives within timeout seconds (None waits forever).'''
+        if threading.current_thread() is self._readthread:
+            raise TransportError(self, 'Transport.request() cannot be called from an inline callback. Subscribe with policy="thread" or "pool".')
+        if self._prefix is not None:
+            dest = self._prefix + dest
+        cid = uuid.uuid4()
+        pending = _PendingRequest()
+        with self._pending_lock:
+            self._pending[cid] = pending
+        try:
+            self._send_frames(dest, transport_codec.encode_message(self._codec, ntuple, transport_codec.FLAG_REQUEST, cid, self._compressor))
+            if not pending.event.wait(timeout):
+                raise TransportTimeoutError(self, 'No reply from %s within %s seconds'%(dest, timeout))
+        finally:
+            with self._pending_lock:
+                self._pending.pop(cid, None)
+        if pending.error is not None:
+            raise TransportRemoteError(self, 'Request to %s failed: %s'%(dest, pending.error))
+        return pending.reply
+    # request()
+
+    def serve(self, handler, policy='inline', maxsize=transport_dispatch.DEFAULT_MAXSIZE, overflow='block', envelope=False):
+        '''Call handler for every request() sent to this Transport and reply with its return value. policy, maxsize, overflow and envelope are as in subscribe().'''
+        if self._server is not None:
+            raise TransportError(self, 'Transport.serve() was called a second time. You must call Transport.unserve() before setting a new handler.')
+        # Requests are independent, so with the pool policy they run
+        # concurrently rather than in order.
+        self._server = self._make_subscription(handler, policy, maxsize, overflow, 'serve', ordered=False, envelope=envelope)
+    # serve()
+
+    def unserve(self):
+        '''Stop handling requests.'''
+        sub = self._server
+        self._server = None
+        if sub is not None:
+            sub.dispatcher.close()
+    # unserve()
+
+    # Notes on stats
+    #
+    # stats() returns a snapshot dict:
+    #
+    #   uptime         seconds since this Transport was created
+    #   remotes        per remote name (with prefix): messages and bytes
+    #                  received and sent, and histograms of decode time
+    #                  and callback run time
+    #   subscriptions  per subscribed remote ('*' for subscribe_all,
+    #                  'serve' for the request handler): policy, number
+    #                  of queued messages (and how many are urgent), age
+    #                  in seconds of the oldest undelivered one, messages
+    #                  dropped on overflow, and urgent messages
+    #                  delivered ahead of waiting normal ones
+    #                  remotes also count urgent messages received,
+    #                  and messages that expired (see notes on
+    #                  deadlines) here or at the remote
+    #   lanes          the reader's priority lanes (see notes on
+    #                  priorities): overtakes, urgent messages handled
+    #                  ahead of held back normal ones; overtaken, the
+    #                  normal messages they went ahead of;
+    #                  max_held_back; and forced, how often the held
+    #                  back ones were let through to bound their wait
+    #   compression    see compression_stats()
+    #   pending_requests  request() calls waiting for a reply
+    #   held           per destination, messages held until it joins,
+    #                  and held_dropped, the number dropped because the
+    #                  send buffer was full (see set_send_buffer())
+    #   early          per remote, messages kept until it's subscribed
+    #                  to, and early_dropped, the number dropped beyond
+    #                  EARLY_MAX or EARLY_AGE (see notes on startup)
+    #   undecodable    messages dropped because their header or
+    #                  payload couldn't be decoded
+    #
+    # Histograms have log-scale buckets from 1us up, with p50/p90/p99
+    # estimates. See transport_stats.py.
+
+    def stats(self):
+        '''Return a snapshot of this Transport's counters (see notes above).'''
+        snap = self._stats.snapshot()
+        now = time.time()
+        subs = {}
+        items = [sub for remote_subs in list(self._subscribers.values()) for sub in remote_subs]
+        items.extend(self._subscribe_all)
+        if self._server is not None:
+            items.append(self._server)
+        for sub in items:
+            q = sub.dispatcher.queue
+            info = {'policy': sub.dispatcher.policy, 'queued': 0, 'queued_urgent': 0, 'oldest_age': None, 'dropped': 0, 'overtaken': 0}
+            if q is not None:
+                oldest = q.oldest()
+                info['queued'] = len(q)
+                info['queued_urgent'] = q.urgent()
+                info['oldest_age'] = now - oldest if oldest is not None else None
+                info['dropped'] = q.dropped
+                info['overtaken'] = q.overtaken
+            subs[sub.label] = info
+        snap['subscriptions'] = subs
+        snap['compression'] = self._compressor.stats()
+        snap['pending_requests'] = len(self._pending)
+        shm = self._shm
+        snap['shared_memory'] = shm.stats() if shm is not None else {}
+        snap['shared_memory']['mapped'] = self._shm_mapped
+        snap['shared_memory']['missing'] = self._shm_missing
+        with self._peers_cond:
+            snap['held'] = dict([(dest, len(held)) for (dest, held) in self._held.items()])
+            snap['held_dropped'] = self._held_dropped
+        with self._early_lock:
+            snap['early'] = dict([(remote, len(early)) for (remote, early) in self._early.items()])
+            snap['early_dropped'] = self._early_dropped
+        snap['undecodable'] = self._undecodable
+        return snap
+    # stats()
+
+    def start_stats_export(self, interval=10.0, path=None):
+        '''Every interval seconds, write stats() as a JSON line to the file at path, or to the Transport logger at INFO level if path is None.'''
+        self.stop_stats_export()
+        try:
+            self._exporter = transport_stats.StatsExporter(self.stats, interval, path)
+        except ValueError as e:
+            raise TransportError(self, str(e))
+    # start_stats_export()
+
+    def stop_stats_export(self):
+        '''Stop exporting stats, after writing one final snapshot.'''
+        exporter = self._exporter
+        self._exporter = None
+        if exporter is not None:
+            exporter.stop()
+    # stop_stats_export()
+
+    # Notes on startup
+    #
+    # Agents start in any order, and Pyre takes a moment to discover
+    # peers. A message sent before its destination has joined is
+    # silently lost. Two ways around that:
+    #
+    # wait_for_peers() blocks until Transports with the given names
+    # have joined, e.g. before sending the first message.
+    #
+    # set_send_buffer() makes send(), send_many() and request() hold
+    # messages for a destination nobody has joined yet, and send them
+    # in order as soon as it joins. At most maxsize messages are held
+    # per destination; beyond that the oldest are dropped (and counted
+    # in stats() under 'held').
+    #
+    # A destination joins when its Transport is created, which may be
+    # well before it subscribes (e.g. after connecting to a server), and
+    # agents subscribe to one remote after another. So a Transport keeps
+    # the messages it gets from a remote until something subscribes to
+    # that remote (subscribe(), add_subscriber() or get()) or to every
+    # remote (subscribe_all()), and then hands them to the subscribers
+    # in order, from the read thread. At most EARLY_MAX are kept per
+    # remote, for at most EARLY_AGE seconds. Once a remote has been
+    # subscribed to, its messages are discarded as usual while nothing
+    # is subscribed to it.
+
+    def wait_for_peers(self, names, timeout=None):
+        '''Block until a Transport has joined for each of names (a name or list of names). Returns False if timeout seconds pass first, True otherwise.'''
+        if threading.current_thread() is self._readthread:
+            raise TransportError(self, 'Transport.wait_for_peers() cannot be called from an inline callback.')
+        if not isinstance(names, (list, tuple, set)):
+            names = [names]
+        if self._prefix is not None:
+            names = [self._prefix + name for name in names]
+        with self._peers_cond:
+            return self._peers_cond.wait_for(lambda: all([self._group_peers.get(name) for name in names]), timeout)
+    # wait_for_peers()
+
+    def set_send_buffer(self, maxsize=1000):
+        '''Hold up to maxsize messages per destination that hasn't joined yet, and send them when it does. None turns holding off and discards anything held.'''
+        if maxsize is not None and maxsize < 1:
+            raise TransportError(self, 'Send buffer size must be positive.')
+        with self._peers_cond:
+            self._hold_max = maxsize
+            if maxsize is None:
+                for (dest, held) in self._held.items():
+                    logger.warning('Discarding %d held messages for %s'%(len(held), dest))
+                self._held = {}
+    # set_send_buffer()
+
+    # Notes on recording
+    #
+    # start_recording() appends every ntuple this Transport sends
+    # (send(), send_many() and broadcast()) or receives (except
+    # requests and replies) to a log file, with time, sender and
+    # channel. transport_record.Replayer reads a log back, and can
+    # replay it into a Transport's subscribers with inject(), at the
+    # original speed, scaled, or as fast as possible. E.g. to load
+    # test an agent with what it received in a real session:
+    #
+    # t.start_recording('session.log')
+    # ...
+    # transport_record.Replayer('session.log').replay(other, speed=None)
+
+    def start_recording(self, path, codec='binary'):
+        '''Append all traffic to the log at path (see notes above). codec encodes the ntuples in the log.'''
+        self.stop_recording()
+        try:
+            self._recorder = transport_record.Recorder(path, codec)
+        except (transport_codec.CodecError, IOError, OSError) as e:
+            raise TransportError(self, 'Cannot record to %s: %s'%(path, e))
+    # start_recording()
+
+    def stop_recording(self):
+        '''Stop recording and close the log.'''
+        recorder = self._recorder
+        self._recorder = None
+        if recorder is not None:
+            recorder.close()
+    # stop_recording()
+
+    def inject(self, remote, ntuple):
+        '''Deliver ntuple to the callbacks subscribed to remote (and subscribe_all) as if remote had just sent it. The uuid and ip passed to callbacks are None.'''
+        if self._prefix is not None:
+            remote = self._prefix + remote
+        self._dispatch(None, remote, None, [ntuple], datetime.datetime.now())
+    # inject()
+
     def quit_federation(self):
         '''Send a quit message to all agents in this federation, and then close down the Transport.'''
         if self._run:
-            self._pyre.shouts(self._globalchannel, u"QUIT")
+            self.set_coalescing(False)
+            with self._sendlock:
+                self._pyre.shouts(self._globalchannel, u"QUIT")
             self._run = False
+            self._wake()
             # Wait for the readthread to finish
             self._readthread.join()
-            # Tell Pyre to shut down
-            self._pyre.stop()
+            self._shutdown()
 
     def is_running(self):
         '''Return the status of this Transport. If the Transport isn't running, you should not send it messages and the callbacks will not be called.'''
         return self._run
 
+    def codec(self):
+        '''Return the name of the codec used to encode outgoing messages.'''
+        return self._codec.name
+
+    def backend(self):
+        '''Return the name of the backend carrying messages, "pyre" or "inproc".'''
+        return self._backend
+
+    def discovery(self):
+        '''Return how the pyre backend finds peers, as a discovery spec (see transport_discovery.py), or None for inproc.'''
+        if self._backend != 'pyre':
+            return None
+        if self._discovery is None:
+            return 'beacon'
+        return repr(self._discovery)
+
+    # Notes on compression
+    #
+    # Compression is off by default. With a threshold set, outgoing
+    # messages whose encoded payload is at least threshold bytes are
+    # zlib compressed at the given level. Receivers always handle
+    # compressed messages. compression_stats() reports how much was
+    # saved and what it cost in CPU time (both directions), which is
+    # what you need to pick a threshold. See transport_codec.Compressor.
+
+    def set_compression(self, threshold, level=6):
+        '''Compress outgoing messages of at least threshold bytes. None turns compression off.'''
+        if threshold is not None and self._backend == 'inproc':
+            raise TransportError(self, 'Compression does not apply to the inproc backend.')
+        self._compressor.threshold = threshold
+        self._compressor.level = level
+    # set_compression()
+
+    # Notes on shared memory
+    #
+    # With set_shared_memory(threshold), send() puts an encoded
+    # payload of at least threshold bytes in a block of shared memory
+    # instead of the message, if every Transport it goes to is on
+    # this host, and sends only a small handle. The receiver decodes
+    # straight from the mapped block, so big payloads (parses,
+    # world-model snapshots) aren't copied through zmq or again before
+    # decoding. Receivers always handle these messages; only the
+    # sender needs to turn this on.
+    #
+    # Blocks are unlinked as soon as every receiver has mapped them,
+    # or lease seconds after they were sent, whichever comes first,
+    # and blocks left by crashed agents are removed by the next one to
+    # turn this on. See transport_shm.py. stats() reports them under
+    # 'shared_memory'.
+    #
+    # Off by default. Pick the binary codec too: JSON has to copy the
+    # payload to decode it anyway.
+
+    def set_shared_memory(self, threshold=transport_shm.DEFAULT_THRESHOLD, lease=transport_shm.DEFAULT_LEASE):
+        '''Send payloads of at least threshold bytes to Transports on this host through shared memory (see notes above). None turns it off.'''
+        if threshold is not None and self._backend == 'inproc':
+            raise TransportError(self, 'Shared memory does not apply to the inproc backend.')
+        old = self._shm
+        self._shm = None
+        if old is not None:
+            old.close()
+        if threshold is not None:
+            try:
+                self._shm = transport_shm.SharedMemoryWriter(threshold, lease)
+            except ValueError as e:
+                raise TransportError(self, str(e))
+            # The read thread unlinks blocks whose lease ran out.
+            self._wake()
+    # set_shared_memory()
+
+    def compression_stats(self):
+        '''Return a dict of compression counters: messages compressed and skipped, bytes before and after, ratio, and CPU seconds spent compressing and decompressing.'''
+        return self._compressor.stats()
+    # compression_stats()
+
     ######################################################################
     # All private methods below here
 
-    def __init__(self, myname, port=None, prefix=None):
-        # NOTE: Seems to be a bug in Pyre where you can't set the port.
+    def __init__(self, myname, port=None, prefix=None, codec='json', pool_size=4, compress_threshold=None, backend='pyre', copy=False, router=None, discovery=None):
+        # How the pyre backend finds peers: a
+        # transport_discovery.Discovery or a spec string. None means
+        # Pyre's own UDP beacons, on port if given.
         if port is not None:
-            raise NotImplementedError('There is a bug in Pyre that prevents setting of the discovery port. If you require multiple federations of Pyre components, use prefix instead of port in Transport constructor.')
-
-        # dict of remote name to callback. See subscribe method above.
+            if discovery is not None:
+                raise TransportError(None, 'Give either port or discovery, not both.')
+            discovery = transport_discovery.BeaconDiscovery(port)
+        if discovery is not None:
+            if backend != 'pyre':
+                raise TransportError(None, 'Discovery only applies to the pyre backend.')
+            try:
+                discovery = transport_discovery.get_discovery(discovery)
+            except transport_discovery.DiscoveryError as e:
+                raise TransportError(None, str(e))
+
+        # 'pyre' for the network, 'inproc' for Transports in this
+        # process only. The inproc backend always uses the reference
+        # codec, so codec is ignored. router (a
+        # transport_loopback.LoopbackRouter) and copy only apply to
+        # inproc.
+        if backend not in ('pyre', 'inproc'):
+            raise TransportError(None, 'Unknown Transport backend "%s"'%(backend))
+        self._backend = backend
+        if backend == 'inproc':
+            codec = 'reference'
+            if compress_threshold is not None:
+                raise TransportError(None, 'Compression does not apply to the inproc backend.')
+
+        # Codec used for outgoing messages. Incoming messages carry
+        # their own codec id, see transport_codec.py.
+        try:
+            self._codec = transport_codec.get_codec(codec)
+        except transport_codec.CodecError as e:
+            raise TransportError(None, str(e))
+        if backend == 'pyre' and self._codec.codec_id == transport_codec.CODEC_REFERENCE:
+            raise TransportError(None, 'The reference codec only works with the inproc backend.')
+
+        # dict of remote name to a tuple of _Subscriptions, in the
+        # order they're called. Replaced rather than modified, under
+        # _sublock, since the reader thread uses it without a lock.
+        # See add_subscriber method above.
         self._subscribers = {}
 
-        # Callback for all message (or None if none registered)
-        self._subscribe_all = None
+        # Tuple of _Subscriptions for messages from every remote.
+        self._subscribe_all = ()
+
+        # The _Subscriptions made by subscribe() (by remote) and
+        # subscribe_all(), which allow one each.
+        self._subscribed = {}
+        self._subscribed_all = None
+
+        self._sublock = threading.Lock()
+        self._subseq = 0
+
+        # Compresses outgoing messages (if compress_threshold is set)
+        # and counts compression work. See set_compression().
+        self._compressor = transport_codec.Compressor(compress_threshold)
+
+        # Counters and histograms. See stats().
+        self._stats = transport_stats.TransportStats()
+
+        # transport_stats.StatsExporter, or None if not exporting.
+        self._exporter = None
+
+        # zmq sockets aren't thread safe, and send() may be called from
+        # any thread (including callback threads). Held while talking
+        # to Pyre.
+        self._sendlock = threading.Lock()
+
+        # transport_coalesce.Coalescer, or None if coalescing is off.
+        # See set_coalescing().
+        self._coalescer = None
+
+        # _Subscription for the request handler. See serve().
+        self._server = None
+
+        # dict of correlation id => _PendingRequest for requests
+        # waiting for a reply. Shared by request() callers and the
+        # read thread, so guarded by _pending_lock.
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+        # Threads shared by subscriptions with policy='pool'. Created
+        # on first use.
+        self._pool_size = pool_size
+        self._pool = None
 
         self._prefix = prefix
+        self._myname = myname
+
+        # transport_record.Recorder, or None if not recording. See
+        # start_recording().
+        self._recorder = None
+
+        # Called when a receiver reports one of our messages expired.
+        # See set_expiry_callback().
+        self._expiry_callback = None
 
         # Attach the federation name as a prefix to both this channel
         # and the global channel. The global channel is currently
@@ -246,17 +992,105 @@ class Transport():
         else:
             self._globalchannel = "GLOBAL"
 
-        self._pyre = Pyre(myname)
-        if port is not None:
-            self._pyre.set_port(port)
+        # Despite the name, an inproc Transport's node is a
+        # transport_loopback.LoopbackNode.
+        if backend == 'inproc':
+            self._pyre = transport_loopback.LoopbackNode(myname, router, copy)
+            self._host = None
+        else:
+            if discovery is None:
+                self._pyre = Pyre(myname)
+            else:
+                self._pyre = transport_discovery.DiscoveryPyre(myname, discovery)
+            # Tells peers on this host they can use shared memory. See
+            # set_shared_memory().
+            self._host = transport_shm.host_id()
+            self._pyre.set_header(transport_shm.HOST_HEADER, self._host)
+        self._discovery = discovery
 
         self._pyre.join(myname)
         self._pyre.join(self._globalchannel)
-        self._pyre.start()
+        try:
+            self._pyre.start()
+        except transport_discovery.DiscoveryError as e:
+            self._pyre.stop()
+            raise TransportError(None, str(e))
 
         # Dict of (UUIDs => IP addresses) that have sent a valid ENTER message
         self._uuid2ip = {}
 
+        # Dict of UUID => transport_shm.host_id() of peers that
+        # advertise one.
+        self._peer_hosts = {}
+
+        # transport_shm.SharedMemoryWriter, or None if large payloads
+        # aren't sent through shared memory. See set_shared_memory().
+        self._shm = None
+        # Blocks received and mapped, and ones that were already gone.
+        self._shm_mapped = 0
+        self._shm_missing = 0
+
+        # Messages the read thread dropped because they couldn't be
+        # decoded. See _drop_message().
+        self._undecodable = 0
+
+        # Dict of group name => tuple of UUIDs of peers in that group.
+        # See _send_frames().
+        self._group_peers = {}
+
+        # Signalled whenever _group_peers changes. Also guards _held.
+        self._peers_cond = threading.Condition()
+
+        # Dict of destination => deque of frames waiting for it to
+        # join, at most _hold_max each. _hold_max None means don't
+        # hold. See set_send_buffer().
+        self._held = {}
+        self._hold_max = None
+        self._held_dropped = 0
+
+        # Dict of remote name => deque of (time received, sid, name,
+        # channel, message, ip) for remotes nothing has subscribed to
+        # yet. Only the read thread adds and delivers them, but
+        # _early_lock guards changes, since subscribers and stats()
+        # look too. See notes on startup.
+        self._early = {}
+        self._early_dropped = 0
+        self._early_lock = threading.Lock()
+        # Remotes that have had a subscription, None for
+        # subscribe_all(). Messages from them aren't kept.
+        self._listened = set()
+
+        # Dict of raw uuid bytes => (uuid.UUID, name) for peers that
+        # have sent ENTER, so events don't have to be parsed from
+        # scratch. Only used by the read thread.
+        self._peers = {}
+
+        # Dict of raw group name => decoded name. See _channel().
+        self._channels = {}
+        self._globalchannel_bytes = self._globalchannel.encode('utf-8')
+
+        # dict of pyre event type => method that handles it.
+        self._event_handlers = {
+            b'ENTER': self._event_ENTER,
+            b'JOIN': self._event_JOIN,
+            b'SHOUT': self._event_SHOUT,
+            b'WHISPER': self._event_WHISPER,
+            b'LEAVE': self._event_LEAVE,
+            b'EXIT': self._event_EXIT,
+        }
+
+        # Control socket pair. Anything sent on _ctrl_send wakes the
+        # read thread, see _wake().
+        ctx = zmq.Context.instance()
+        self._ctrl_recv = ctx.socket(zmq.PAIR)
+        self._ctrl_send = ctx.socket(zmq.PAIR)
+        endpoint = 'inproc://transport-ctrl-%s'%(uuid.uuid4().hex)
+        self._ctrl_recv.bind(endpoint)
+        self._ctrl_send.connect(endpoint)
+        self._ctrl_lock = threading.Lock()
+        # Set by _shutdown()
+        self._stopped = False
+
         self._run = True
 
         self._readthread = threading.Thread(target=self._readworker)
@@ -265,120 +1099,721 @@ class Transport():
 
     # Handle pyre messages. Run in self._readthread
     def _readworker(self):
-        '''This method is called in a separate thread to handle messages sent over pyre. It dispataches to methods named for the pyre events (e.g. _ENTER).'''
-
-        # Set up a poller so recv doesn't block. Possibly not needed
-        # since we'll always get an event when the other agents quit,
-        # but just in case something goes wrong, we want to be sure to
-        # close down.
+        '''This method is called in a separate thread to handle messages sent over pyre. It dispatches to methods named for the pyre events (e.g. _ENTER).'''
 
+        # Wait on both Pyre and the control socket, so quit_federation()
+        # can wake us right away instead of waiting for a timeout.
         poller = zmq.Poller()
         sock = self._pyre.socket()
         poller.register(sock, zmq.POLLIN)
+        poller.register(self._ctrl_recv, zmq.POLLIN)
+
+        # Locals, since this loop runs once per event.
+        ctrl = self._ctrl_recv
+        handlers = self._event_handlers
+        peers = self._peers
+        recv = self._pyre.recv
+        enter = self._event_ENTER
+        # From the table, so they can be compared with "is".
+        shout = handlers[b'SHOUT']
+        whisper = handlers[b'WHISPER']
+
+        # Normal messages held back while more events wait, so urgent
+        # ones can go first, as (handler, event, peer). overtakes
+        # counts the urgent messages that went ahead of them. See notes
+        # on priorities.
+        backlog = collections.deque()
+        overtakes = 0
+
+        # When the next shared memory blocks whose lease ran out
+        # should be unlinked. See _collect_shared().
+        collect = None
+
+        try:
+            while self._run:
+                timeout = None
+                shm = self._shm
+                if shm is not None:
+                    collect = self._collect_shared(shm, collect)
+                    timeout = max(0, 1000 * (collect - time.time()))
+                items = dict(poller.poll(timeout))
+                if ctrl in items:
+                    ctrl.recv()
+                    if not self._run:
+                        break
+                    if self._early:
+                        self._release_early()
+                if sock not in items:
+                    continue
+                # There's at least one event waiting. Handle events
+                # until there are none, checking the socket directly
+                # rather than going back to the (slower) poller.
+                while self._run:
+                    event = recv()
+                    more = sock.getsockopt(zmq.EVENTS) & zmq.POLLIN
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug('Transport %s-%s received event %s'%(self._pyre.uuid(), self._pyre.name(), event))
+                    handler = handlers.get(event[0])
+                    if handler is None:
+                        raise TransportProtocolError(self, 'Illegal event type in event %s'%(event))
+                    # Sender's (uuid, name). Make sure we've seen matching
+                    # ENTER for all events.
+                    peer = peers.get(event[1])
+                    if peer is None and handler != enter:
+                        raise TransportProtocolError(self, 'Received event %s with no matching ENTER.'%(event))
+                    if handler is shout or handler is whisper:
+                        if _urgent_event(event, 4 if handler is shout else 3):
+                            if backlog:
+                                overtakes += 1
+                                self._stats.record_overtake(len(backlog))
+                            handler(event, peer)
+                        elif more or backlog:
+                            backlog.append((handler, event, peer))
+                        else:
+                            handler(event, peer)
+                    else:
+                        # Other events stay in order with messages, e.g.
+                        # the sender's EXIT comes after its messages.
+                        if backlog:
+                            self._handle_backlog(backlog)
+                            overtakes = 0
+                        handler(event, peer)
+                    if backlog and (not more or len(backlog) >= LANE_WINDOW or overtakes >= LANE_WINDOW):
+                        if more:
+                            self._stats.record_forced()
+                        self._handle_backlog(backlog)
+                        overtakes = 0
+                    if not (self._run and more):
+                        break
+        finally:
+            with self._ctrl_lock:
+                self._ctrl_send.close(linger=0)
+                self._ctrl_send = None
+            ctrl.close(linger=0)
+    # _readworker()
 
-        while self._run:
-            # Wait until a message is received OR one second timeout.
-            items = dict(poller.poll(1000))
-            if not (sock in items and items[sock] == zmq.POLLIN):
-                # This should only happen if we time out.
-                continue
-            # There's an event waiting. Read and process it.
-            event = self._pyre.recv()
-            logger.debug('Transport %s-%s received event %s'%(self._pyre.uuid(), self._pyre.name(), event))
-            eventtype = event[0].decode('utf-8')
-            # Sender's uuid and name
-            sid = uuid.UUID(bytes=event[1])
-            name = event[2].decode('utf-8')
-            # Make sure we've seen matching ENTER for all events
-            if eventtype != 'ENTER' and sid not in self._uuid2ip:
-                raise TransportProtocolError(self, 'Received event %s with no matching ENTER.'%(event))
-                continue
-
-            if eventtype == 'ENTER':
-                # Changed
-                url = event[4].decode('utf-8')
-                self._ENTER(sid, name, url)
-            elif eventtype == 'JOIN':
-                channel = event[3].decode('utf-8')
-                self._JOIN(sid, name, channel)
-            elif eventtype == 'SHOUT':
-                channel = event[3].decode('utf-8')
-                message = event[4].decode('utf-8')
-                if channel == self._globalchannel and message == "QUIT":
-                    # Set ourself to stop running, close down pyre, exit
-                    # worker thread.
-                    self._run = False
-                    self._pyre.stop()
-                    break
-                else:
-                    self._SHOUT(sid, name, channel, message)
-            elif eventtype == 'WHISPER':
-                message = event[3].decode('utf-8')
-                self._WHISPER(sid, name, message)
-            elif eventtype == 'LEAVE':
-                channel = event[3].decode('utf-8')
-                self._LEAVE(sid, name, channel)
-            elif eventtype == 'EXIT':
-                self._EXIT(sid, name)
+    def _collect_shared(self, shm, collect):
+        '''Unlink blocks of SharedMemoryWriter shm whose lease ran out, if it's time (collect) to check. Returns when to check next. Called by the read thread, so blocks a crashed receiver never acknowledged don't wait for the next send().'''
+        now = time.time()
+        if collect is None or now >= collect:
+            shm.collect()
+            collect = now + max(shm.lease / 2.0, 0.01)
+        return collect
+    # _collect_shared()
+
+    def _handle_backlog(self, backlog):
+        '''Handle the message events the reader held back, in order.'''
+        while backlog and self._run:
+            (handler, event, peer) = backlog.popleft()
+            handler(event, peer)
+    # _handle_backlog()
+
+    def _wake(self):
+        '''Make the read thread check self._run, self._shm and messages kept for new subscribers.'''
+        with self._ctrl_lock:
+            if self._ctrl_send is not None:
+                self._ctrl_send.send(b'')
+    # _wake()
+
+    def _shutdown(self):
+        '''Stop Pyre and the dispatchers. Only the first call does anything, since a QUIT can arrive while quit_federation() is running.'''
+        with self._ctrl_lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        # Tell Pyre to shut down
+        self._pyre.stop()
+        self._close_dispatchers()
+        shm = self._shm
+        if shm is not None:
+            shm.close()
+    # _shutdown()
+
+    def _channel(self, raw):
+        # Group names repeat, so decode each one once.
+        channel = self._channels.get(raw)
+        if channel is None:
+            channel = self._channels[raw] = raw.decode('utf-8')
+        return channel
+    # _channel()
+
+    # The following methods unpack one kind of pyre event. peer is
+    # the sender's (uuid.UUID, name), or None for ENTER.
+
+    def _event_ENTER(self, event, peer):
+        sid = uuid.UUID(bytes=event[1])
+        name = event[2].decode('utf-8')
+        self._ENTER(sid, name, event[4].decode('utf-8'))
+        self._peers[event[1]] = (sid, name)
+        try:
+            host = json.loads(event[3].decode('utf-8')).get(transport_shm.HOST_HEADER)
+        except (ValueError, AttributeError):
+            host = None
+        if host is not None:
+            self._peer_hosts[sid] = host
+    # _event_ENTER()
+
+    def _event_JOIN(self, event, peer):
+        self._JOIN(peer[0], peer[1], self._channel(event[3]))
+    # _event_JOIN()
+
+    def _event_SHOUT(self, event, peer):
+        # The message is one or more frames. See transport_codec.py.
+        message = event[4:]
+        if event[3] == self._globalchannel_bytes and message == [b'QUIT']:
+            # Set ourself to stop running, close down pyre, exit
+            # worker thread.
+            self._run = False
+            self._shutdown()
+        else:
+            try:
+                self._SHOUT(peer[0], peer[1], self._channel(event[3]), message)
+            except TransportProtocolError as e:
+                self._drop_message(e)
+    # _event_SHOUT()
+
+    def _event_WHISPER(self, event, peer):
+        try:
+            self._WHISPER(peer[0], peer[1], event[3:])
+        except TransportProtocolError as e:
+            self._drop_message(e)
+    # _event_WHISPER()
+
+    def _drop_message(self, e):
+        '''Log and count a message the read thread couldn't decode (e, a TransportProtocolError), so one bad message doesn't stop the thread.'''
+        self._undecodable += 1
+        logger.warning('Dropping message: %s'%(e))
+    # _drop_message()
+
+    def _event_LEAVE(self, event, peer):
+        self._LEAVE(peer[0], peer[1], self._channel(event[3]))
+    # _event_LEAVE()
+
+    def _event_EXIT(self, event, peer):
+        self._EXIT(peer[0], peer[1])
+        del self._peers[event[1]]
+    # _event_EXIT()
+
+    # Notes on routing
+    #
+    # Every Transport joins a group named after itself, so shouting to
+    # the group dest always reaches the Transport named dest. But when
+    # exactly one peer has joined that group (the usual case), it's
+    # cheaper to whisper to that peer directly. _group_peers tracks
+    # group membership from JOIN, LEAVE and EXIT events. If the
+    # destination hasn't joined yet, or several peers share its name,
+    # messages are shouted as before. Both go over the same connection
+    # to the peer, so switching between them doesn't reorder messages.
+
+    def _send_frames(self, dest, frames):
+        '''Send frames to the Transport named dest (with prefix), whispering if it's a single known peer.'''
+        peers = self._group_peers.get(dest)
+        if not peers and self._hold_max is not None:
+            # Check again with the lock held, so _JOIN can't flush
+            # between our check and holding the message.
+            with self._peers_cond:
+                peers = self._group_peers.get(dest)
+                if not peers:
+                    self._hold(dest, frames)
+                    return
+        if peers is not None and len(peers) == 1:
+            self._whisper(peers[0], dest, frames)
+        else:
+            self._shout(dest, frames)
+    # _send_frames()
+
+    def _hold(self, dest, frames):
+        # Must be called with self._peers_cond held.
+        held = self._held.get(dest)
+        if held is None:
+            held = self._held[dest] = collections.deque()
+        if len(held) >= self._hold_max:
+            held.popleft()
+            self._held_dropped += 1
+            logger.warning('Send buffer for %s is full, dropping the oldest message'%(dest))
+        held.append(frames)
+    # _hold()
+
+    def _local_peers(self, dest):
+        '''Return the peers in group dest (with prefix) if there are any and all are on this host, else None.'''
+        peers = self._group_peers.get(dest)
+        if not peers:
+            return None
+        for peer in peers:
+            if self._peer_hosts.get(peer) != self._host:
+                return None
+        return peers
+    # _local_peers()
+
+    def _whisper(self, peer, dest, frames):
+        with self._sendlock:
+            self._pyre.whisper(peer, frames)
+        self._stats.record_sent(dest, sum([transport_codec.frame_size(frame) for frame in frames]))
+    # _whisper()
+
+    def _shout(self, group, frames):
+        with self._sendlock:
+            self._pyre.shout(group, frames)
+        self._stats.record_sent(group, sum([transport_codec.frame_size(frame) for frame in frames]))
+    # _shout()
+
+    def _send_back(self, sid, name, frames):
+        '''Send frames back to the peer sid, named name, that sent us a message: a reply, expiry report or shared memory ack.'''
+        # Whisper if sid is all there is in its group. Otherwise shout
+        # to its name, as AsyncTransport does, so a bridge client in
+        # the group hears it and passes it on. Across a bridge, sid is
+        # the local proxy, not the sender.
+        if self._group_peers.get(name) == (sid,):
+            self._whisper(sid, name, frames)
+        else:
+            self._shout(name, frames)
+    # _send_back()
+
+    def _priority_flags(self, priority):
+        '''Return the header flags for a send() priority.'''
+        if priority == 'normal':
+            return 0
+        if priority == 'high':
+            return transport_codec.FLAG_URGENT
+        raise TransportError(self, 'Unknown priority "%s". Use "normal" or "high".'%(priority))
+    # _priority_flags()
+
+    def _encode(self, ntuple):
+        '''Return (codec id, encoded payload) for ntuple. A LazyNtuple that hasn't been decoded keeps its original encoding.'''
+        if isinstance(ntuple, transport_codec.LazyNtuple):
+            if not ntuple.decoded() and ntuple.codec_id != transport_codec.CODEC_REFERENCE:
+                return (ntuple.codec_id, ntuple.raw)
+            # It may have been changed since it was decoded.
+            ntuple = ntuple.value
+        return (self._codec.codec_id, self._codec.encode(ntuple))
+    # _encode()
+
+    def _send_payloads(self, dest, payloads):
+        '''Send already encoded payloads to dest as one message. Called by the Coalescer.'''
+        self._send_frames(dest, transport_codec.pack_payloads(self._codec.codec_id, payloads, compressor=self._compressor))
+    # _send_payloads()
+
+    def _make_subscription(self, callback, policy, maxsize, overflow, label, ordered=True, lazy=False, where=None, order=0, remote=None, envelope=False):
+        if policy == transport_dispatch.POOL and self._pool is None:
+            self._pool = transport_dispatch.DispatchPool(self._pool_size, name='Transport-pool')
+        try:
+            dispatcher = transport_dispatch.make_dispatcher(policy, maxsize, overflow, pool=self._pool, name='Transport-%s'%(label), ordered=ordered)
+        except ValueError as e:
+            raise TransportError(self, str(e))
+        self._subseq += 1
+        return _Subscription(callback, dispatcher, lazy, where, order, self._subseq, remote, label, _callback_kind(callback, envelope))
+    # _make_subscription()
+
+    def _add_subscription(self, callback, policy, maxsize, overflow, lazy, where, order, remote, label, envelope=False):
+        '''Make a _Subscription and add it to the ones for remote (None for all). Returns it.'''
+        with self._sublock:
+            sub = self._make_subscription(callback, policy, maxsize, overflow, label, lazy=lazy, where=where, order=order, remote=remote, envelope=envelope)
+            if remote is None:
+                self._subscribe_all = tuple(sorted(self._subscribe_all + (sub,), key=_subscription_key))
             else:
-                raise TransportProtocolError(self, 'Illegal event type in event %s'%(event))
-    # _readworker()
+                self._subscribers[remote] = tuple(sorted(self._subscribers.get(remote, ()) + (sub,), key=_subscription_key))
+        with self._early_lock:
+            self._listened.add(remote)
+            waiting = bool(self._early)
+        if waiting:
+            # The read thread hands over what was kept.
+            self._wake()
+        return sub
+    # _add_subscription()
+
+    def _hold_early(self, sid, name, channel, message):
+        '''Keep a message from name, which nothing has subscribed to yet. Returns False if something has since.'''
+        now = time.time()
+        with self._early_lock:
+            if name in self._listened or None in self._listened:
+                return False
+            early = self._early.get(name)
+            if early is None:
+                early = self._early[name] = collections.deque()
+            while early and (len(early) >= EARLY_MAX or now - early[0][0] > EARLY_AGE):
+                early.popleft()
+                self._early_dropped += 1
+            early.append((now, sid, name, channel, message, self._uuid2ip[sid]))
+            return True
+    # _hold_early()
+
+    def _release_early(self, remote=None):
+        '''Hand the messages kept for remote (any remote if None) to its subscribers, if it has some now. Called by the read thread.'''
+        ready = []
+        with self._early_lock:
+            for name in ([remote] if remote is not None else list(self._early)):
+                if name in self._early and self._subscriptions(name):
+                    ready.append(self._early.pop(name))
+        now = time.time()
+        for early in ready:
+            logger.debug('Delivering %d messages kept for the first subscription'%(len(early)))
+            for (received, sid, name, channel, message, ip) in early:
+                if now - received > EARLY_AGE:
+                    with self._early_lock:
+                        self._early_dropped += 1
+                    continue
+                try:
+                    self._SHOUT(sid, name, channel, message, ip)
+                except TransportProtocolError as e:
+                    self._drop_message(e)
+    # _release_early()
+
+    def _remove_subscription(self, sub):
+        with self._sublock:
+            if sub.remote is None:
+                self._subscribe_all = tuple([s for s in self._subscribe_all if s is not sub])
+            else:
+                subs = tuple([s for s in self._subscribers.get(sub.remote, ()) if s is not sub])
+                if subs:
+                    self._subscribers[sub.remote] = subs
+                else:
+                    self._subscribers.pop(sub.remote, None)
+        sub.dispatcher.close()
+    # _remove_subscription()
+
+    def _subscriptions(self, name):
+        '''Return the _Subscriptions for a message from name, in the order they're called.'''
+        subs = self._subscribers.get(name, ())
+        alls = self._subscribe_all
+        if not alls:
+            return subs
+        if not subs:
+            return alls
+        return tuple(sorted(subs + alls, key=_subscription_key))
+    # _subscriptions()
+
+    def _close_dispatchers(self):
+        '''Let thread and pool callbacks finish what's queued, then stop their threads. Also stops the stats exporter and recording.'''
+        for subs in list(self._subscribers.values()) + [self._subscribe_all]:
+            for sub in subs:
+                sub.dispatcher.close()
+        if self._server is not None:
+            self._server.dispatcher.close()
+        self.stop_stats_export()
+        self.stop_recording()
+        if self._pool is not None:
+            self._pool.close()
+    # _close_dispatchers()
 
     # The following methods are named for the pyre event that this
     # instance has received. They are called automatically from the
     # worker thread that's listening for events.
 
     def _ENTER(self, sid, name, url):
-        # We expect all connections to be tcp on some port. This regular
-        # expression is used to extract the ip part.
-        urlmatch = re.match('tcp://([0-9.]+):[0-9]+$', url)
-        if urlmatch:
-            ip = urlmatch.group(1)
-            if is_valid_ip(ip):
-                # Everything looks good. Add to list of valid uuids.
-                self._uuid2ip[sid] = ip
-            else:
-                raise TransportSecurityError(self, 'Message from invalid IP address %s in ENTER %s %s %s. Check the function is_valid_ip() in Transport.py.'%(ip, sid, name, url))
-        else:
-            raise TransportProtocolError(self, 'Malformed URL in ENTER %s %s %s'%(sid, name, url))
+        # Everything looks good. Add to list of valid uuids.
+        self._uuid2ip[sid] = enter_ip(self, sid, name, url)
     # _ENTER()
 
     def _JOIN(self, sid, name, channel):
-        pass
+        with self._peers_cond:
+            peers = self._group_peers.get(channel, ())
+            if sid not in peers:
+                # Replaced rather than modified, since senders read it
+                # without a lock.
+                self._group_peers[channel] = peers + (sid,)
+            self._peers_cond.notify_all()
+            # Send whatever was held for this destination. Still
+            # holding the lock, so new sends can't overtake these.
+            held = self._held.pop(channel, None)
+            if held:
+                logger.debug('Sending %d held messages to %s'%(len(held), channel))
+                for frames in held:
+                    self._send_frames(channel, frames)
     # _JOIN()
 
-    def _SHOUT(self, sid, name, channel, message):
+    def _SHOUT(self, sid, name, channel, message, ip=None):
+        # ip is given for a message kept until its sender was
+        # subscribed to (see _release_early()), since the sender may
+        # have gone since.
         now = datetime.datetime.now()
-        logger.debug('In _SHOUT with %s %s %s %s'%(sid, name, channel, message)) #???
-        if name in self._subscribers:
-            logger.debug('got a subscription')
-            cb = self._subscribers[name]
-            self._call_callback(cb, sid, name, channel, message, now)
-        if self._subscribe_all is not None:
-            cb = self._subscribe_all
-            self._call_callback(cb, sid, name, channel, message, now)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('In _SHOUT with %s %s %s %s'%(sid, name, channel, message)) #???
+        nbytes = sum([transport_codec.frame_size(frame) for frame in message])
+        try:
+            header = transport_codec.unpack_header(message)
+        except transport_codec.CodecError as e:
+            raise TransportProtocolError(self, 'Bad header from %s %s: %s'%(sid, name, e))
+        if header.flags & transport_codec.FLAG_REPLY:
+            if header.codec_id == transport_codec.CODEC_SHM:
+                # A receiver mapped one of our shared memory blocks.
+                shm = self._shm
+                if shm is not None:
+                    shm.release(header.correlation_id)
+            else:
+                self._REPLY(sid, name, header, message)
+            return
+        if header.flags & transport_codec.FLAG_EXPIRED:
+            self._EXPIRED(sid, name, header, message)
+            return
+        if header.deadline is not None and time.time() > header.deadline:
+            # Too late. Don't even decode it.
+            self._stats.record_received(name, nbytes)
+            self._expire(sid, name, header.deadline)
+            return
+        if header.flags & transport_codec.FLAG_REQUEST:
+            self._REQUEST(sid, name, header, message, now)
+            return
+        urgent = header.flags & transport_codec.FLAG_URGENT != 0
+        recorder = self._recorder
+        subs = self._subscriptions(name)
+        if ip is not None:
+            # Kept until now, see _release_early().
+            pass
+        elif subs:
+            if name in self._early:
+                # Messages kept from before name was subscribed to go
+                # first.
+                self._release_early(name)
+        elif recorder is None:
+            # Nothing is subscribed to name. Keep the message if
+            # nothing ever was, see notes on startup.
+            if header.codec_id == transport_codec.CODEC_SHM:
+                # Map the blocks now, rather than let their lease run
+                # out while the message waits.
+                message = self._map_message(sid, name, header, message)
+                if message is None:
+                    return
+                header = transport_codec.unpack_header(message)
+            if self._hold_early(sid, name, channel, message):
+                return
+            # Subscribed to since we looked.
+            subs = self._subscriptions(name)
+        if not subs and recorder is None:
+            # Nobody is listening, so don't bother decoding. Blocks in
+            # shared memory are still mapped, so the sender can unlink
+            # them.
+            self._stats.record_received(name, nbytes, urgent=urgent)
+            if header.codec_id == transport_codec.CODEC_SHM:
+                self._map_message(sid, name, header, message)
+            return
+        # Decode now unless only lazy or filtered subscribers are
+        # listening.
+        eager = recorder is not None or any([not sub.lazy and sub.where is None for sub in subs])
+        start = time.time()
+        codec_id = header.codec_id
+        try:
+            payloads = transport_codec.payload_frames(header, message, self._compressor)
+            if codec_id == transport_codec.CODEC_SHM:
+                (codec_id, payloads) = self._map_shared(sid, name, payloads)
+                if payloads is None:
+                    return
+            if eager:
+                codec = transport_codec.get_codec(codec_id)
+                ntuples = [codec.decode(payload) for payload in payloads]
+            else:
+                ntuples = [None] * len(payloads)
+        except (transport_codec.CodecError, ValueError) as e:
+            raise TransportProtocolError(self, 'Undecodable message from %s %s: %s'%(sid, name, e))
+        self._stats.record_received(name, nbytes, time.time() - start, urgent)
+        lazies = None
+        if not eager or any([sub.lazy or sub.where is not None for sub in subs]):
+            lazies = [transport_codec.LazyNtuple(codec_id, payload, ntuple, eager) for (payload, ntuple) in zip(payloads, ntuples)]
+        if recorder is not None:
+            # channel is None for a WHISPER, which was sent to us.
+            if channel is None:
+                channel = self._myname
+            else:
+                channel = self._unprefixed(channel)
+            for ntuple in ntuples:
+                recorder.record(transport_record.RECEIVED, self._unprefixed(name), channel, ntuple)
+        # Look up the IP now, since the sender may EXIT before a
+        # queued callback runs.
+        if ip is None:
+            ip = self._uuid2ip[sid]
+        self._dispatch(sid, name, ip, ntuples, now, lazies, subs, urgent, header.deadline)
     # _SHOUT()
 
-    def _call_callback(self, cb, sid, name, channel, message, now):
-        if inspect.getargspec(cb).keywords is None:
-            cb(json.loads(message))
+    def _map_shared(self, sid, name, handles):
+        '''Map the shared memory blocks named by handles and tell the sender. Returns (codec id, payloads), or (None, None) if a block is gone.'''
+        try:
+            (codec_id, payloads, blocks) = transport_shm.open_handles(handles)
+        except transport_shm.SharedMemoryError as e:
+            self._shm_missing += 1
+            logger.warning('Dropping message from %s: %s'%(name, e))
+            return (None, None)
+        self._shm_mapped += len(blocks)
+        # Mapped blocks stay valid once unlinked, so the sender can
+        # unlink them now.
+        for block in blocks:
+            self._send_back(sid, name, [transport_codec.pack_header(transport_codec.CODEC_SHM, transport_codec.FLAG_REPLY, block), b''])
+        return (codec_id, payloads)
+    # _map_shared()
+
+    def _map_message(self, sid, name, header, message):
+        '''Map the shared memory blocks of a CODEC_SHM message and tell the sender. Returns the message with the payloads themselves in place of the handles, or None if a block is gone.'''
+        try:
+            handles = transport_codec.payload_frames(header, message, self._compressor)
+        except (transport_codec.CodecError, ValueError) as e:
+            raise TransportProtocolError(self, 'Undecodable message from %s %s: %s'%(sid, name, e))
+        (codec_id, payloads) = self._map_shared(sid, name, handles)
+        if payloads is None:
+            return None
+        return transport_codec.pack_payloads(codec_id, payloads, header.flags & transport_codec.FLAG_URGENT, deadline=header.deadline)
+    # _map_message()
+
+    def _dispatch(self, sid, name, ip, ntuples, now, lazies=None, subs=None, urgent=False, deadline=None):
+        '''Hand ntuples from name to the subscribed callbacks (subs, or the current ones for name). lazies, if given, are the matching LazyNtuples for lazy and filtered subscriptions. urgent ntuples go ahead of normal ones in dispatch queues, and ones with a deadline are dropped if it passes while they're queued.'''
+        if subs is None:
+            subs = self._subscriptions(name)
+        # A batch is delivered one ntuple at a time, in order.
+        for (i, ntuple) in enumerate(ntuples):
+            # Taken by the first queued callback to find the deadline
+            # passed, so the ntuple is counted and reported once
+            # however many subscribers drop it.
+            report = [True] if deadline is not None else None
+            for sub in subs:
+                if sub.lazy or sub.where is not None:
+                    if lazies is None:
+                        lazies = [transport_codec.LazyNtuple(transport_codec.CODEC_REFERENCE, n, n, True) for n in ntuples]
+                    if sub.where is not None and not _matches(sub.where, lazies[i]):
+                        continue
+                    arg = lazies[i] if sub.lazy else lazies[i].value
+                elif lazies is not None:
+                    # Decoded at most once, and shared by every
+                    # subscriber.
+                    arg = lazies[i].value
+                else:
+                    arg = ntuple
+                submit = sub.dispatcher.submit_urgent if urgent else sub.dispatcher.submit
+                if deadline is not None and sub.dispatcher.queue is not None:
+                    submit(self._call_before_deadline, deadline, report, sub, sid, name, ip, arg, now)
+                else:
+                    submit(self._call_callback, sub, sid, name, ip, arg, now)
+    # _dispatch()
+
+    def _unprefixed(self, name):
+        if self._prefix is not None and name.startswith(self._prefix):
+            return name[len(self._prefix):]
+        return name
+    # _unprefixed()
+
+    def _decode(self, sid, name, header, message):
+        try:
+            return transport_codec.decode_payload(header, message, self._compressor)
+        except (transport_codec.CodecError, ValueError) as e:
+            raise TransportProtocolError(self, 'Undecodable message from %s %s: %s'%(sid, name, e))
+    # _decode()
+
+    def _REQUEST(self, sid, name, header, message, now):
+        sub = self._server
+        if sub is None:
+            self._reply(sid, name, header.correlation_id, 'No request handler in %s'%(self._pyre.name()), error=True)
+            return
+        ntuple = self._decode(sid, name, header, message)
+        sub.dispatcher.submit(self._serve_request, sub, sid, name, self._uuid2ip[sid], header.correlation_id, ntuple, now)
+    # _REQUEST()
+
+    def _serve_request(self, sub, sid, name, ip, cid, ntuple, now):
+        try:
+            reply = self._call_callback(sub, sid, name, ip, ntuple, now)
+        except Exception as e:
+            logger.exception('Request handler failed for request from %s'%(name))
+            self._reply(sid, name, cid, '%s: %s'%(type(e).__name__, e), error=True)
+        else:
+            self._reply(sid, name, cid, reply)
+    # _serve_request()
+
+    def _reply(self, sid, dest, cid, reply, error=False):
+        # Straight back to the requester (see _send_back()). Other
+        # Transports with the same name drop the reply.
+        flags = transport_codec.FLAG_REPLY
+        if error:
+            flags |= transport_codec.FLAG_ERROR
+        if self._run:
+            self._send_back(sid, dest, transport_codec.encode_message(self._codec, reply, flags, cid, self._compressor))
+    # _reply()
+
+    def _REPLY(self, sid, name, header, message):
+        with self._pending_lock:
+            pending = self._pending.get(header.correlation_id)
+        if pending is None:
+            # Timed out, or meant for another Transport with our name.
+            logger.debug('Dropping reply %s from %s with no pending request'%(header.correlation_id, name))
+            return
+        result = self._decode(sid, name, header, message)
+        if header.flags & transport_codec.FLAG_ERROR:
+            pending.error = result
         else:
-            cb(message, uuid=sid, name=name, ip=self._uuid2ip[sid], datetime=now)
+            pending.reply = result
+        pending.event.set()
+    # _REPLY()
+
+    def _EXPIRED(self, sid, name, header, message):
+        # name dropped messages we sent it, since they were late.
+        report = self._decode(sid, name, header, message)
+        late = report.get('late') if isinstance(report, dict) else None
+        self._stats.record_expiry_report(name)
+        callback = self._expiry_callback
+        if callback is not None:
+            try:
+                callback(self._unprefixed(name), late)
+            except Exception:
+                logger.exception('Exception in Transport expiry callback %s'%(callback))
+    # _EXPIRED()
+
+    def _expire(self, sid, name, deadline):
+        '''Count a message from name that missed its deadline, and tell the sender.'''
+        late = time.time() - deadline
+        logger.debug('Dropping message from %s that is %.3f seconds late'%(name, late))
+        self._stats.record_expired(name)
+        if self._run and sid is not None:
+            self._send_back(sid, name, transport_codec.encode_message(self._codec, {'late': late}, transport_codec.FLAG_EXPIRED))
+    # _expire()
+
+    def _call_before_deadline(self, deadline, report, sub, sid, name, ip, ntuple, now):
+        if time.time() > deadline:
+            try:
+                # Atomic, so only one subscriber's thread gets it.
+                report.pop()
+            except IndexError:
+                return None
+            self._expire(sid, name, deadline)
+            return None
+        return self._call_callback(sub, sid, name, ip, ntuple, now)
+    # _call_before_deadline()
+
+    def _call_callback(self, sub, sid, name, ip, ntuple, now):
+        '''Call the callback of _Subscription sub the way it was subscribed (see _callback_kind()).'''
+        start = time.time()
+        kind = sub.kind
+        try:
+            if kind == _PLAIN:
+                return sub.callback(ntuple)
+            elif kind == _KEYWORDS:
+                return sub.callback(ntuple, uuid=sid, name=name, ip=ip, datetime=now)
+            else:
+                return sub.callback(TransportEnvelope(ntuple, sid, name, ip, now))
+        finally:
+            self._stats.record_callback(name, time.time() - start)
     # _call_callback
 
 
     def _WHISPER(self, sid, name, message):
-        raise TransportProtocolError(self, 'Unexpected WHISPER from %s %s'%(sid, name))
+        # Sent directly to us (see _send_frames()), otherwise handled
+        # exactly like a SHOUT.
+        self._SHOUT(sid, name, None, message)
     # _WHISPER()
 
     def _LEAVE(self, sid, name, channel):
-        pass
+        with self._peers_cond:
+            peers = self._group_peers.get(channel)
+            if peers is not None and sid in peers:
+                peers = tuple([p for p in peers if p != sid])
+                if peers:
+                    self._group_peers[channel] = peers
+                else:
+                    del self._group_peers[channel]
+                self._peers_cond.notify_all()
     # _LEAVE()
 
     def _EXIT(self, sid, name):
         # Remove sid from list of valid uuids. This should
         # never be an error since we check in _readworker().
         del self._uuid2ip[sid]
+        self._peer_hosts.pop(sid, None)
+        # Pyre doesn't always send LEAVE before EXIT.
+        for channel in [c for (c, peers) in self._group_peers.items() if sid in peers]:
+            self._LEAVE(sid, name, channel)
     # _EXIT()
 # class Transport
 
@@ -6,6 +6,17 @@
 //
 // See README.rst and TransportBridge.h for documentation and
 // testtb.cpp for an example.
+//
+// NOTES:
+//
+// Speaks the binary framing in bridge_protocol.py: an 8 byte header
+// (magic 0xff 'B', version, flags, 4 byte body length, network byte
+// order) then the body. Everything sent is a plain json frame.
+// recv_json() also takes apart FLAG_RAW SHOUTs and FLAG_BATCH runs,
+// but only a raw SHOUT of a plain JSON message (a single Pyre frame)
+// can be turned into json here; raw SHOUTs in any other codec are
+// skipped. Compressed batches (bridge_server.py -compress) are not
+// supported; run the server without -compress for C++ clients.
 
 #include "stdafx.h"
 #include "TransportBridge.h"
@@ -13,16 +24,37 @@
 #include <winsock2.h>
 #include <ws2tcpip.h>
 #include <stdio.h>
+#include <string>
 
 #include "rapidjson/document.h"
 #include "rapidjson/stringbuffer.h"
 #include "rapidjson/writer.h"
 
+// See bridge_protocol.py.
+#define BRIDGE_MAGIC0 (0xff)
+#define BRIDGE_MAGIC1 ('B')
+#define BRIDGE_FRAME_VERSION (1)
+#define BRIDGE_HEADER_SIZE (8)
+#define BRIDGE_FLAG_RAW (0x01)
+#define BRIDGE_FLAG_BATCH (0x02)
+#define BRIDGE_FLAG_COMPRESSED (0x04)
+#define BRIDGE_KNOWN_FLAGS (BRIDGE_FLAG_RAW | BRIDGE_FLAG_BATCH | BRIDGE_FLAG_COMPRESSED)
+#define BRIDGE_MAX_FRAME (64 << 20)
+
+static unsigned long get_u32(const unsigned char* p) {
+	return ((unsigned long)p[0] << 24) | ((unsigned long)p[1] << 16) | ((unsigned long)p[2] << 8) | (unsigned long)p[3];
+} // get_u32()
+
+static unsigned int get_u16(const unsigned char* p) {
+	return ((unsigned int)p[0] << 8) | (unsigned int)p[1];
+} // get_u16()
+
 TransportBridge::TransportBridge(const char* amyname, const char* abridge_host, int abridge_port)
 {
 	bridge_host = _strdup(abridge_host);
 	bridge_port = abridge_port;
 	myname = _strdup(amyname);
+	pending_pos = 0;
 
 	struct addrinfo *result = NULL,
 		*ptr = NULL,
@@ -107,6 +139,10 @@ int TransportBridge::data_available(long timeout) {
 	int nset;
 	TIMEVAL tv;
 
+	// Frames left over from a batch are already here.
+	if (pending_pos < pending.size()) {
+		return 1;
+	}
 	FD_ZERO(&readset);
 	FD_SET(bridge_socket, &readset);
 	if (timeout >= 0) {
@@ -130,89 +166,179 @@ int TransportBridge::data_available(long timeout) {
 } // TransportBridge::data_available()
 
 
+// Send len bytes from buf, however many send() calls it takes.
+void TransportBridge::send_all(const char* buf, size_t len) {
+	int iResult;
+	size_t nsent = 0;
+	while (nsent < len) {
+		iResult = send(bridge_socket, buf + nsent, (int)(len - nsent), 0);
+		if (iResult == SOCKET_ERROR) {
+			int err = WSAGetLastError();
+			closesocket(bridge_socket);
+			bridge_error("send failed with error: %d\n", err);
+		}
+		nsent += iResult;
+	}
+} // TransportBridge::send_all()
+
 // Send a string to the bridge. You must handle the pyre stuff yourself, but send_string()
-// handles encoding for the bridge (i.e. the length of the string).
+// handles encoding for the bridge (i.e. the frame header, see NOTES above).
 
-#define BRIDGE_SEND_BUFSIZE (1024)
 void TransportBridge::send_string(const char* sendbuf) {
+	size_t len = strlen(sendbuf);
+	if (len > BRIDGE_MAX_FRAME) {
+		bridge_error("message too long (max %d, got %lu)\n", BRIDGE_MAX_FRAME, (unsigned long)len);
+	}
+	char header[BRIDGE_HEADER_SIZE];
+	header[0] = (char)BRIDGE_MAGIC0;
+	header[1] = BRIDGE_MAGIC1;
+	header[2] = BRIDGE_FRAME_VERSION;
+	header[3] = 0; // No flags: a plain json frame.
+	header[4] = (char)((len >> 24) & 0xff);
+	header[5] = (char)((len >> 16) & 0xff);
+	header[6] = (char)((len >> 8) & 0xff);
+	header[7] = (char)(len & 0xff);
+	send_all(header, BRIDGE_HEADER_SIZE);
+	send_all(sendbuf, len);
+} // TransportBridge::send_string()
+
+// Read exactly len bytes into buf. This is needed because socket
+// communication is not guaranteed to be atomic (i.e. one write may
+// become many reads).
+void TransportBridge::recv_all(char* buf, size_t len) {
 	int iResult;
-	// First send the length.
-	char buf[BRIDGE_SEND_BUFSIZE];
-	_snprintf_s(buf, BRIDGE_SEND_BUFSIZE, _TRUNCATE, "%d\n", strlen(sendbuf)); // Probably need to check errors here...
-	iResult = send(bridge_socket, buf, (int)strlen(buf), 0);
-	if (iResult == SOCKET_ERROR) {
-		int err = WSAGetLastError();
-		closesocket(bridge_socket);
-		bridge_error("send length failed with error: %d\n", err);
+	size_t nread = 0;
+	while (nread < len) {
+		iResult = recv(bridge_socket, buf + nread, (int)(len - nread), 0);
+		if (iResult == 0) {
+			bridge_error("Remote bridge closed.\n");
+		}
+		else if (iResult < 0) {
+			bridge_error("recv failed with error: %d\n", WSAGetLastError());
+		}
+		nread += iResult;
 	}
+} // TransportBridge::recv_all()
 
-	iResult = send(bridge_socket, sendbuf, (int)strlen(sendbuf), 0);
-	if (iResult == SOCKET_ERROR) {
-		int err = WSAGetLastError();
-		closesocket(bridge_socket);
-		bridge_error("send failed with error: %d\n", err);
+// Check a frame header and return its flags. *len is set to the body length.
+int TransportBridge::check_header(const unsigned char* header, size_t* len) {
+	if (header[0] != BRIDGE_MAGIC0 || header[1] != BRIDGE_MAGIC1) {
+		bridge_error("recv got a bad frame header (is the bridge server too old?)\n");
 	}
-} // TransportBridge::send_string()
+	if (header[2] != BRIDGE_FRAME_VERSION) {
+		bridge_error("recv got frame version %d, expected %d\n", header[2], BRIDGE_FRAME_VERSION);
+	}
+	if (header[3] & ~BRIDGE_KNOWN_FLAGS) {
+		bridge_error("recv got unknown frame flags 0x%x\n", header[3]);
+	}
+	*len = get_u32(header + 4);
+	if (*len > BRIDGE_MAX_FRAME) {
+		bridge_error("length too long (max %d, got %lu)\n", BRIDGE_MAX_FRAME, (unsigned long)*len);
+	}
+	return header[3];
+} // TransportBridge::check_header()
 
-// Receive data from the Bridge. It is encoded as an ascii length
-// followed by newline followed by that number of bytes in a JSON
-// string. This is complex because socket communication is not
-// guaranteed to be atomic (i.e. one write may become many reads).
+// Parse the body of one (non-batch) frame into document. Returns 0
+// if it's a raw SHOUT that can't be turned into json (see NOTES above).
+int TransportBridge::parse_body(int flags, const char* body, size_t len, rapidjson::Document* document) {
+	document->SetArray(); // This should clear any existing allocation. Not sure if needed.
+	if (!(flags & BRIDGE_FLAG_RAW)) {
+		std::string json(body, len); // null terminate.
+		document->Parse(json.c_str()); // Parse the json into the document.
+		return 1;
+	}
+	// A raw SHOUT: name and channel lengths, frame count, name, channel, frames.
+	const unsigned char* p = (const unsigned char*)body;
+	if (len < 6) {
+		bridge_error("recv got a raw frame that's too short\n");
+	}
+	size_t name_length = get_u16(p);
+	size_t channel_length = get_u16(p + 2);
+	unsigned int count = get_u16(p + 4);
+	size_t pos = 6;
+	if (len < pos + name_length + channel_length) {
+		bridge_error("recv got a raw frame that's too short\n");
+	}
+	std::string name(body + pos, name_length);
+	pos += name_length;
+	std::string channel(body + pos, channel_length);
+	pos += channel_length;
+	if (count != 1) {
+		// A Transport header and payloads, not plain JSON.
+		return 0;
+	}
+	if (len < pos + 4 || len - pos - 4 < get_u32(p + pos)) {
+		bridge_error("recv got a raw frame that's too short\n");
+	}
+	size_t frame_length = get_u32(p + pos);
+	pos += 4;
+	std::string json(body + pos, frame_length);
+	rapidjson::Document message;
+	message.Parse(json.c_str());
+	if (message.HasParseError()) {
+		return 0;
+	}
+	// Build ["SHOUT", name, channel, message], as a json frame would be.
+	rapidjson::Document::AllocatorType& allocator = document->GetAllocator();
+	rapidjson::Value type("SHOUT", allocator);
+	rapidjson::Value vname(name.c_str(), (rapidjson::SizeType)name.size(), allocator);
+	rapidjson::Value vchannel(channel.c_str(), (rapidjson::SizeType)channel.size(), allocator);
+	rapidjson::Value vmessage(message, allocator);
+	document->PushBack(type, allocator);
+	document->PushBack(vname, allocator);
+	document->PushBack(vchannel, allocator);
+	document->PushBack(vmessage, allocator);
+	return 1;
+} // TransportBridge::parse_body()
+
+// Receive a message from the Bridge. It comes as a frame (see NOTES
+// above), possibly one of several in a batch. Frames that can't be
+// turned into json are skipped.
 
-#define BRIDGE_RECV_BUFSIZE (10000)
 void TransportBridge::recv_json(rapidjson::Document* document) {
-	char recvbuf[BRIDGE_RECV_BUFSIZE];
-	int iResult;
-	int pos = 0;
-	int len;
+	unsigned char header[BRIDGE_HEADER_SIZE];
+	size_t len;
+	int flags;
 
-	// First info should be the number of bytes in the string followed by newline.
 	while (1) {
-		iResult = recv(bridge_socket, recvbuf + pos, 1, 0);
-		if (iResult == 0) {
-			// Connection closed.
-			bridge_error("Remote bridge closed trying to read length.\n");
-		}
-		else if (iResult != 1) {
-			// Some other error
-			bridge_error("recv failed reading length with error: %d\n", WSAGetLastError());
+		// Frames left over from a batch go first.
+		while (pending_pos < pending.size()) {
+			if (pending.size() - pending_pos < BRIDGE_HEADER_SIZE) {
+				bridge_error("recv got a truncated frame in a batch\n");
+			}
+			flags = check_header((const unsigned char*)pending.data() + pending_pos, &len);
+			if (flags & (BRIDGE_FLAG_BATCH | BRIDGE_FLAG_COMPRESSED)) {
+				bridge_error("recv got a batch inside a batch\n");
+			}
+			if (pending.size() - pending_pos - BRIDGE_HEADER_SIZE < len) {
+				bridge_error("recv got a truncated frame in a batch\n");
+			}
+			const char* body = pending.data() + pending_pos + BRIDGE_HEADER_SIZE;
+			pending_pos += BRIDGE_HEADER_SIZE + len;
+			if (parse_body(flags, body, len, document)) {
+				return;
+			}
 		}
-		// Read one byte. If it's newline, we should have now received a full length string.
-		if (recvbuf[pos] == '\n') {
-			break;
+		pending.clear();
+		pending_pos = 0;
+
+		recv_all((char*)header, BRIDGE_HEADER_SIZE);
+		flags = check_header(header, &len);
+		std::string body(len, '\0');
+		if (len > 0) {
+			recv_all(&body[0], len);
 		}
-		// Error if it isn't a digit.
-		if (!isdigit(recvbuf[pos])) {
-			bridge_error("recv got a non-digit in the length field.\n");
+		if (flags & BRIDGE_FLAG_COMPRESSED) {
+			bridge_error("recv got a compressed batch, which TransportBridge doesn't support (run the bridge server without -compress)\n");
 		}
-		if (pos >= BRIDGE_RECV_BUFSIZE-1) {
-			bridge_error("recv got a very long length field.\n");
-		}
-		pos++;
-	}
-	// If we get here, we should have a legal length in recvbuf.
-	len = -1;
-	if (sscanf_s(recvbuf, "%d", &len) != 1 || len < 1) {
-		bridge_error("Got illegal length string \"%s\"\n", recvbuf);
-	}
-	if (len >= BRIDGE_RECV_BUFSIZE-1) {
-		bridge_error("length too long (max %d, got %d)\n", BRIDGE_RECV_BUFSIZE, len);
-	}
-	// Now read until we get len bytes.
-	int nread = 0;
-	while (nread < len) {
-		iResult = recv(bridge_socket, recvbuf + nread, len - nread, 0);
-		if (iResult == 0) {
-			bridge_error("Remote bridge closed.\n");
+		if (flags & BRIDGE_FLAG_BATCH) {
+			pending.swap(body);
+			continue;
 		}
-		else if (iResult < 0) {
-			bridge_error("recv failed with error: %d\n", WSAGetLastError());
+		if (parse_body(flags, body.data(), len, document)) {
+			return;
 		}
-		nread += iResult;
 	}
-	recvbuf[nread] = 0; // null terminate.
-	document->SetArray(); // This should clear any existing allocation. Not sure if needed.
-	document->Parse(recvbuf); // Parse the json into the document.
 }  // TransportBridge::recv_json()
 
 void TransportBridge::send_json(rapidjson::Document* doc) {
@@ -26,6 +26,7 @@
 #pragma once
 
 #include <winsock2.h>
+#include <string>
 
 #include "rapidjson/document.h"
 
@@ -52,6 +53,8 @@ public:
 	// It's up to you to make sure the command is for you.
 	// The passed document is cleared before parsing the incoming json.
         // Note that recv_json() blocks until a full message is available.
+	// Raw SHOUTs that aren't plain JSON are skipped, and compressed batches
+	// are fatal (see TransportBridge.cpp).
 	void recv_json(rapidjson::Document*);
 
 	// Send a JSON document. You must include the pyre pieces yourself (e.g. ["SHOUT", "StarCraft", "ProblemSover", { "UnitAppeared": "Firebat", "Location": [ ... ] } ]
@@ -66,4 +69,14 @@ public:
 	int bridge_port;
 	char* bridge_host;
 	char* myname;
+
+private:
+	void send_all(const char*, size_t);
+	void recv_all(char*, size_t);
+	int check_header(const unsigned char*, size_t*);
+	int parse_body(int, const char*, size_t, rapidjson::Document*);
+
+	// The rest of a batch still to be returned by recv_json(), from pending_pos on.
+	std::string pending;
+	size_t pending_pos;
 };
@@ -75,7 +75,7 @@ class CoreProblemSolver(CoreAgent):
 
     def request_clarification(self, ntuple, message="This ntuple requires clarification."):
         request = {'ntuple': ntuple, 'message': message, 'type': 'clarification', 'tag': self.address}
-        self.transport.send(self.ui_address, request)
+        self.transport.send(self.ui_address, request, priority='high')
 
     def identification_failure(self, message):
         request = {'type': 'id_failure', 'message': message, 'tag': self.address}
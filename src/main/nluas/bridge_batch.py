@@ -0,0 +1,141 @@
+######################################################################
+#
+# File: bridge_batch.py
+#
+# Link level batching for the bridge (see bridge_client.py and
+# bridge_server.py).
+#
+# Bridged sites are usually far apart, and sending every message as
+# its own write costs a packet (and its round of acks) per message.
+# With batching on (-batch), each end of a link holds outgoing frames
+# for up to max_delay seconds, or until max_bytes bytes are held, and
+# sends them as one FLAG_BATCH frame (see bridge_protocol.py).
+# Batches of at least compress bytes are zlib compressed, if that
+# makes them smaller. The reader unpacks batches, so receivers don't
+# need to be configured; only the sending end decides.
+#
+# LinkBatcher has no timer or thread of its own. The caller sends
+# whatever add() returns, and calls flush() once time.time() reaches
+# due(): the bridge client from its poll loop, the server with
+# call_later().
+#
+# stats() reports frames per batch, the compression ratio, and the
+# latency batching added: how long, on average and at most, frames
+# were held before they were sent.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import time
+import zlib
+
+from nluas import bridge_protocol
+
+_cputime = getattr(time, 'thread_time', time.time)
+
+def new_counts():
+    '''Return an empty dict of LinkBatcher counters, which several LinkBatchers can share.'''
+    return dict.fromkeys(['batches', 'frames', 'bytes_in', 'bytes_out', 'compressed', 'compress_cpu', 'delay_total', 'delay_max'], 0)
+# new_counts()
+
+def summarize(counts):
+    '''Return the stats for counts (see LinkBatcher.stats()).'''
+    c = dict(counts)
+    c['frames_per_batch'] = float(c['frames']) / c['batches'] if c['batches'] else None
+    c['ratio'] = float(c['bytes_out']) / c['bytes_in'] if c['bytes_in'] else None
+    c['delay_mean_ms'] = 1e3 * c.pop('delay_total') / c['frames'] if c['frames'] else None
+    c['delay_max_ms'] = 1e3 * c.pop('delay_max')
+    return c
+# summarize()
+
+class LinkBatcher(object):
+    '''Collects the outgoing frames of one link into batches. See notes above. counts can be a dict from new_counts() to share counters with other LinkBatchers.'''
+
+    def __init__(self, max_delay=0.01, max_bytes=65536, compress=None, level=6, counts=None):
+        if max_delay < 0 or max_bytes < 1 or (compress is not None and compress < 1):
+            raise ValueError('Batching limits must be positive.')
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.level = level
+        self._counts = new_counts() if counts is None else counts
+        self._frames = []
+        self._size = 0
+        # Time the first held frame was added, and the sum of the times
+        # all of them were, for the delay stats.
+        self._first = None
+        self._added = 0.0
+    # __init__()
+
+    def add(self, frame):
+        '''Hold frame. Returns a frame to send right away if the batch is full (or max_delay is 0), else None.'''
+        now = time.time()
+        if not self._frames:
+            self._first = now
+        self._frames.append(frame)
+        self._size += len(frame)
+        self._added += now
+        if self._size >= self.max_bytes or self.max_delay == 0:
+            return self.flush(now)
+        return None
+    # add()
+
+    def due(self):
+        '''Return the time by which flush() must be called, or None if nothing is held.'''
+        if self._first is None:
+            return None
+        return self._first + self.max_delay
+    # due()
+
+    def flush(self, now=None):
+        '''Return the frames held as one frame to send, or None if nothing is held. A lone frame that isn't worth compressing goes as it is.'''
+        frames = self._frames
+        if not frames:
+            return None
+        if now is None:
+            now = time.time()
+        size = self._size
+        c = self._counts
+        c['batches'] += 1
+        c['frames'] += len(frames)
+        c['bytes_in'] += size
+        c['delay_total'] += len(frames) * now - self._added
+        c['delay_max'] = max(c['delay_max'], now - self._first)
+        self._frames = []
+        self._size = 0
+        self._first = None
+        self._added = 0.0
+
+        flags = bridge_protocol.FLAG_BATCH
+        body = None
+        if self.compress is not None and size >= self.compress:
+            start = _cputime()
+            plain = b''.join(frames)
+            compressed = zlib.compress(plain, self.level)
+            c['compress_cpu'] += _cputime() - start
+            if len(compressed) < size:
+                c['compressed'] += 1
+                flags |= bridge_protocol.FLAG_COMPRESSED
+                body = compressed
+        if body is None:
+            if len(frames) == 1:
+                c['bytes_out'] += size
+                return frames[0]
+            body = b''.join(frames)
+        frame = bridge_protocol.pack_frame(body, flags)
+        c['bytes_out'] += len(frame)
+        return frame
+    # flush()
+
+    def pending(self):
+        '''Return the number of frames held.'''
+        return len(self._frames)
+    # pending()
+
+    def stats(self):
+        '''Return a dict of counters: batches and frames sent, bytes before (bytes_in) and after batching and compression (bytes_out), ratio of the two, batches compressed and the CPU seconds it took, frames_per_batch, and the delay batching added in ms, delay_mean_ms per frame and delay_max_ms.'''
+        return summarize(self._counts)
+    # stats()
+# class LinkBatcher
@@ -42,18 +42,41 @@
 # destination. If so, it uses the proxy Transport to send the message
 # to the destination Transport.
 #
+# By default (-format raw) SHOUTs pass through the bridge as the
+# sender's Pyre frames, untouched: only the name and channel are
+# packed around them (see bridge_protocol.py), and the proxy relays
+# the frames as they are (Transport.relay()). Nothing is decoded or
+# encoded on the way, and messages in any codec, batches and headers
+# get through. With -format json, plain JSON messages go as the json
+# list ['SHOUT', name, channel, message] instead, which is easier to
+# watch on the wire but costs a decode and encode at each end.
+#
+# With -batch and/or -compress, what the client sends the server is
+# batched and compressed (see bridge_batch.py). The client reads
+# batches from the server whatever its own settings. Type "stats" for
+# batch sizes, compression ratio and the delay batching added.
+#
 # NOTES:
 #
 # LEAVE messages are not currently handled since I'm not sure how to
 # guarantee that NO remote Transports exist. I guess the server could
 # keep track, but I wanted to keep the server really simple.
 #
+# The server does keep track of which channels each client has
+# joined, and only sends a SHOUT to clients that joined its channel.
+# The check against localchannelcount below is now just a safeguard.
+#
+# The bridge client joins a remote Transport's channel before
+# creating its proxy, so local Transports see two peers in the group
+# and shout to it, which the bridge client hears. A message whispered
+# to the proxy before that (or a reply or expiry report, which go to
+# the sender) is passed on by the proxy itself, see BridgeProxy.
+#
 # The client/server communicate with a low level socket, which
 # introduces some complexity in the code. Specifically, the objects
 # have to be serialized (using json), and we have to handle framing
-# ourselves. Framing is done by sending an ascii count of the
-# serialized object's size in bytes followed by a newline (\n)
-# followed by the bytes in the serialized object.
+# ourselves. Framing is done with a binary header giving the
+# serialized object's size, see bridge_protocol.py.
 #
 
 from __future__ import print_function
@@ -69,14 +92,17 @@ import signal
 import socket
 import sys
 import threading
+import time
 import uuid
 
 from pyre import Pyre
 import zmq
 
 from nluas import Transport
+from nluas import bridge_batch
+from nluas import bridge_protocol
 
-VERSION = 0.1
+VERSION = 0.4
 
 class Global:
     '''Stores globals. There should be no instances of Global.'''
@@ -87,6 +113,13 @@ class Global:
     # A socket to the bridge server
     bridgesocket = None
 
+    # bridge_protocol.FrameReader for bridgesocket.
+    reader = None
+
+    # bridge_batch.LinkBatcher for what's sent on bridgesocket, or
+    # None if batching is off.
+    batcher = None
+
     # Lock objects for interacting with the bridgesocket.
     # Not currently needed, but if performance is an issue,
     # the code could be upgraded to multithread.
@@ -110,6 +143,24 @@ class Global:
 
 # end class Globals
 
+class BridgeProxy(Transport.Transport):
+    '''A Transport standing in for the Transport of the same name at the other end of the bridge.'''
+
+    def _WHISPER(self, sid, name, message):
+        # Local Transports whisper to a destination with a single peer
+        # in its group, which is the proxy until they see the bridge
+        # client join it. Replies and expiry reports are whispered too.
+        # Pass them on as SHOUTs to the remote Transport. Called from
+        # the proxy's reader thread.
+        server_send_frame(shout_frame(name, self._pyre.name(), message, Global.args.format))
+    # _WHISPER()
+
+    def _hold_early(self, sid, name, channel, message):
+        # Proxies never subscribe, so don't keep messages for them.
+        return False
+    # _hold_early()
+# end class BridgeProxy
+
 def main(argv):
 
     #if six.PY3:
@@ -125,6 +176,10 @@ def main(argv):
     # Create the bridge socket
     Global.bridgesocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     Global.bridgesocket.connect((Global.args.host, Global.args.port))
+    Global.reader = bridge_protocol.FrameReader()
+    if Global.args.batch > 0 or Global.args.compress > 0:
+        Global.batcher = bridge_batch.LinkBatcher(Global.args.batch / 1000.0, Global.args.batchbytes,
+                                                  Global.args.compress or None, Global.args.level)
 
     # Create a pyre instance
     Global.pyre = Pyre()
@@ -141,7 +196,19 @@ def main(argv):
     logging.warning('Starting bridge client to server at %s:%d'%(Global.args.host, Global.args.port))
 
     while True:
-        items = dict(poller.poll())
+        # Wake up in time to send a held batch.
+        timeout = None
+        due = Global.batcher.due() if Global.batcher is not None else None
+        if Global.batcher is not None and due is None:
+            # Proxies add to the batch from their own threads, so
+            # check back within a batch delay.
+            timeout = 1000 * Global.batcher.max_delay
+        elif due is not None:
+            if due <= time.time():
+                server_flush()
+            else:
+                timeout = 1000 * (due - time.time())
+        items = dict(poller.poll(timeout))
         logging.debug('Got items =%s'%(items))
 
         if 0 in items:  # stdin
@@ -151,37 +218,51 @@ def main(argv):
             message = input()
             if message == 'quit':
                 client_quit()
+            elif message == 'stats':
+                print({'sent': Global.batcher.stats() if Global.batcher is not None else None,
+                       'received': Global.reader.stats()})
             elif message == 'help':
-                print('You can quit the bridge_client (but not the federation) by typing "quit".')
+                print('You can quit the bridge_client (but not the federation) by typing "quit". Type "stats" for link statistics.')
             else:
                 print('Unrecognized command %s'%(message))
 
         if Global.bridgesocket.fileno() in items:
-            # Got a message from the remote.
-            rec = server_recv()
-            logging.debug('Got remote data %s'%(rec))
-            if rec[0] == 'JOIN':
-                channel = rec[1]
-                # If we don't already have a proxy object, create one.
-                if channel not in Global.proxies:
-                    t = Transport.Transport(channel)
-                    Global.pyre.join(channel)
-                    Global.proxies[channel] = t
-                    Global.proxy_uuids[t._pyre.uuid()] = t
-                    logging.info('Creating bridge proxy %s'%(channel))
-            elif rec[0] == 'LEAVE':
-                # Don't actually know how to handle this.
-                pass
-            elif rec[0] == 'SHOUT':
-                # Use the proxy object to relay the message.
-                name = rec[1]
-                channel = rec[2]
-                message = rec[3]
-                if Global.localchannelcount.get(channel, 0) > 0:
-                    logging.debug('Bridge proxy shout %s %s %s'%(name, channel, message))
-                    Global.proxies[name].send(channel, message)
-            else:
-                logging.warning('Unexpected msg %s from client.'%(rec))
+            # Got messages from the remote.
+            for rec in server_recv():
+                logging.debug('Got remote data %s'%(rec))
+                if rec[0] == 'JOIN':
+                    channel = rec[1]
+                    # If we don't already have a proxy object, create one.
+                    if channel not in Global.proxies:
+                        # Join first, so local senders see two peers in
+                        # the group and shout rather than whisper to
+                        # the proxy. Whispers that reach the proxy
+                        # anyway are forwarded (see BridgeProxy).
+                        Global.pyre.join(channel)
+                        t = BridgeProxy(channel)
+                        Global.proxies[channel] = t
+                        Global.proxy_uuids[t._pyre.uuid()] = t
+                        logging.info('Creating bridge proxy %s'%(channel))
+                elif rec[0] == 'LEAVE':
+                    # Don't actually know how to handle this.
+                    pass
+                elif rec[0] == 'SHOUT':
+                    # Use the proxy object to relay the message.
+                    name = rec[1]
+                    channel = rec[2]
+                    message = rec[3]
+                    if Global.localchannelcount.get(channel, 0) > 0:
+                        logging.debug('Bridge proxy shout %s %s %s'%(name, channel, message))
+                        Global.proxies[name].send(channel, message)
+                elif rec[0] == 'RAW':
+                    # A SHOUT passed through as the sender's Pyre
+                    # frames. Relay them unchanged.
+                    (name, channel, frames) = rec[1:]
+                    if Global.localchannelcount.get(channel, 0) > 0:
+                        logging.debug('Bridge proxy relay %s %s'%(name, channel))
+                        Global.proxies[name].relay(channel, frames)
+                else:
+                    logging.warning('Unexpected msg %s from client.'%(rec))
 
         if Global.pyre.socket() in items:
             # Got a message on Pyre.
@@ -213,59 +294,80 @@ def main(argv):
                     logging.debug('Bridge client leaving channel %s'%(channel))
             elif eventtype == 'SHOUT':
                 channel = event[3].decode('utf-8')
+                frames = event[4:]
 
                 # Quit if federation QUIT message received.
-                if event[4] == u'QUIT':
+                if frames == [b'QUIT']:
                     logging.warning('Bridge client received a local QUIT message. Exiting.')
                     client_quit()
-                # Since the server communicates with json, we
-                # need to un-json the message (which server_send
-                # will re-json). There's probably a more elegant way
-                # to do this.
-                if six.PY3:
-                    decoded = event[4].decode('utf-8')
-                    server_send(['SHOUT', name, channel, decoded])
-                else:
-                    message = json.loads(event[4].decode('utf-8'))
-                    server_send(['SHOUT', name, channel, message])
+                server_send_frame(shout_frame(name, channel, frames, Global.args.format))
 # end main()
 
-# server_send and server_recv taken almost directly from
-# https://github.com/mdebbar/jsonsocket
-#
-# The complexity is to handle framing -- send/receive over sockets
-# isn't atomic. See top of this file for comments.
+def shout_frame(name, channel, frames, format='raw'):
+    '''Return the bridge frame for a local SHOUT of frames (its Pyre frames) from name to channel. format is as in -format.'''
+    if format == 'json' and len(frames) == 1:
+        # Only a plain JSON message (a single frame, see
+        # transport_codec.py) can go as json.
+        try:
+            message = json.loads(frames[0].decode('utf-8'))
+        except ValueError:
+            pass
+        else:
+            return bridge_protocol.pack_frame(json.dumps(['SHOUT', name, channel, message]).encode('utf-8'))
+    return bridge_protocol.pack_raw(name, channel, frames)
+# end shout_frame()
+
+def decode_frame(frame):
+    '''Return the message in a bridge frame: a json list, or ['RAW', name, channel, frames] for a SHOUT passed through raw. Raises bridge_protocol.FrameError if it's malformed.'''
+    if bridge_protocol.frame_flags(frame) & bridge_protocol.FLAG_RAW:
+        return ['RAW'] + list(bridge_protocol.unpack_raw(frame))
+    return json.loads(bridge_protocol.frame_body(frame).decode('utf-8'))
+# end decode_frame()
 
 def server_send(msg):
-    serialized = json.dumps(msg)
+    server_send_frame(bridge_protocol.pack_frame(json.dumps(msg).encode('utf-8')))
+# end server_send()
+
+def server_send_frame(frame):
     with Global.writelock:
-        Global.bridgesocket.send(six.b('%d\n'%(len(serialized))))
-        Global.bridgesocket.sendall(six.b(serialized))
+        if Global.batcher is not None:
+            frame = Global.batcher.add(frame)
+            if frame is None:
+                return
+        Global.bridgesocket.sendall(frame)
+# end server_send_frame()
+
+def server_flush():
+    '''Send the batch being held, if any.'''
+    with Global.writelock:
+        frame = Global.batcher.flush()
+        if frame is not None:
+            Global.bridgesocket.sendall(frame)
+# end server_flush()
 
 def server_recv():
-    length_str = ''
-    next_offset = 0
+    '''Read what's available from the bridge socket, and return a list of the complete messages in it (possibly none). Quits if the server has gone away or sends a malformed frame.'''
     with Global.readlock:
-        # Get the length
-        char = Global.bridgesocket.recv(1)
-        while char != six.b('\n'):
-            length_str += char.decode('utf-8')
-            char = Global.bridgesocket.recv(1)
-        total = int(length_str)
-
-        # use a memoryview to receive the data chunk by chunk efficiently
-        view = memoryview(bytearray(total))
-        while total - next_offset > 0:
-            recv_size = Global.bridgesocket.recv_into(view[next_offset:], total - next_offset)
-            next_offset += recv_size
-
-    # Convert back to a python object
-    deserialized = json.loads(view.tobytes().decode('utf-8'))
-    return deserialized
+        data = Global.bridgesocket.recv(1 << 16)
+        if not data:
+            logging.warning('Bridge server closed the connection. Exiting.')
+            client_quit()
+        try:
+            # Convert back to python objects
+            return [decode_frame(frame) for frame in Global.reader.feed(data)]
+        except bridge_protocol.FrameError as e:
+            logging.error('Bad data from bridge server: %s. Exiting.'%(e))
+            client_quit()
 # end server_recv()
 
 def client_quit():
     '''Quit the bridge_client without throwing any errors.'''
+    try:
+        if Global.batcher is not None:
+            server_flush()
+    except:
+        pass
+
     try:
         Global.pyre.stop()
     except:
@@ -288,6 +390,11 @@ def parse_arguments(strs):
     parser = argparse.ArgumentParser(description='Start a bridge client that listens for Transport traffic and forwards to a bridge server. Version %s.'%(VERSION))
     parser.add_argument('-port', type=int, default=7417, help='Bridge server port. Defaults to %(default)s.')
     parser.add_argument('-host', default='ec2-54-153-1-22.us-west-1.compute.amazonaws.com', help='Bridge server host name. Defaults to %(default)s.')
+    parser.add_argument('-format', choices=['raw', 'json'], default='raw', help='How to send SHOUTs to the server: raw passes the Pyre frames through unchanged, json decodes plain JSON messages and sends them as json. The receiving client handles either. Defaults to %(default)s.')
+    parser.add_argument('-batch', type=float, default=0, help='Hold messages to the server for up to this many ms, and send them together. Use 0 to send each right away. Defaults to %(default)s.')
+    parser.add_argument('-batchbytes', type=int, default=65536, help='Send a batch once it holds this many bytes. Defaults to %(default)s.')
+    parser.add_argument('-compress', type=int, default=0, help='zlib compress batches of at least this many bytes. Use 0 to never compress. Defaults to %(default)s.')
+    parser.add_argument('-level', type=int, default=6, help='zlib compression level, 1 (fast) to 9 (small). Defaults to %(default)s.')
     parser.add_argument('-loglevel',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         default='WARNING',
@@ -0,0 +1,257 @@
+######################################################################
+#
+# File: bridge_protocol.py
+#
+# Framing for the bridge client/server connection (see
+# bridge_client.py and bridge_server.py).
+#
+# Each message is a frame: a fixed size binary header followed by the
+# message body. The body is the json list the bridge client sends
+# (['JOIN', channel], ['SHOUT', name, channel, message], ...), or with
+# FLAG_RAW, a SHOUT passed through as the sender's Pyre frames.
+#
+# Header layout (network byte order):
+#
+#   2 bytes  magic, b'\xffB'
+#   1 byte   frame version
+#   1 byte   flags (see FLAG_* below)
+#   4 bytes  body length in bytes
+#
+# A FLAG_BATCH body is a run of complete frames (none of them
+# batches), which the reader returns one by one. With FLAG_COMPRESSED
+# as well, the run is zlib compressed. See bridge_batch.py.
+#
+# FLAG_RAW body layout (network byte order):
+#
+#   2 bytes  length of the sender's name
+#   2 bytes  length of the channel
+#   2 bytes  number of Pyre frames
+#   the name, then the channel, both utf-8
+#   for each Pyre frame, 4 bytes length then the frame
+#
+# NOTES:
+#
+# Frames replace the old ascii length and newline, which the client
+# read a byte at a time with recv(1). FrameReader buffers whatever a
+# single recv() returns and splits out every complete frame in it, so
+# a busy link costs one recv() per buffer full rather than several
+# per message.
+#
+# The header is checked before anything is buffered past it, so a
+# client speaking the old format (or anything else) is caught at its
+# first message rather than after reading a bogus length. Clients and
+# servers from before this format can't talk to ones after it; upgrade
+# them together.
+#
+# A FLAG_RAW SHOUT is never decoded or re-encoded on the way: the
+# bridge client on the sending side packs the Pyre frames as they
+# came, the server reads only the channel (raw_channel()), and the
+# receiving bridge client relays the frames as they are (see
+# Transport.relay()). Transport headers, codecs and batches all get
+# through unchanged.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import struct
+import zlib
+
+MAGIC = b'\xffB'
+FRAME_VERSION = 1
+
+_HEADER = struct.Struct('!2sBBI')
+HEADER_SIZE = _HEADER.size
+
+# Frame flags.
+FLAG_RAW = 0x01  # A SHOUT of Pyre frames, see notes above.
+FLAG_BATCH = 0x02  # The body is a run of frames.
+FLAG_COMPRESSED = 0x04  # With FLAG_BATCH: the run is zlib compressed.
+
+# Flags this version understands. A frame with any other bit set is
+# rejected.
+KNOWN_FLAGS = FLAG_RAW | FLAG_BATCH | FLAG_COMPRESSED
+
+_RAW_HEADER = struct.Struct('!HHH')
+_RAW_LENGTH = struct.Struct('!I')
+
+# Default limit on the body of one frame.
+MAX_FRAME = 64 << 20
+
+class FrameError(Exception):
+    '''Raised for a malformed frame. The stream can't be read past it.'''
+    pass
+
+def pack_frame(body, flags=0):
+    '''Return bytes body as a frame.'''
+    return _HEADER.pack(MAGIC, FRAME_VERSION, flags, len(body)) + body
+# pack_frame()
+
+def frame_flags(frame):
+    return frame[3]
+# frame_flags()
+
+def frame_body(frame):
+    return frame[HEADER_SIZE:]
+# frame_body()
+
+def pack_raw(name, channel, frames):
+    '''Return a FLAG_RAW frame for a SHOUT from name to channel (strings) of frames (a list of bytes).'''
+    name = name.encode('utf-8')
+    channel = channel.encode('utf-8')
+    parts = [_RAW_HEADER.pack(len(name), len(channel), len(frames)), name, channel]
+    for frame in frames:
+        parts.append(_RAW_LENGTH.pack(len(frame)))
+        parts.append(frame)
+    return pack_frame(b''.join(parts), FLAG_RAW)
+# pack_raw()
+
+def raw_channel(frame):
+    '''Return the channel of a FLAG_RAW frame, without unpacking the rest. Raises FrameError if it's malformed.'''
+    start = HEADER_SIZE + _RAW_HEADER.size
+    if len(frame) < start:
+        raise FrameError('Raw frame too short')
+    (name_length, channel_length, count) = _RAW_HEADER.unpack_from(frame, HEADER_SIZE)
+    start += name_length
+    if len(frame) < start + channel_length:
+        raise FrameError('Raw frame too short')
+    try:
+        return frame[start:start + channel_length].decode('utf-8')
+    except UnicodeDecodeError:
+        raise FrameError('Raw frame channel is not utf-8')
+# raw_channel()
+
+def unpack_raw(frame):
+    '''Return (name, channel, list of Pyre frames) from a FLAG_RAW frame. Raises FrameError if it's malformed.'''
+    size = len(frame)
+    start = HEADER_SIZE + _RAW_HEADER.size
+    if size < start:
+        raise FrameError('Raw frame too short')
+    (name_length, channel_length, count) = _RAW_HEADER.unpack_from(frame, HEADER_SIZE)
+    end = start + name_length + channel_length
+    if size < end:
+        raise FrameError('Raw frame too short')
+    try:
+        name = frame[start:start + name_length].decode('utf-8')
+        channel = frame[start + name_length:end].decode('utf-8')
+    except UnicodeDecodeError:
+        raise FrameError('Raw frame name or channel is not utf-8')
+    frames = []
+    for i in range(count):
+        start = end + _RAW_LENGTH.size
+        if size < start:
+            raise FrameError('Raw frame too short')
+        end = start + _RAW_LENGTH.unpack_from(frame, start - _RAW_LENGTH.size)[0]
+        if size < end:
+            raise FrameError('Raw frame too short')
+        frames.append(frame[start:end])
+    if end != size:
+        raise FrameError('Raw frame has %d extra bytes'%(size - end))
+    return (name, channel, frames)
+# unpack_raw()
+
+class FrameReader(object):
+    '''Splits a byte stream into frames. Give feed() whatever recv() returns; it returns the complete frames (header included) found so far.'''
+
+    def __init__(self, maxframe=MAX_FRAME):
+        self.maxframe = maxframe
+        # Bytes of an incomplete frame, left over from the last feed().
+        self._buffer = bytearray()
+        # Counters, see stats().
+        self._counts = dict.fromkeys(['frames', 'bytes', 'batches', 'compressed', 'compressed_bytes_in', 'compressed_bytes_out'], 0)
+    # __init__()
+
+    def feed(self, data):
+        '''Return a list of complete frames, as bytes. Raises FrameError if the stream is malformed.'''
+        buf = self._buffer
+        if buf:
+            buf += data
+            source = buf
+        else:
+            # Usually frames end where recv() did, so parse data itself
+            # and don't copy it into the buffer first.
+            source = data
+        size = len(source)
+        frames = []
+        start = 0
+        unpack = _HEADER.unpack_from
+        while size - start >= HEADER_SIZE:
+            (magic, version, flags, length) = unpack(source, start)
+            self._check(source, start, magic, version, flags, length)
+            end = start + HEADER_SIZE + length
+            if end > size:
+                break
+            if flags & FLAG_BATCH:
+                frames += self._unbatch(flags, bytes(source[start + HEADER_SIZE:end]))
+            else:
+                frames.append(bytes(source[start:end]))
+            start = end
+        if source is buf:
+            del buf[:start]
+        elif start < size:
+            buf += data[start:]
+        self._counts['bytes'] += len(data)
+        self._counts['frames'] += len(frames)
+        return frames
+    # feed()
+
+    def stats(self):
+        '''Return a dict of counters: frames and bytes read, batches unpacked, and of those, how many were compressed and their size before and after decompressing.'''
+        return dict(self._counts)
+    # stats()
+
+    def _check(self, source, start, magic, version, flags, length):
+        if magic != MAGIC:
+            raise FrameError('Bad frame magic %r (old or foreign client?)'%(bytes(source[start:start + 2])))
+        if version != FRAME_VERSION:
+            raise FrameError('Unsupported frame version %d'%(version))
+        if flags & ~KNOWN_FLAGS:
+            raise FrameError('Unknown frame flags 0x%02x'%(flags))
+        if flags & FLAG_BATCH:
+            if flags & FLAG_RAW:
+                raise FrameError('Bad batch flags 0x%02x'%(flags))
+        elif flags & FLAG_COMPRESSED:
+            raise FrameError('Compressed frame that is not a batch')
+        if length > self.maxframe:
+            raise FrameError('Frame of %d bytes is over the limit of %d'%(length, self.maxframe))
+    # _check()
+
+    def _unbatch(self, flags, body):
+        '''Return the frames in the body of a batch.'''
+        self._counts['batches'] += 1
+        if flags & FLAG_COMPRESSED:
+            decompressor = zlib.decompressobj()
+            try:
+                plain = decompressor.decompress(body, self.maxframe)
+            except zlib.error as e:
+                raise FrameError('Corrupt compressed batch: %s'%(e))
+            if decompressor.unconsumed_tail:
+                raise FrameError('Compressed batch is over the limit of %d bytes'%(self.maxframe))
+            self._counts['compressed'] += 1
+            self._counts['compressed_bytes_in'] += len(body)
+            self._counts['compressed_bytes_out'] += len(plain)
+            body = plain
+        size = len(body)
+        frames = []
+        start = 0
+        while start < size:
+            if size - start < HEADER_SIZE:
+                raise FrameError('Truncated frame in batch')
+            (magic, version, inner, length) = _HEADER.unpack_from(body, start)
+            self._check(body, start, magic, version, inner, length)
+            if inner & FLAG_BATCH:
+                raise FrameError('Batch inside a batch')
+            end = start + HEADER_SIZE + length
+            if end > size:
+                raise FrameError('Truncated frame in batch')
+            frames.append(body[start:end])
+            start = end
+        return frames
+    # _unbatch()
+
+    def pending(self):
+        '''Return the number of bytes buffered toward the next frame.'''
+        return len(self._buffer)
+    # pending()
+# class FrameReader
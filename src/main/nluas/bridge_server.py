@@ -12,133 +12,386 @@
 # It knows nothing about federations, so you should
 # have a separate server for each federation.
 #
+# NOTES:
 #
-# TODO:
+# The server is an asyncio event loop, so it never waits on any one
+# client. Messages are frames (see bridge_protocol.py), and the server
+# forwards whole frames, so messages from different clients are never
+# interleaved.
 #
-# Support python3
+# Each client has its own outbound buffer. A client that reads more
+# slowly than others send has its buffer grow; above -highwater bytes
+# it's marked slow, and if it's still slow after -stall seconds, or
+# its buffer passes -maxbuffer bytes, it's disconnected (evicted) so
+# it can't hold up anyone else or use up the server's memory. It can
+# reconnect, but it will have missed messages. Evictions are logged
+# and counted in the stats printed by the "stats" command.
+#
+# The server reads the start of each message (see message_route(),
+# or for raw SHOUTs bridge_protocol.raw_channel()) to track which
+# channels each client has JOINed, and sends a SHOUT only to the
+# clients that have joined its channel, rather than to every client
+# for most of them to throw away. JOIN and LEAVE still go
+# to every client, since clients create proxies from JOINs. A client
+# that connects is sent a JOIN for every channel other clients are on,
+# so it has proxies for Transports that were running before it came.
+# Fan-out per channel is counted in the stats.
+#
+# With -batch and/or -compress, what the server sends each client is
+# batched and compressed (see bridge_batch.py). Batches from clients
+# are unpacked whatever the server's own settings.
+#
+# Python 3 only.
 #
 
-from six.moves import input
+# ------
+# See LICENSE.txt for licensing information.
+# ------
 
 import argparse
+import asyncio
+import json
 import logging
-import select
 import signal
 import socket
 import sys
+import time
 
-VERSION = 0.1
+from nluas import bridge_batch
+from nluas import bridge_protocol
+
+VERSION = 0.4
 
 # Command line arguments (argparse object). Created in parse_arguments()
 Args = None
 
-# Dictionary of client socket -> address
-ClientSockets = {}
+# The BridgeServer. Global so server_quit() can find it.
+Server = None
+
+# Decodes a json string starting just after its opening quote.
+_scanstring = json.decoder.scanstring
+
+class BridgeError(Exception):
+    '''Raised for a malformed message from a client.'''
+    pass
+
+class BridgeServer(object):
+    '''Forwards every message a client sends to all the other clients. See notes above for highwater, maxbuffer and stall. batch (seconds), batchbytes, compress and level set up batching to each client as in bridge_batch.LinkBatcher; batch and compress of None turn it off.'''
+
+    def __init__(self, highwater=1 << 20, maxbuffer=16 << 20, stall=10.0, maxmessage=64 << 20, batch=None, batchbytes=65536, compress=None, level=6):
+        self.highwater = highwater
+        self.maxbuffer = maxbuffer
+        self.stall = stall
+        self.maxmessage = maxmessage
+        self.batch = batch
+        self.batchbytes = batchbytes
+        self.compress = compress
+        self.level = level
+        # Batching counters of all clients, see bridge_batch.py.
+        self.link_counts = bridge_batch.new_counts()
+        # Set of connected BridgeProtocols.
+        self.clients = set()
+        # Dict of channel -> set of BridgeProtocols that have joined it.
+        self.channels = {}
+        # Counters, see stats(). fanout is a dict of channel ->
+        # [SHOUTs received, SHOUTs forwarded].
+        self.messages = 0
+        self.bytes = 0
+        self.forwarded = 0
+        self.evicted = 0
+        self.fanout = {}
+        # Time of the last message or connection. See -timeout.
+        self.last_activity = time.time()
+        self._server = None
+    # __init__()
+
+    async def start(self, host, port):
+        '''Start listening on host:port. Returns the asyncio server.'''
+        loop = asyncio.get_event_loop()
+        self._server = await loop.create_server(lambda: BridgeProtocol(self), host or None, port)
+        return self._server
+    # start()
+
+    def received(self, sender, message):
+        '''Route message (a frame) from the client sender.'''
+        self.messages += 1
+        self.bytes += len(message)
+        self.last_activity = time.time()
+        if bridge_protocol.frame_flags(message) & bridge_protocol.FLAG_RAW:
+            (kind, channel) = ('SHOUT', bridge_protocol.raw_channel(message))
+        else:
+            (kind, channel) = message_route(message, bridge_protocol.HEADER_SIZE)
+        if kind == 'SHOUT':
+            members = self.channels.get(channel, ())
+            counts = self.fanout.get(channel)
+            if counts is None:
+                counts = self.fanout[channel] = [0, 0]
+            counts[0] += 1
+            # Copied, since writing can evict a client.
+            for client in list(members):
+                if client is not sender:
+                    client.write(message)
+                    counts[1] += 1
+                    self.forwarded += 1
+            return
+        if kind == 'JOIN':
+            self.channels.setdefault(channel, set()).add(sender)
+            sender.channels.add(channel)
+        elif kind == 'LEAVE':
+            self.leave(sender, channel)
+        self.forward(sender, message)
+    # received()
+
+    def forward(self, sender, message):
+        '''Send message (a frame) from the client sender to all the others.'''
+        # Copied, since writing can evict a client.
+        for client in list(self.clients):
+            if client is not sender:
+                client.write(message)
+                self.forwarded += 1
+    # forward()
+
+    def connected(self, client):
+        self.clients.add(client)
+        self.last_activity = time.time()
+        # Tell the new client about channels that are already joined.
+        for channel in self.channels:
+            client.write(bridge_protocol.pack_frame(json.dumps(['JOIN', channel]).encode('utf-8')))
+    # connected()
+
+    def disconnected(self, client):
+        self.clients.discard(client)
+        for channel in list(client.channels):
+            self.leave(client, channel)
+    # disconnected()
+
+    def leave(self, client, channel):
+        client.channels.discard(channel)
+        members = self.channels.get(channel)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self.channels[channel]
+    # leave()
+
+    def make_batcher(self):
+        '''Return a LinkBatcher for a new client, or None if batching is off.'''
+        if self.batch is None and self.compress is None:
+            return None
+        return bridge_batch.LinkBatcher(self.batch or 0, self.batchbytes, self.compress, self.level, self.link_counts)
+    # make_batcher()
+
+    def close(self):
+        for client in list(self.clients):
+            client.close()
+        if self._server is not None:
+            self._server.close()
+    # close()
+
+    def stats(self):
+        '''Return a dict of counters: clients connected, messages and bytes received, messages forwarded, clients evicted, for each channel, clients joined and SHOUTs received and forwarded, and batching stats (see bridge_batch.LinkBatcher.stats()) or None if batching is off.'''
+        channels = {}
+        for (channel, (shouts, forwarded)) in self.fanout.items():
+            channels[channel] = {'members': 0, 'shouts': shouts, 'forwarded': forwarded}
+        for (channel, members) in self.channels.items():
+            channels.setdefault(channel, {'shouts': 0, 'forwarded': 0})['members'] = len(members)
+        return {'clients': len(self.clients), 'messages': self.messages, 'bytes': self.bytes,
+                'forwarded': self.forwarded, 'evicted': self.evicted, 'channels': channels,
+                'batching': None if self.batch is None and self.compress is None else bridge_batch.summarize(self.link_counts)}
+    # stats()
+# end class BridgeServer
+
+class BridgeProtocol(asyncio.Protocol):
+    '''One client connection: splits what it sends into messages, and buffers what's sent to it.'''
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.address = None
+        self._reader = bridge_protocol.FrameReader(server.maxmessage)
+        # Channels this client has joined.
+        self.channels = set()
+        # When the outbound buffer went over the high-water mark, or
+        # None if it's under.
+        self._slow_since = None
+        self._batcher = server.make_batcher()
+        # Timer for flushing _batcher.
+        self._flush_handle = None
+    # __init__()
 
-# Global so server_quit() can find it.
-ServerSocket = None
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        transport.set_write_buffer_limits(high=self.server.highwater)
+        logging.info('Got connection from %s:%d'%self.address[:2])
+        self.server.connected(self)
+    # connection_made()
+
+    def connection_lost(self, exc):
+        self.server.disconnected(self)
+        logging.info('%s:%d disconnected'%self.address[:2])
+    # connection_lost()
+
+    def data_received(self, data):
+        try:
+            for message in self._reader.feed(data):
+                self.server.received(self, message)
+        except (bridge_protocol.FrameError, BridgeError) as e:
+            logging.warning('Disconnecting %s:%d: %s'%(self.address[:2] + (e,)))
+            self.close()
+    # data_received()
+
+    def pause_writing(self):
+        # Called when the outbound buffer goes over the high-water mark.
+        self._slow_since = time.time()
+        logging.debug('%s:%d is slow'%self.address[:2])
+    # pause_writing()
+
+    def resume_writing(self):
+        self._slow_since = None
+    # resume_writing()
+
+    def write(self, message):
+        transport = self.transport
+        if transport.is_closing():
+            return
+        slow = self._slow_since
+        if slow is not None:
+            size = transport.get_write_buffer_size() + len(message)
+            if size > self.server.maxbuffer or time.time() - slow > self.server.stall:
+                self.evict(size)
+                return
+        batcher = self._batcher
+        if batcher is not None:
+            message = batcher.add(message)
+            if message is None:
+                if self._flush_handle is None:
+                    self._flush_handle = asyncio.get_event_loop().call_later(batcher.max_delay, self.flush)
+                return
+        transport.write(message)
+    # write()
+
+    def flush(self):
+        '''Send what the batcher holds.'''
+        self._flush_handle = None
+        message = self._batcher.flush()
+        if message is not None and not self.transport.is_closing():
+            self.transport.write(message)
+    # flush()
+
+    def evict(self, size):
+        logging.warning('Evicting slow client %s:%d with %d bytes waiting'%(self.address[:2] + (size,)))
+        self.server.evicted += 1
+        self.server.disconnected(self)
+        # abort() rather than close(), which would wait to send the
+        # buffer.
+        self.transport.abort()
+    # evict()
+
+    def close(self):
+        self.server.disconnected(self)
+        self.transport.abort()
+    # close()
+# end class BridgeProtocol
+
+def message_route(message, offset=0):
+    '''Return (type, channel) of the json message in bytes message from offset, where type is 'JOIN', 'LEAVE' or 'SHOUT' and channel is a string (or None for other types). Only reads as far as the channel. Raises BridgeError if the message isn't a list starting with strings.'''
+    text = message[offset:offset + 4096].decode('utf-8', 'ignore')
+    try:
+        i = text.index('"')
+        if text[:i].strip() != '[':
+            raise ValueError
+        (kind, i) = _scanstring(text, i + 1)
+        if kind in ('JOIN', 'LEAVE'):
+            fields = 1
+        elif kind == 'SHOUT':
+            # Skip the name.
+            fields = 2
+        else:
+            return (kind, None)
+        for field in range(fields):
+            j = text.index('"', i)
+            if text[i:j].strip() != ',':
+                raise ValueError
+            (value, i) = _scanstring(text, j + 1)
+        return (kind, value)
+    except ValueError:
+        pass
+    # Cut off, or not formatted as json.dumps() would. Decode it all.
+    try:
+        decoded = json.loads(message[offset:].decode('utf-8'))
+        if decoded[0] in ('JOIN', 'LEAVE'):
+            return (decoded[0], decoded[1])
+        if decoded[0] == 'SHOUT':
+            return (decoded[0], decoded[2])
+        return (decoded[0], None)
+    except (ValueError, TypeError, IndexError, KeyError):
+        raise BridgeError('bad message %r'%(message[offset:offset + 40]))
+# message_route()
 
 def main(argv):
 
-    global ClientSockets, ServerSocket, Args
+    global Server
 
     parse_arguments(argv[1:])
     setup_logging()
 
-    # If the user presses ctrl-C, exit cleanly.
-    signal.signal(signal.SIGINT, lambda s, f: server_quit())
-
-    # Create the server socket.
-    ServerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    ServerSocket.bind((Args.host, Args.port))
-    ServerSocket.listen(5)
-    (ignore, port) = ServerSocket.getsockname()
+    loop = asyncio.get_event_loop()
+    Server = BridgeServer(Args.highwater, Args.maxbuffer, Args.stall,
+                          batch=Args.batch / 1000.0 if Args.batch > 0 else None, batchbytes=Args.batchbytes,
+                          compress=Args.compress or None, level=Args.level)
+    server = loop.run_until_complete(Server.start(Args.host, Args.port))
+    (ignore, port) = server.sockets[0].getsockname()[:2]
     if Args.host == '':
         host = socket.getfqdn()
     else:
         host = Args.host
     logging.warning('Server listening on %s:%d'%(host, port))
 
-    # Listen for connections and/or messages from clients
-    while True:
-        sockets = list(ClientSockets.keys())
-        sockets.append(ServerSocket)
-        sockets.append(sys.stdin)
-        # sockets now contain all the current client sockets plus
-        # the server socket plus stdin.
-        if Args.timeout > 0:
-            si,so,se = select.select(sockets, [], [], Args.timeout)
-        else:
-            si,so,se = select.select(sockets, [], [])
-
-        # If si is empty, timeout occurred.
-        if len(si) == 0:
-            logging.warning('Server timed out')
-            server_quit()
-            break
-
-        if sys.stdin in si:
-            # Got something on stdin.
-            command = input()
-            if command == 'quit':
-                server_quit()
-                break
-            elif command == 'help':
-                print('\nValid commands are quit and help.\n')
-            else:
-                logging.warning('Unknown command on stdin: "%s"'%(command))
-
-        if ServerSocket in si:
-            # New connection. Add to ClientSockets.
-            (clientsocket, address) = ServerSocket.accept()
-            logging.info("Got connection from %s:%d"%address)
-            ClientSockets[clientsocket] = address
-            continue
-
-        # Now, for each client, check if it's sent a message
-        for client in ClientSockets:
-            if client in si:
-                try:
-                    rec = client.recv(Args.blocksize)
-                except:
-                    rec = None
-                if rec == b'' or rec == 0 or rec == '' or rec is None:
-                    # Client disconnected
-                    logging.info("%s:%d disconnected"%ClientSockets[client])
-                    try:
-                        client.shutdown(socket.SHUT_RDWR)
-                        client.close()
-                    except:
-                        pass  # silently ignore problems closing a cleient.
-                    del ClientSockets[client]
-                    # Since ClientSockets has changed, the "for client"
-                    # iterator must be exited.
-                    break
-                logging.debug('Got data "%s"'%(rec))
-                # Client sent something. Forward to all clients
-                # except the client that sent it.
-                for c in ClientSockets:
-                    if c != client:
-                        logging.debug('Sending data to %s:%d'%ClientSockets[c])
-                        c.sendall(rec)
-        # end for client
-    # end while True
+    # If the user presses ctrl-C, exit cleanly.
+    loop.add_signal_handler(signal.SIGINT, server_quit)
+    try:
+        loop.add_reader(sys.stdin, read_command)
+    except (ValueError, OSError):
+        # No usable stdin, e.g. started in the background.
+        pass
+    if Args.timeout > 0:
+        loop.call_later(Args.timeout, check_timeout)
+    loop.run_forever()
 # end main()
 
+def read_command():
+    command = sys.stdin.readline()
+    if command == '':
+        # End of file. Stop reading, but keep serving.
+        asyncio.get_event_loop().remove_reader(sys.stdin)
+        return
+    command = command.strip()
+    if command == 'quit':
+        server_quit()
+    elif command == 'stats':
+        print(Server.stats())
+    elif command == 'help':
+        print('\nValid commands are quit, stats and help.\n')
+    else:
+        logging.warning('Unknown command on stdin: "%s"'%(command))
+# end read_command()
+
+def check_timeout():
+    idle = time.time() - Server.last_activity
+    if idle >= Args.timeout:
+        logging.warning('Server timed out')
+        server_quit()
+    else:
+        asyncio.get_event_loop().call_later(Args.timeout - idle, check_timeout)
+# end check_timeout()
 
 def server_quit():
     '''Close all clients and the server'''
-    global ClientSockets, ServerSocket, Args
-
-    for c in ClientSockets:
-        c.shutdown(socket.SHUT_RDWR)
-        c.close()
-
-    if ServerSocket is not None:
-        ServerSocket.shutdown(socket.SHUT_RDWR)
-        ServerSocket.close()
+    if Server is not None:
+        Server.close()
     logging.info('Server quitting')
-    sys.exit(0)
+    asyncio.get_event_loop().stop()
 # end server_quit()
 
 
@@ -147,12 +400,18 @@ def parse_arguments(strs):
     parser.add_argument('-port', type=int, default=7417, help='Server port to listen on. Use 0 to assign an unused non-root port. Defaults to %(default)s.')
     parser.add_argument('-host', default='', help='Which host IP to listen on. Typical settings are "localhost" if you only want connections from this host, the fully qualified host name, or blank if you want to accept connections sent to any interface the local host uses. Defaults to %(default)s.')
     parser.add_argument('-timeout', type=int, default=0, help='If the server has no activity after this amount of time, it automatically exits. Use 0 to never exit. Default is %(default)s.')
+    parser.add_argument('-highwater', type=int, default=1 << 20, help='A client with more than this many bytes waiting to be sent to it is slow. Default is %(default)s.')
+    parser.add_argument('-maxbuffer', type=int, default=16 << 20, help='Evict a client with more than this many bytes waiting. Default is %(default)s.')
+    parser.add_argument('-stall', type=float, default=10.0, help='Evict a client that has been slow for this many seconds. Default is %(default)s.')
+    parser.add_argument('-batch', type=float, default=0, help='Hold messages to each client for up to this many ms, and send them together. Use 0 to send each right away. Default is %(default)s.')
+    parser.add_argument('-batchbytes', type=int, default=65536, help='Send a batch once it holds this many bytes. Default is %(default)s.')
+    parser.add_argument('-compress', type=int, default=0, help='zlib compress batches of at least this many bytes. Use 0 to never compress. Default is %(default)s.')
+    parser.add_argument('-level', type=int, default=6, help='zlib compression level, 1 (fast) to 9 (small). Default is %(default)s.')
     parser.add_argument('-loglevel',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         default='INFO',
                         help='Logging level (default %(default)s)')
     parser.add_argument('-version', '--version', action='version', version=str(VERSION))
-    parser.add_argument('-blocksize', type=int, default=1024, help='Read at most this many bytes when a socket has data available. Only useful for debugging. Default is %(default)s.')
     global Args
     Args = parser.parse_args(strs)
 # end parse_arguments()
@@ -161,7 +420,7 @@ def parse_arguments(strs):
 def setup_logging():
     numeric_level = getattr(logging, Args.loglevel, None)
     if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: %s' % loglevel)
+        raise ValueError('Invalid log level: %s' % Args.loglevel)
     logging.basicConfig(level=numeric_level, format="%(module)s:%(levelname)s: %(message)s")
 # end setup_logging()
 
@@ -63,11 +63,22 @@ class CoreAgent(object):
         self.federation = os.environ.get("ECG_FED")
         if self.federation is None:
             self.federation = "FED1"
+        # Wire codec for this agent's Transport, e.g. "json" or "binary".
+        self.codec = os.environ.get("ECG_CODEC", "json")
+        # "pyre" (default), or "inproc" when all agents share one process.
+        self.backend = os.environ.get("ECG_TRANSPORT", "pyre")
+        # How agents find each other, e.g. "registry:/tmp/ecg" where UDP
+        # broadcast doesn't work. Pyre's beacons if unset. See
+        # transport_discovery.py.
+        self.discovery = os.environ.get("ECG_DISCOVERY")
 
     def initialize(self, args):
         self.name = args.name
         self.address = "{}_{}".format(self.federation, self.name)
-        self.transport = Transport(self.address)
+        self.transport = Transport(self.address, codec=self.codec, backend=self.backend, discovery=self.discovery)
+        # Agents start in any order. Hold messages for agents that
+        # haven't joined yet instead of losing them.
+        self.transport.set_send_buffer()
         self.logfile = args.logfile
         self.loglevel = args.loglevel
         self.logagent = args.logagent
@@ -87,7 +98,7 @@ class CoreAgent(object):
     def close(self, quit_federation=False):
         if not self._broadcasted:
             self._broadcasted = True
-            self.transport.broadcast({"text": "QUIT", "type": "QUIT"}) # application-level quit
+            self.transport.broadcast({"text": "QUIT", "type": "QUIT"}, priority="high") # application-level quit
 
         if quit_federation:
             time.sleep(0.5)
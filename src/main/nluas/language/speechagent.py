@@ -52,7 +52,16 @@ class SpeechAgent(CoreAgent):
         CoreAgent.__init__(self, args)
         self.ui_destination = "%s_%s"%(self.federation, "AgentUI")
         self.transport.subscribe(self.ui_destination, self.callback)
+        # Seconds after which what was said is stale. The UI drops
+        # anything that reaches it later, and tells us.
+        self.ttl = 5.0
+        self.transport.set_expiry_callback(self.expired)
     # end __init__()
+
+    def expired(self, dest, late):
+        '''Called when dest drops something we heard because it arrived too late.'''
+        print("%s is falling behind and dropped what you said (%.1f seconds late). Please say it again."%(dest, late or 0))
+    # end expired()
 # end class SpeechAgent
 
 
@@ -198,7 +207,7 @@ def main(argv):
         if asrresult != "":
             print("Heard:", asrresult, "\n")
             ntuple = {'type': 'speech', 'text': asrresult}
-            speechagent.transport.send(speechagent.ui_destination, ntuple)
+            speechagent.transport.send(speechagent.ui_destination, ntuple, ttl=speechagent.ttl)
         else:
             print("Speech recognition failed")
     speechagent.transport.quit_federation()
@@ -26,6 +26,7 @@ from nluas.language.analyzer_proxy import *
 from nluas.ntuple_decoder import NtupleDecoder
 import sys, traceback, time
 import json
+import threading
 import time
 from collections import OrderedDict
 
@@ -46,9 +47,17 @@ class UserAgent(CoreAgent):
         self.text_address = "{}_{}".format(self.federation, "TextAgent")
         # self.ui_destination = "{}_{}".format(self.federation, "AgentUI")
         self.transport.subscribe(self.solve_destination, self.callback)
-        self.transport.subscribe(self.speech_address, self.speech_callback)
-        self.transport.subscribe(self.text_address, self.text_callback)
-
+        # speech_callback and text_callback run a full analyzer round
+        # trip, so give them their own threads rather than stalling the
+        # other channels. process_input() takes input_lock, so they
+        # take turns with the analyzer and specializer.
+        self.transport.subscribe(self.speech_address, self.speech_callback, policy='thread')
+        self.transport.subscribe(self.text_address, self.text_callback, policy='thread')
+        # Spoken commands are useless to the ProblemSolver if they
+        # reach it more than command_ttl seconds later. It drops them
+        # and tells us, see command_expired().
+        self.command_ttl = 5.0
+        self.transport.set_expiry_callback(self.command_expired)
 
 
     def setup_ui_parser(self):
@@ -59,6 +68,9 @@ class UserAgent(CoreAgent):
 
     def initialize_UI(self):
         self.clarification = False
+        # Held while the analyzer and specializer are in use. See
+        # process_input().
+        self.input_lock = threading.Lock()
         self.analyzer_port = "http://localhost:8090"
         connected, printed = False, False
         while not connected:
@@ -104,7 +116,12 @@ class UserAgent(CoreAgent):
         * Feed the string msg to the ECG analyzer
         * Passes the resulting SemSpec to the specializer to produce a new ntuple
         * Returns a JSON-Encoded version of the ntuple
+        * Called from several threads; one input is processed at a time
         '''
+        with self.input_lock:
+            return self._process_input(msg)
+
+    def _process_input(self, msg):
         # print('===========================================================')
         # print('User Agent.process_input!')
         # print('===========================================================')
@@ -214,7 +231,11 @@ class UserAgent(CoreAgent):
             print("Got {}".format(text))
         new_ntuple = self.process_input(text)
         if new_ntuple and new_ntuple != "null" and "predicate_type" in new_ntuple:
-            self.transport.send(self.solve_destination, new_ntuple)
+            self.transport.send(self.solve_destination, new_ntuple, ttl=self.command_ttl)
+
+    def command_expired(self, dest, late):
+        """ Called when dest dropped a command of ours because it arrived late. """
+        self.output_stream(self.name, "{} is busy and dropped a command that arrived {:.1f} seconds late. Please repeat it.".format(dest, late or 0))
 
 
     def text_callback(self, ntuple):
@@ -230,7 +251,8 @@ class UserAgent(CoreAgent):
             if msg == None or msg == "":
                 specialize = False
             elif msg.lower() == "d":
-                self.specializer.set_debug()
+                with self.input_lock:
+                    self.specializer.set_debug()
                 specialize = False
             elif specialize:
                 new_ntuple = self.process_input(ntuple['text'])
@@ -0,0 +1,115 @@
+######################################################################
+#
+# File: transport_coalesce.py
+#
+# Coalescing of outgoing Transport messages.
+#
+# When coalescing is on (Transport.set_coalescing()), Transport.send()
+# doesn't shout right away. Instead, the encoded message is added to a
+# per-destination buffer. The buffer is sent as a single batch message
+# (see transport_codec.encode_batch()) once it holds max_count
+# messages or max_bytes bytes, or max_delay seconds after its first
+# message, whichever comes first.
+#
+# Messages to one destination keep their order. A background thread
+# handles the max_delay flushes, and only runs while coalescing is on.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import logging
+import threading
+import time
+
+from nluas import transport_codec
+
+logger = logging.getLogger('Transport')
+
+class Coalescer(object):
+    '''Buffers encoded payloads per destination and hands them to send(dest, payloads) in batches.'''
+
+    def __init__(self, send, max_delay=0.005, max_count=64, max_bytes=65536):
+        if max_delay <= 0 or max_count < 1 or max_bytes < 1:
+            raise ValueError('Coalescing limits must be positive.')
+        self._send = send
+        self.max_delay = max_delay
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        # dict of dest => list of payloads waiting to go out
+        self._buffers = {}
+        # dict of dest => bytes in _buffers[dest]
+        self._sizes = {}
+        # dict of dest => time by which _buffers[dest] must be sent
+        self._deadlines = {}
+        # Held while sending so batches to one destination can't
+        # overtake each other.
+        self._cond = threading.Condition(threading.Lock())
+        self._run = True
+        self._thread = threading.Thread(target=self._worker, name='Transport-coalesce')
+        self._thread.daemon = True
+        self._thread.start()
+    # __init__()
+
+    def add(self, dest, payload):
+        '''Queue encoded payload for dest. Sends the buffer right away if it's full.'''
+        with self._cond:
+            buf = self._buffers.get(dest)
+            if buf is None:
+                buf = self._buffers[dest] = []
+                self._sizes[dest] = 0
+                self._deadlines[dest] = time.time() + self.max_delay
+                # The worker may be sleeping past our deadline.
+                self._cond.notify()
+            buf.append(payload)
+            self._sizes[dest] += transport_codec.frame_size(payload)
+            if len(buf) >= self.max_count or self._sizes[dest] >= self.max_bytes:
+                self._flush(dest)
+    # add()
+
+    def flush(self, dest=None):
+        '''Send what's buffered for dest, or for all destinations if dest is None.'''
+        with self._cond:
+            if dest is None:
+                for d in list(self._buffers):
+                    self._flush(d)
+            elif dest in self._buffers:
+                self._flush(dest)
+    # flush()
+
+    def close(self):
+        '''Flush everything and stop the background thread.'''
+        self.flush()
+        with self._cond:
+            self._run = False
+            self._cond.notify()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+    # close()
+
+    def _flush(self, dest):
+        # Must be called with self._cond held.
+        payloads = self._buffers.pop(dest)
+        del self._sizes[dest]
+        del self._deadlines[dest]
+        try:
+            self._send(dest, payloads)
+        except Exception:
+            logger.exception('Failed to send %d coalesced messages to %s'%(len(payloads), dest))
+    # _flush()
+
+    def _worker(self):
+        with self._cond:
+            while self._run:
+                if not self._deadlines:
+                    self._cond.wait()
+                    continue
+                now = time.time()
+                due = [d for (d, t) in self._deadlines.items() if t <= now]
+                for dest in due:
+                    self._flush(dest)
+                if not due:
+                    self._cond.wait(min(self._deadlines.values()) - now)
+    # _worker()
+# class Coalescer
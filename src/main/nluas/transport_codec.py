@@ -0,0 +1,567 @@
+######################################################################
+#
+# File: transport_codec.py
+#
+# Wire codecs for Transport.
+#
+# A Transport message travels as one or more Pyre frames. Messages
+# encoded with the default JSON codec are sent exactly as before: a
+# single frame holding the utf-8 JSON text. Anything else is sent as
+# a header frame followed by the payload frame. The header starts
+# with a magic byte (0xff) that can never start valid utf-8 JSON, so
+# a receiver can always tell the two formats apart.
+#
+# A batch (FLAG_BATCH, see Transport.send_many()) is a header frame
+# followed by one payload frame per message, in order.
+#
+# Compression (FLAG_COMPRESSED) is opt-in on the sending side, see
+# Compressor below. Every Transport can decompress, since zlib is in
+# the standard library.
+#
+# FLAG_URGENT marks a high priority message (see Transport.send()).
+# Receivers check it with is_urgent() before decoding anything, so
+# it can jump ahead of normal messages. Older receivers ignore it.
+#
+# FLAG_DEADLINE adds the time (seconds since the epoch) after which
+# the message is useless, see Transport.send(ttl=...). A receiver
+# drops it if it's late and reports that to the sender with a
+# FLAG_EXPIRED message.
+#
+# Header layout (network byte order):
+#
+#   2 bytes  magic, b'\xffT'
+#   1 byte   header version
+#   1 byte   codec id (see CODEC_* below)
+#   1 byte   flags (see FLAG_* below)
+#
+# followed by optional fields, present only if the matching flag is
+# set, in this order:
+#
+#   16 bytes correlation id (FLAG_REQUEST or FLAG_REPLY)
+#   8 bytes  deadline, a double (FLAG_DEADLINE)
+#
+# NOTES:
+#
+# All agents in a federation must be able to decode the codec that
+# the sender picks. The "binary" codec is marshal (stdlib) on every
+# host, so picking it never depends on what happens to be installed.
+# Name msgpack explicitly to use it; then every receiver needs the
+# msgpack package too. The header carries the codec used, so
+# receivers always know which one to decode with.
+#
+# Every codec raises CodecError for a payload it can't decode, so a
+# receiver can drop a bad message without knowing which library
+# failed or how.
+#
+# marshal is not safe against maliciously constructed data. It is
+# fine between agents on a trusted network (which is already assumed
+# by Transport.is_valid_ip()), but don't use it across the bridge to
+# untrusted sites.
+#
+# LazyNtuple (see Transport.subscribe(lazy=True)) holds an encoded
+# payload and only decodes it when it's used. peek() can read a
+# top-level field of a JSON payload without decoding the rest.
+#
+# CODEC_SHM isn't a codec that can be picked. Transport sends large
+# payloads to peers on the same host as handles of shared memory
+# blocks (see transport_shm.py), and the receiver maps them and
+# decodes them with the codec named in the handle.
+#
+# The "reference" codec doesn't serialize at all: its payload frames
+# are the ntuples themselves. It only works with the in-process
+# backend (see transport_loopback.py), where frames never leave the
+# process.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import json
+import marshal
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC = b'\xffT'
+HEADER_VERSION = 1
+
+# Fixed part of the header frame.
+_HEADER = struct.Struct('!2sBBB')
+
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+CODEC_MARSHAL = 2
+CODEC_SHM = 3  # Payloads are handles of shared memory blocks, see transport_shm.py.
+CODEC_REFERENCE = 255  # In-process only, never on the wire.
+
+# Header flags.
+FLAG_REQUEST = 0x01   # Transport.request(); the sender waits for a reply.
+FLAG_REPLY = 0x02     # Reply to the request with the same correlation id.
+FLAG_ERROR = 0x04     # With FLAG_REPLY: the payload is an error message.
+FLAG_BATCH = 0x08     # Every frame after the header is a message.
+FLAG_COMPRESSED = 0x10  # Every frame after the header is zlib compressed.
+FLAG_URGENT = 0x20    # High priority; handled before normal messages.
+FLAG_DEADLINE = 0x40  # The header has a deadline.
+FLAG_EXPIRED = 0x80   # The payload reports messages that missed their deadline.
+
+_CORRELATION_FLAGS = FLAG_REQUEST | FLAG_REPLY
+
+_DEADLINE = struct.Struct('!d')
+
+class Header(object):
+    '''Decoded Transport header. correlation_id is a uuid.UUID or None, deadline seconds since the epoch or None.'''
+    __slots__ = ['codec_id', 'flags', 'correlation_id', 'deadline']
+
+    def __init__(self, codec_id=CODEC_JSON, flags=0, correlation_id=None, deadline=None):
+        self.codec_id = codec_id
+        self.flags = flags
+        self.correlation_id = correlation_id
+        self.deadline = deadline
+    # __init__()
+# class Header
+
+# Header of a bare JSON message.
+_BARE_HEADER = Header()
+
+class CodecError(Exception):
+    '''Raised if a message can't be encoded or decoded.'''
+    pass
+
+class Codec(object):
+    '''Base class for wire codecs. Subclasses set name and codec_id and implement encode() and decode().'''
+    name = None
+    codec_id = None
+
+    def encode(self, obj):
+        '''Return obj serialized as bytes.'''
+        raise NotImplementedError()
+    # encode()
+
+    def decode(self, data):
+        '''Return the object serialized in data (bytes or memoryview). Raises CodecError if data can't be decoded.'''
+        raise NotImplementedError()
+    # decode()
+# class Codec
+
+class JSONCodec(Codec):
+    '''The original Transport encoding. Readable by every agent.'''
+    name = 'json'
+    codec_id = CODEC_JSON
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+    # encode()
+
+    def decode(self, data):
+        try:
+            return json.loads(bytes(data).decode('utf-8'))
+        except ValueError as e:
+            raise CodecError('Cannot decode JSON payload: %s'%(e))
+    # decode()
+# class JSONCodec
+
+class MsgpackCodec(Codec):
+    '''Compact binary encoding. Requires the msgpack package.'''
+    name = 'msgpack'
+    codec_id = CODEC_MSGPACK
+
+    def __init__(self):
+        if msgpack is None:
+            raise CodecError('The msgpack codec requires the msgpack package.')
+    # __init__()
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+    # encode()
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except (msgpack.UnpackException, ValueError, TypeError) as e:
+            raise CodecError('Cannot decode msgpack payload: %s'%(e))
+    # decode()
+# class MsgpackCodec
+
+class MarshalCodec(Codec):
+    '''Compact binary encoding using only the standard library. See the note at the top of this file about trust.'''
+    name = 'marshal'
+    codec_id = CODEC_MARSHAL
+
+    def encode(self, obj):
+        try:
+            return marshal.dumps(obj)
+        except ValueError as e:
+            raise CodecError('Cannot marshal ntuple: %s'%(e))
+    # encode()
+
+    def decode(self, data):
+        try:
+            return marshal.loads(data)
+        except (EOFError, ValueError, TypeError) as e:
+            raise CodecError('Cannot unmarshal payload: %s'%(e))
+    # decode()
+# class MarshalCodec
+
+class ReferenceCodec(Codec):
+    '''Passes objects through untouched. Only for the in-process backend.'''
+    name = 'reference'
+    codec_id = CODEC_REFERENCE
+
+    def encode(self, obj):
+        return obj
+    # encode()
+
+    def decode(self, data):
+        return data
+    # decode()
+# class ReferenceCodec
+
+def frame_size(frame):
+    '''Return the size in bytes of an encoded frame. Frames of the reference codec count as 0.'''
+    if isinstance(frame, (bytes, bytearray, memoryview)):
+        return len(frame)
+    return 0
+# frame_size()
+
+class LazyNtuple(object):
+    '''An ntuple that's decoded on first use. Item and attribute access (n['type'], n.keys(), ...) go to the decoded value; peek() reads one top-level field, cheaply for JSON. raw is the encoded payload, codec_id its codec.'''
+    __slots__ = ['codec_id', 'raw', '_value', '_decoded']
+
+    def __init__(self, codec_id, raw, value=None, decoded=False):
+        self.codec_id = codec_id
+        self.raw = raw
+        self._value = value
+        self._decoded = decoded
+    # __init__()
+
+    def decoded(self):
+        '''Return true if the payload has been decoded.'''
+        return self._decoded
+    # decoded()
+
+    @property
+    def value(self):
+        '''The decoded ntuple.'''
+        if not self._decoded:
+            self._value = get_codec(self.codec_id).decode(self.raw)
+            self._decoded = True
+        return self._value
+    # value()
+
+    def peek(self, key, default=None):
+        '''Return the top-level field key of a dict ntuple (default if it's missing or the ntuple isn't a dict). Doesn't decode the whole payload if it's JSON.'''
+        if not self._decoded and self.codec_id == CODEC_JSON:
+            try:
+                return _json_peek(bytes(self.raw).decode('utf-8'), key, default)
+            except (ValueError, IndexError):
+                # Malformed; let the full decode raise.
+                pass
+        value = self.value
+        if isinstance(value, dict):
+            return value.get(key, default)
+        return default
+    # peek()
+
+    def __getattr__(self, name):
+        # Only called for names that aren't ours. Private and special
+        # names (looked up by copy, pickle, ...) aren't passed on.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.value, name)
+    # __getattr__()
+
+    def __getitem__(self, key):
+        return self.value[key]
+    # __getitem__()
+
+    def __contains__(self, key):
+        return key in self.value
+    # __contains__()
+
+    def __iter__(self):
+        return iter(self.value)
+    # __iter__()
+
+    def __len__(self):
+        return len(self.value)
+    # __len__()
+
+    def __eq__(self, other):
+        if isinstance(other, LazyNtuple):
+            other = other.value
+        return self.value == other
+    # __eq__()
+
+    def __ne__(self, other):
+        return not self == other
+    # __ne__()
+
+    __hash__ = None
+
+    def __repr__(self):
+        if not self._decoded:
+            return 'LazyNtuple(codec %d, %d bytes)'%(self.codec_id, frame_size(self.raw))
+        return 'LazyNtuple(%r)'%(self._value)
+    # __repr__()
+# class LazyNtuple
+
+_json_decoder = json.JSONDecoder()
+_json_space = json.decoder.WHITESPACE.match
+
+def _json_peek(text, key, default):
+    '''Return the value of top-level key in the JSON object text, parsing only the members before it. Raises ValueError or IndexError if text is malformed.'''
+    i = _json_space(text, 0).end()
+    if text[i] != '{':
+        return default
+    i = _json_space(text, i + 1).end()
+    if text[i] == '}':
+        return default
+    while True:
+        if text[i] != '"':
+            raise ValueError('Expected a key at %d'%(i))
+        (name, i) = json.decoder.scanstring(text, i + 1)
+        i = _json_space(text, i).end()
+        if text[i] != ':':
+            raise ValueError('Expected ":" at %d'%(i))
+        i = _json_space(text, i + 1).end()
+        # raw_decode() parses the value in C; for other keys it's just
+        # a way to find where the value ends.
+        (value, i) = _json_decoder.raw_decode(text, i)
+        if name == key:
+            return value
+        i = _json_space(text, i).end()
+        if text[i] == '}':
+            return default
+        if text[i] != ',':
+            raise ValueError('Expected "," at %d'%(i))
+        i = _json_space(text, i + 1).end()
+# _json_peek()
+
+# CPU time of the calling thread, where the platform supports it.
+_cputime = getattr(time, 'thread_time', time.time)
+
+class Compressor(object):
+    '''zlib compression of payloads of at least threshold bytes, with counters for tuning the threshold. A threshold of None never compresses, but still counts decompression.'''
+
+    def __init__(self, threshold=None, level=6):
+        self.threshold = threshold
+        self.level = level
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(['compressed', 'skipped', 'incompressible', 'bytes_in', 'bytes_out', 'compress_cpu', 'decompressed', 'decompressed_bytes_in', 'decompressed_bytes_out', 'decompress_cpu'], 0)
+    # __init__()
+
+    def wants(self, payloads):
+        '''Return true if payloads are worth compressing.'''
+        if self.threshold is None:
+            return False
+        if sum([len(p) for p in payloads]) >= self.threshold:
+            return True
+        with self._lock:
+            self._counts['skipped'] += 1
+        return False
+    # wants()
+
+    def compress(self, payloads):
+        '''Return the compressed payloads, or None if compression didn't make them smaller.'''
+        start = _cputime()
+        compressed = [zlib.compress(p, self.level) for p in payloads]
+        elapsed = _cputime() - start
+        size_in = sum([len(p) for p in payloads])
+        size_out = sum([len(p) for p in compressed])
+        with self._lock:
+            c = self._counts
+            c['compress_cpu'] += elapsed
+            if size_out >= size_in:
+                c['incompressible'] += 1
+                return None
+            c['compressed'] += 1
+            c['bytes_in'] += size_in
+            c['bytes_out'] += size_out
+        return compressed
+    # compress()
+
+    def decompress(self, payloads):
+        start = _cputime()
+        try:
+            plain = [zlib.decompress(p) for p in payloads]
+        except zlib.error as e:
+            raise CodecError('Corrupt compressed payload: %s'%(e))
+        elapsed = _cputime() - start
+        with self._lock:
+            c = self._counts
+            c['decompressed'] += 1
+            c['decompressed_bytes_in'] += sum([len(p) for p in payloads])
+            c['decompressed_bytes_out'] += sum([len(p) for p in plain])
+            c['decompress_cpu'] += elapsed
+        return plain
+    # decompress()
+
+    def stats(self):
+        '''Return a dict of counters. ratio is compressed/original size of what was sent compressed (lower is better), or None if nothing was.'''
+        with self._lock:
+            c = dict(self._counts)
+        c['threshold'] = self.threshold
+        c['ratio'] = float(c['bytes_out'])/c['bytes_in'] if c['bytes_in'] else None
+        return c
+    # stats()
+# class Compressor
+
+# Used to decompress when the caller doesn't keep statistics.
+_default_compressor = Compressor()
+
+# dict of codec id => Codec instance, filled in lazily by get_codec().
+_codecs_by_id = {}
+
+# dict of codec name => Codec class
+_codec_classes = {
+    JSONCodec.name: JSONCodec,
+    MsgpackCodec.name: MsgpackCodec,
+    MarshalCodec.name: MarshalCodec,
+    ReferenceCodec.name: ReferenceCodec,
+}
+
+def register_codec(cls):
+    '''Make a Codec subclass available by name and id. The id must fit in one byte and not clash with an existing codec.'''
+    for other in _codec_classes.values():
+        if other.codec_id == cls.codec_id and other is not cls:
+            raise CodecError('Codec id %d is already used by %s'%(cls.codec_id, other.name))
+    _codec_classes[cls.name] = cls
+    return cls
+# register_codec()
+
+def get_codec(codec):
+    '''Return a Codec instance given a name, a codec id, or a Codec instance. The name "binary" is marshal everywhere (see notes above).'''
+    if isinstance(codec, Codec):
+        return codec
+    if codec == 'binary':
+        codec = 'marshal'
+    if isinstance(codec, int):
+        if codec in _codecs_by_id:
+            return _codecs_by_id[codec]
+        matches = [c for c in _codec_classes.values() if c.codec_id == codec]
+        if not matches:
+            raise CodecError('Unknown codec id %d'%(codec))
+        cls = matches[0]
+    elif codec in _codec_classes:
+        cls = _codec_classes[codec]
+        if cls.codec_id in _codecs_by_id:
+            return _codecs_by_id[cls.codec_id]
+    else:
+        raise CodecError('Unknown codec "%s"'%(codec))
+    instance = cls()
+    _codecs_by_id[cls.codec_id] = instance
+    return instance
+# get_codec()
+
+def pack_header(codec_id, flags=0, correlation_id=None, deadline=None):
+    '''Return a header frame. correlation_id (a uuid.UUID) is required if flags include FLAG_REQUEST or FLAG_REPLY. A deadline (seconds since the epoch) sets FLAG_DEADLINE.'''
+    if deadline is not None:
+        flags |= FLAG_DEADLINE
+    header = _HEADER.pack(MAGIC, HEADER_VERSION, codec_id, flags)
+    if flags & _CORRELATION_FLAGS:
+        header += correlation_id.bytes
+    if deadline is not None:
+        header += _DEADLINE.pack(deadline)
+    return header
+# pack_header()
+
+def pack_payloads(codec_id, payloads, flags=0, correlation_id=None, compressor=None, deadline=None):
+    '''Return the list of frames for already encoded payloads. More than one payload becomes a batch message. If compressor is given and decides the payloads are big enough, they're compressed. deadline applies to every payload.'''
+    if compressor is not None and compressor.wants(payloads):
+        compressed = compressor.compress(payloads)
+        if compressed is not None:
+            payloads = compressed
+            flags |= FLAG_COMPRESSED
+    if len(payloads) > 1:
+        flags |= FLAG_BATCH
+    elif codec_id == CODEC_JSON and flags == 0 and deadline is None:
+        # Plain JSON messages are a single bare frame so older
+        # agents can read them.
+        return list(payloads)
+    return [pack_header(codec_id, flags, correlation_id, deadline)] + list(payloads)
+# pack_payloads()
+
+def encode_message(codec, obj, flags=0, correlation_id=None, compressor=None):
+    '''Return the list of frames carrying obj encoded with codec.'''
+    return pack_payloads(codec.codec_id, [codec.encode(obj)], flags, correlation_id, compressor)
+# encode_message()
+
+def encode_batch(codec, objs, compressor=None):
+    '''Return the list of frames carrying all of objs (at least one) as a single message.'''
+    return pack_payloads(codec.codec_id, [codec.encode(obj) for obj in objs], compressor=compressor)
+# encode_batch()
+
+def has_header(frames):
+    '''Return true if frames start with a Transport header frame.'''
+    return len(frames) > 1 and frames[0][:2] == MAGIC
+# has_header()
+
+# Every flags byte with FLAG_URGENT set, so is_urgent() needn't
+# unpack it.
+_URGENT_FLAGS = frozenset([struct.pack('!B', flags) for flags in range(256) if flags & FLAG_URGENT])
+
+def is_urgent(frame):
+    '''Return true if frame is a header frame with FLAG_URGENT set. Cheap enough to call on every message before decoding it.'''
+    return frame[:2] == MAGIC and frame[4:5] in _URGENT_FLAGS
+# is_urgent()
+
+def unpack_header(frames):
+    '''Return the Header of the message in frames. Bare JSON messages get a default header.'''
+    if not has_header(frames):
+        return _BARE_HEADER
+    header = frames[0]
+    if len(header) < _HEADER.size:
+        raise CodecError('Truncated Transport header (%d bytes)'%(len(header)))
+    (magic, version, codec_id, flags) = _HEADER.unpack_from(header)
+    if version != HEADER_VERSION:
+        raise CodecError('Unsupported Transport header version %d'%(version))
+    correlation_id = None
+    offset = _HEADER.size
+    if flags & _CORRELATION_FLAGS:
+        if len(header) < offset + 16:
+            raise CodecError('Truncated correlation id in Transport header')
+        correlation_id = uuid.UUID(bytes=bytes(header[offset:offset+16]))
+        offset += 16
+    deadline = None
+    if flags & FLAG_DEADLINE:
+        if len(header) < offset + _DEADLINE.size:
+            raise CodecError('Truncated deadline in Transport header')
+        (deadline,) = _DEADLINE.unpack_from(header, offset)
+    return Header(codec_id, flags, correlation_id, deadline)
+# unpack_header()
+
+def payload_frames(header, frames, compressor=None):
+    '''Return the list of encoded (and decompressed) payloads in frames, given their already unpacked header. compressor, if given, only keeps statistics.'''
+    if header is _BARE_HEADER:
+        return [frames[0]]
+    payloads = frames[1:]
+    if header.flags & FLAG_COMPRESSED:
+        if compressor is None:
+            compressor = _default_compressor
+        payloads = compressor.decompress(payloads)
+    return payloads
+# payload_frames()
+
+def decode_payload(header, frames, compressor=None):
+    '''Return the object carried in frames, given their already unpacked header.'''
+    return get_codec(header.codec_id).decode(payload_frames(header, frames, compressor)[0])
+# decode_payload()
+
+def decode_messages(header, frames, compressor=None):
+    '''Return the list of objects carried in frames, given their already unpacked header. A message that isn't a batch gives a list of one.'''
+    codec = get_codec(header.codec_id)
+    return [codec.decode(payload) for payload in payload_frames(header, frames, compressor)]
+# decode_messages()
+
+def decode_message(frames):
+    '''Return the object carried in frames (as produced by encode_message()).'''
+    return decode_payload(unpack_header(frames), frames)
+# decode_message()
@@ -0,0 +1,422 @@
+######################################################################
+#
+# File: transport_discovery.py
+#
+# How Transports find each other. See the discovery argument of the
+# Transport constructor.
+#
+# Pyre finds peers with UDP beacons broadcast on port 5670. That
+# takes a second or so to converge, is noisy on shared networks and
+# doesn't work at all where broadcast is unavailable (most container
+# networks). The backends here are alternatives:
+#
+#   BeaconDiscovery(port)       Pyre's UDP beacons, on any port. The
+#                               default (with port 5670).
+#   StaticDiscovery(peers)      A fixed table of Transport name =>
+#                               endpoint, e.g. from a config file.
+#   RegistryDiscovery(path)     A directory where each Transport
+#                               registers its endpoint, e.g. on a
+#                               volume shared by the containers of a
+#                               deployment.
+#
+# Each can also be given as a string, e.g. in the ECG_DISCOVERY
+# environment variable read by CoreAgent:
+#
+#   beacon                      (or beacon:5671)
+#   static:A=tcp://10.0.0.1:5701,B=tcp://10.0.0.2:5701
+#   static:/etc/nluas/peers     (lines of "name endpoint")
+#   registry:/var/run/nluas
+#
+# NOTES:
+#
+# Without beacons, a Transport binds a known endpoint and connects to
+# the endpoints its backend lists, at start and then once a second
+# (so peers that start later, or restart, are found). Pyre's HELLO
+# handshake does the rest: a peer that is connected to connects back,
+# so it's enough for either side to know the other's endpoint.
+# Startup therefore doesn't depend on timing, and peers are seen as
+# soon as their TCP connection is up.
+#
+# A static table entry fixes both the endpoint a Transport (named by
+# its full Pyre name, including any prefix) listens on and its UUID,
+# which is derived from the endpoint. A Transport that isn't in the
+# table listens on a random port and connects to everyone in it; the
+# peers in the table then find it, but two such Transports never see
+# each other.
+#
+# Endpoints are tcp with an IP address, since ENTER events must carry
+# one (see enter_ip() in Transport.py). Host names in a static table
+# are resolved when it's read.
+#
+# Without beacons there's also no goodbye beacon, and Pyre has no
+# other way to say a node is leaving. A stopping Transport leaves all
+# its groups instead, so peers stop routing to it at once; they see
+# it EXIT when it stops answering pings (30 seconds).
+#
+# Each kind of federation (prefix, port, registry directory, table)
+# is independent, so any of them can separate federations.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import json
+import logging
+import os
+import re
+import socket
+import time
+import uuid
+
+from pyre import Pyre
+from pyre import zhelper
+from pyre.pyre_node import PyreNode, REAP_INTERVAL, ZRE_DISCOVERY_PORT
+from pyre.zactor import ZActor
+from pyre.zre_msg import ZreMsg
+import zmq
+
+from nluas import transport_shm
+
+logger = logging.getLogger('Transport')
+
+# UUIDs of Transports in a static table are uuid5(_NAMESPACE, endpoint).
+_NAMESPACE = uuid.UUID('8d3c1a2e-4b7f-5e0a-9c61-2f5d7b3e9a10')
+
+# How long a stopping node keeps trying to deliver its LEAVEs.
+_LEAVE_LINGER = 100
+
+class DiscoveryError(Exception):
+    '''Raised for a malformed discovery spec or table, or if a node can't listen on its endpoint.'''
+    pass
+
+def _split_endpoint(endpoint):
+    '''Return (ip, port) from "tcp://host:port", resolving host.'''
+    match = re.match(r'tcp://([^:/]+):([0-9]+)$', endpoint)
+    if not match:
+        raise DiscoveryError('Endpoint %s is not of the form tcp://host:port'%(endpoint))
+    try:
+        ip = socket.gethostbyname(match.group(1))
+    except socket.error as e:
+        raise DiscoveryError('Cannot resolve %s: %s'%(endpoint, e))
+    return (ip, int(match.group(2)))
+# _split_endpoint()
+
+class Discovery(object):
+    '''Base class for the ways a Transport finds its peers. One instance can serve several Transports. Its methods are called from Pyre's node thread.'''
+
+    def configure(self, name):
+        '''Return (interface to bind, port or None for any, host to advertise, UUID or None for any) for the node named name, or None to use UDP beacons.'''
+        raise NotImplementedError()
+    # configure()
+
+    def register(self, name, identity, endpoint):
+        '''The node named name is listening on endpoint.'''
+        pass
+    # register()
+
+    def peers(self):
+        '''Return a list of (UUID, endpoint) of the nodes to connect to. May include the caller.'''
+        return []
+    # peers()
+
+    def unregister(self, identity):
+        '''The node with the UUID identity is stopping.'''
+        pass
+    # unregister()
+# class Discovery
+
+class BeaconDiscovery(Discovery):
+    '''Pyre's UDP beacons, on port (5670 by default). Transports only see peers that beacon on the same port.'''
+
+    def __init__(self, port=ZRE_DISCOVERY_PORT):
+        self.port = int(port)
+    # __init__()
+
+    def configure(self, name):
+        return None
+    # configure()
+
+    def __repr__(self):
+        return 'beacon:%d'%(self.port)
+    # __repr__()
+# class BeaconDiscovery
+
+class StaticDiscovery(Discovery):
+    '''A fixed table of peers. peers is a dict of Pyre name => "tcp://host:port". host is the address Transports not in the table advertise.'''
+
+    def __init__(self, peers, host='127.0.0.1'):
+        self.host = host
+        # dict of name => (ip, port, endpoint, uuid)
+        self._table = {}
+        for (name, endpoint) in peers.items():
+            (ip, port) = _split_endpoint(endpoint)
+            endpoint = 'tcp://%s:%d'%(ip, port)
+            self._table[name] = (ip, port, endpoint, uuid.uuid5(_NAMESPACE, endpoint))
+        endpoints = [entry[2] for entry in self._table.values()]
+        if len(set(endpoints)) != len(endpoints):
+            raise DiscoveryError('Two Transports in a static discovery table share an endpoint')
+        self._peers = [(entry[3], entry[2]) for entry in self._table.values()]
+    # __init__()
+
+    @classmethod
+    def from_file(cls, path, host='127.0.0.1'):
+        '''Read a table of "name endpoint" lines. Blank lines and # comments are ignored.'''
+        peers = {}
+        with open(path) as f:
+            for (lineno, line) in enumerate(f, 1):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                fields = line.split()
+                if len(fields) != 2:
+                    raise DiscoveryError('%s:%d: expected "name endpoint"'%(path, lineno))
+                peers[fields[0]] = fields[1]
+        return cls(peers, host)
+    # from_file()
+
+    def configure(self, name):
+        entry = self._table.get(name)
+        if entry is None:
+            return (self.host, None, self.host, None)
+        # Listen on every interface, since the table's address may be
+        # translated (e.g. by a container network).
+        return ('*', entry[1], entry[0], entry[3])
+    # configure()
+
+    def peers(self):
+        return self._peers
+    # peers()
+
+    def __repr__(self):
+        return 'static:%s'%(','.join(['%s=%s'%(name, self._table[name][2]) for name in sorted(self._table)]))
+    # __repr__()
+# class StaticDiscovery
+
+class RegistryDiscovery(Discovery):
+    '''A directory (created if needed) where each Transport writes its endpoint while it runs. host is the address they listen on and advertise: the default only reaches Transports on this host.'''
+
+    def __init__(self, path, host='127.0.0.1'):
+        self.path = path
+        self.host = host
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise DiscoveryError('Cannot create discovery registry %s'%(path))
+        self._hostname = socket.gethostname()
+    # __init__()
+
+    def configure(self, name):
+        return (self.host, None, self.host, None)
+    # configure()
+
+    def _entry(self, identity):
+        return os.path.join(self.path, identity.hex)
+    # _entry()
+
+    def register(self, name, identity, endpoint):
+        # Written under another name and renamed, so readers never see
+        # half an entry.
+        path = self._entry(identity)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'name': name, 'endpoint': endpoint, 'pid': os.getpid(), 'host': self._hostname}, f)
+        os.rename(tmp, path)
+    # register()
+
+    def peers(self):
+        peers = []
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            logger.warning('Cannot read discovery registry %s: %s'%(self.path, e))
+            return peers
+        for name in names:
+            try:
+                identity = uuid.UUID(hex=name)
+            except ValueError:
+                # .tmp files, and anything else that isn't ours.
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except (IOError, OSError, ValueError):
+                # Unregistered since we listed it.
+                continue
+            if entry.get('host') == self._hostname and not transport_shm.pid_alive(entry.get('pid', 0)):
+                # Left behind by a Transport that crashed.
+                transport_shm.unlink(path)
+                continue
+            peers.append((identity, entry['endpoint']))
+        return peers
+    # peers()
+
+    def unregister(self, identity):
+        transport_shm.unlink(self._entry(identity))
+    # unregister()
+
+    def __repr__(self):
+        return 'registry:%s'%(self.path)
+    # __repr__()
+# class RegistryDiscovery
+
+def get_discovery(spec):
+    '''Return a Discovery given a Discovery instance or a spec string (see the top of this file).'''
+    if isinstance(spec, Discovery):
+        return spec
+    (kind, _, arg) = spec.partition(':')
+    if kind == 'beacon':
+        if not arg:
+            return BeaconDiscovery()
+        try:
+            return BeaconDiscovery(arg)
+        except ValueError:
+            raise DiscoveryError('Bad beacon port in discovery spec %s'%(spec))
+    if kind == 'static' and arg:
+        if '=' not in arg:
+            return StaticDiscovery.from_file(arg)
+        try:
+            return StaticDiscovery(dict([item.split('=', 1) for item in arg.split(',')]))
+        except ValueError:
+            raise DiscoveryError('Bad discovery spec %s, expected static:name=endpoint,...'%(spec))
+    if kind == 'registry' and arg:
+        return RegistryDiscovery(arg)
+    raise DiscoveryError('Unknown discovery spec %s'%(spec))
+# get_discovery()
+
+class _DiscoveryNode(PyreNode):
+    '''PyreNode that finds peers through a Discovery instead of (or as well as configuring) UDP beacons.'''
+
+    def __init__(self, ctx, pipe, outbox, discovery):
+        self._discovery = discovery
+        self._config = None
+        # PyreNode.__init__() runs the node until it's terminated.
+        PyreNode.__init__(self, ctx, pipe, outbox)
+    # __init__()
+
+    def start(self):
+        config = self._discovery.configure(self.name)
+        if config is None:
+            self.beacon_port = self._discovery.port
+            PyreNode.start(self)
+            return
+        (interface, port, host, identity) = config
+        if identity is not None:
+            self.identity = identity
+        self.beacon_port = 0
+        try:
+            if port is None:
+                port = self.inbox.bind_to_random_port('tcp://%s'%(interface))
+            else:
+                self.inbox.bind('tcp://%s:%d'%(interface, port))
+        except zmq.ZMQError as e:
+            # Pyre.start() is waiting, so report it through ENDPOINT
+            # rather than dying. See DiscoveryPyre.start().
+            logger.error('Cannot listen on %s port %s: %s'%(interface, port, e))
+            return
+        self.port = port
+        self.bound = True
+        self.endpoint = 'tcp://%s:%d'%(host, port)
+        self._config = config
+        self.poller.register(self.inbox, zmq.POLLIN)
+        self._discovery.register(self.name, self.identity, self.endpoint)
+        self._discover()
+    # start()
+
+    def _discover(self):
+        for (identity, endpoint) in self._discovery.peers():
+            if identity != self.identity and endpoint != self.endpoint and identity not in self.peers:
+                self.require_peer(identity, endpoint)
+    # _discover()
+
+    def stop(self):
+        if self._config is not None:
+            self._config = None
+            self._discovery.unregister(self.identity)
+            # There's no goodbye beacon, so leave every group.
+            for group in list(self.own_groups):
+                msg = ZreMsg(ZreMsg.LEAVE)
+                msg.set_group(group)
+                self.status += 1
+                msg.set_status(self.status)
+                for peer in self.peers.values():
+                    if peer.mailbox is not None:
+                        peer.mailbox.setsockopt(zmq.LINGER, _LEAVE_LINGER)
+                    peer.send(msg)
+        PyreNode.stop(self)
+    # stop()
+
+    def remove_peer(self, peer):
+        if peer.get_ready():
+            PyreNode.remove_peer(self, peer)
+            return
+        # A peer we connected to that never said HELLO. The application
+        # hasn't seen it ENTER, so it mustn't see it EXIT.
+        for group in self.peer_groups.values():
+            group.leave(peer)
+        self.peers.pop(peer.get_identity())
+        peer.disconnect()
+    # remove_peer()
+
+    def run(self):
+        # PyreNode.run(), discovering along with the reaping.
+        self._pipe.signal()
+        reap_at = time.time() + REAP_INTERVAL
+        while not self._terminated:
+            timeout = reap_at - time.time()
+            if timeout < 0:
+                timeout = 0
+            items = dict(self.poller.poll(timeout * 1000))
+            if self._pipe in items and items[self._pipe] == zmq.POLLIN:
+                self.recv_api()
+            if self.inbox in items and items[self.inbox] == zmq.POLLIN:
+                self.recv_peer()
+            if self.beacon_socket in items and items[self.beacon_socket] == zmq.POLLIN:
+                self.recv_beacon()
+            if time.time() >= reap_at:
+                reap_at = time.time() + REAP_INTERVAL
+                for peer_id in list(self.peers.keys()):
+                    self.ping_peer(peer_id)
+                if self._config is not None:
+                    self._discover()
+        # Unlike PyreNode, close our sockets, so the context can be
+        # terminated. See DiscoveryPyre.stop().
+        for peer in self.peers.values():
+            peer.disconnect()
+        self.inbox.close()
+    # run()
+# class _DiscoveryNode
+
+class DiscoveryPyre(Pyre):
+    '''A Pyre node that finds its peers through discovery (a Discovery).'''
+
+    def __init__(self, name, discovery):
+        # Pyre.__init__(), except for the node it starts.
+        self._ctx = zmq.Context()
+        self._uuid = None
+        self._name = name
+        self.verbose = False
+        self.inbox, self._outbox = zhelper.zcreate_pipe(self._ctx)
+        self.actor = ZActor(self._ctx, _DiscoveryNode, self._outbox, discovery)
+        self.actor.send_unicode('SET NAME', zmq.SNDMORE)
+        self.actor.send_unicode(name)
+    # __init__()
+
+    def start(self):
+        Pyre.start(self)
+        self.actor.send_unicode('ENDPOINT')
+        if not self.actor.recv_unicode():
+            raise DiscoveryError('Pyre node %s could not start listening, see the log'%(self._name))
+    # start()
+
+    def stop(self):
+        Pyre.stop(self)
+        # Pyre leaves its sockets open, so its context (and so the
+        # process) can hang when it's garbage collected.
+        self.inbox.close()
+        self._outbox.close()
+        self._ctx.term()
+    # stop()
+# class DiscoveryPyre
@@ -0,0 +1,356 @@
+######################################################################
+#
+# File: transport_dispatch.py
+#
+# Execution policies for Transport subscriber callbacks.
+#
+# Transport's reader thread decodes each incoming message and hands
+# it to the dispatcher of every matching subscription. The dispatcher
+# decides where the callback runs:
+#
+#   inline  In the reader thread itself (the original behavior). A slow
+#           callback stalls every other channel.
+#   thread  In a thread dedicated to this subscription.
+#   pool    In a thread from a pool shared by all "pool" subscriptions
+#           of a Transport. Messages for one subscription are still
+#           delivered one at a time and in order, unless the
+#           dispatcher is created with ordered=False (used for request
+#           handlers, which may run concurrently).
+#
+# The thread and pool dispatchers buffer pending messages in a bounded
+# queue. When the queue is full, the overflow policy decides what
+# happens to a new message:
+#
+#   block        The reader thread waits for room. Backpressure
+#                spreads to every channel of the Transport.
+#   drop_oldest  The oldest pending message is discarded.
+#   reject       The new message is discarded.
+#
+# Dropped messages are logged and counted (see DispatchQueue.dropped).
+#
+# Urgent messages (see Transport.send(priority='high')) go in a second
+# lane of the queue and are delivered before normal ones, but never
+# more than max_overtake in a row while normal messages wait, so
+# normal traffic isn't starved. DispatchQueue.overtaken counts how
+# often an urgent message went first.
+#
+# Exceptions raised by callbacks in thread or pool dispatchers are
+# logged and don't stop delivery of later messages. Inline callbacks
+# behave as before.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import collections
+import logging
+import threading
+import time
+
+from six.moves import queue
+
+logger = logging.getLogger('Transport')
+
+INLINE = 'inline'
+THREAD = 'thread'
+POOL = 'pool'
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+REJECT = 'reject'
+
+POLICIES = (INLINE, THREAD, POOL)
+OVERFLOWS = (BLOCK, DROP_OLDEST, REJECT)
+
+# Default number of messages a thread or pool subscription can buffer.
+DEFAULT_MAXSIZE = 1000
+
+# Default number of urgent messages a queue delivers in a row while
+# normal ones wait.
+DEFAULT_MAX_OVERTAKE = 16
+
+class DispatchQueue(object):
+    '''Bounded FIFO of pending callback invocations with an overflow policy, and a second lane for urgent items.'''
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, overflow=BLOCK, max_overtake=DEFAULT_MAX_OVERTAKE):
+        if overflow not in OVERFLOWS:
+            raise ValueError('Unknown overflow policy "%s". Use one of %s.'%(overflow, ', '.join(OVERFLOWS)))
+        if maxsize < 1:
+            raise ValueError('Dispatch queue size must be at least 1.')
+        if max_overtake < 1:
+            raise ValueError('Dispatch queue max_overtake must be at least 1.')
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.max_overtake = max_overtake
+        # Number of messages discarded because of overflow.
+        self.dropped = 0
+        # Number of urgent items delivered ahead of waiting normal ones.
+        self.overtaken = 0
+        self._items = collections.deque()
+        self._urgent = collections.deque()
+        # Urgent items delivered in a row while normal ones waited.
+        self._run = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+    # __init__()
+
+    def __len__(self):
+        return len(self._items) + len(self._urgent)
+    # __len__()
+
+    def urgent(self):
+        '''Return the number of pending urgent items.'''
+        return len(self._urgent)
+    # urgent()
+
+    def put(self, item, urgent=False):
+        '''Add item, to the urgent lane if urgent. Returns False if item was discarded (queue closed or rejected).'''
+        with self._cond:
+            if self._closed:
+                return False
+            if len(self) >= self.maxsize:
+                if self.overflow == REJECT:
+                    self.dropped += 1
+                    return False
+                elif self.overflow == DROP_OLDEST:
+                    # Normal items go first.
+                    (self._items or self._urgent).popleft()
+                    self.dropped += 1
+                else:
+                    while len(self) >= self.maxsize and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        return False
+            if urgent:
+                self._urgent.append(item)
+            else:
+                self._items.append(item)
+            self._cond.notify_all()
+            return True
+    # put()
+
+    def get(self, block=True):
+        '''Remove and return the next item: the oldest urgent one, unless max_overtake urgent items in a row have gone ahead of a normal one, else the oldest normal one. Returns None if the queue is empty and either closed or block is False.'''
+        with self._cond:
+            while not self._items and not self._urgent:
+                if self._closed or not block:
+                    return None
+                self._cond.wait()
+            if self._urgent and (not self._items or self._run < self.max_overtake):
+                item = self._urgent.popleft()
+                if self._items:
+                    self._run += 1
+                    self.overtaken += 1
+            else:
+                item = self._items.popleft()
+                self._run = 0
+            self._cond.notify_all()
+            return item
+    # get()
+
+    def oldest(self):
+        '''Return the time the oldest pending item was queued, or None if there are none. Items must be tuples starting with that time.'''
+        # Workers pop items concurrently.
+        with self._cond:
+            times = [lane[0][0] for lane in (self._items, self._urgent) if lane]
+        if not times:
+            return None
+        return min(times)
+    # oldest()
+
+    def close(self):
+        '''Refuse new items and wake up any waiters. Pending items can still be read.'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+    # close()
+# class DispatchQueue
+
+def _run_item(item):
+    '''Call a queued (time queued, fn, args) item, logging rather than propagating errors.'''
+    (queued, fn, args) = item
+    try:
+        fn(*args)
+    except Exception:
+        logger.exception('Exception in Transport callback %s'%(fn))
+# _run_item()
+
+class InlineDispatcher(object):
+    '''Runs the callback immediately in the calling (reader) thread.'''
+    policy = INLINE
+    queue = None
+
+    def submit(self, fn, *args):
+        fn(*args)
+        return True
+    # submit()
+
+    def submit_urgent(self, fn, *args):
+        fn(*args)
+        return True
+    # submit_urgent()
+
+    def close(self):
+        pass
+    # close()
+# class InlineDispatcher
+
+class ThreadDispatcher(object):
+    '''Runs callbacks in order in a thread owned by this dispatcher.'''
+    policy = THREAD
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, overflow=BLOCK, name=None):
+        self.queue = DispatchQueue(maxsize, overflow)
+        self._thread = threading.Thread(target=self._worker, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+    # __init__()
+
+    def submit(self, fn, *args):
+        return self._submit(False, fn, args)
+    # submit()
+
+    def submit_urgent(self, fn, *args):
+        return self._submit(True, fn, args)
+    # submit_urgent()
+
+    def _submit(self, urgent, fn, args):
+        if not self.queue.put((time.time(), fn, args), urgent):
+            logger.warning('Transport dispatch queue full, dropped message for %s'%(fn))
+            return False
+        return True
+    # _submit()
+
+    def close(self):
+        '''Deliver what's already queued, then stop the thread.'''
+        self.queue.close()
+    # close()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            _run_item(item)
+    # _worker()
+# class ThreadDispatcher
+
+class DispatchPool(object):
+    '''A set of worker threads shared by PoolDispatchers. Workers run whichever dispatcher has pending messages.'''
+
+    def __init__(self, size=4, name=None):
+        if size < 1:
+            raise ValueError('Dispatch pool size must be at least 1.')
+        self.size = size
+        # Queue of PoolDispatchers that have pending messages. An
+        # ordered dispatcher is in here at most once at any time; an
+        # unordered one once per pending message.
+        self._ready = queue.Queue()
+        self._threads = []
+        for i in range(size):
+            t = threading.Thread(target=self._worker, name=name)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+    # __init__()
+
+    def schedule(self, dispatcher):
+        self._ready.put(dispatcher)
+    # schedule()
+
+    def close(self):
+        '''Stop the worker threads once they finish the dispatchers already scheduled.'''
+        for t in self._threads:
+            self._ready.put(None)
+    # close()
+
+    def _worker(self):
+        while True:
+            dispatcher = self._ready.get()
+            if dispatcher is None:
+                break
+            dispatcher._drain()
+    # _worker()
+# class DispatchPool
+
+class PoolDispatcher(object):
+    '''Runs callbacks on threads borrowed from a DispatchPool. If ordered, callbacks run one at a time in the order submitted. Otherwise each message may run on its own pool thread.'''
+    policy = POOL
+
+    # Maximum number of messages run per turn before giving the worker
+    # thread back to the pool, so one busy subscription can't
+    # monopolize it.
+    batch = 16
+
+    def __init__(self, pool, maxsize=DEFAULT_MAXSIZE, overflow=BLOCK, ordered=True):
+        self.queue = DispatchQueue(maxsize, overflow)
+        self.ordered = ordered
+        self._pool = pool
+        self._lock = threading.Lock()
+        # True while this dispatcher is in the pool's ready queue or
+        # being drained by a worker.
+        self._scheduled = False
+    # __init__()
+
+    def submit(self, fn, *args):
+        return self._submit(False, fn, args)
+    # submit()
+
+    def submit_urgent(self, fn, *args):
+        return self._submit(True, fn, args)
+    # submit_urgent()
+
+    def _submit(self, urgent, fn, args):
+        if not self.queue.put((time.time(), fn, args), urgent):
+            logger.warning('Transport dispatch queue full, dropped message for %s'%(fn))
+            return False
+        if not self.ordered:
+            # One turn per message, so idle pool threads can pick up
+            # the next one while this one runs.
+            self._pool.schedule(self)
+            return True
+        with self._lock:
+            if self._scheduled:
+                return True
+            self._scheduled = True
+        self._pool.schedule(self)
+        return True
+    # _submit()
+
+    def close(self):
+        self.queue.close()
+    # close()
+
+    def _drain(self):
+        if not self.ordered:
+            item = self.queue.get(block=False)
+            if item is not None:
+                _run_item(item)
+            return
+        for i in range(self.batch):
+            item = self.queue.get(block=False)
+            if item is None:
+                break
+            _run_item(item)
+        with self._lock:
+            if len(self.queue) == 0:
+                self._scheduled = False
+                return
+        # Still more to do. Go to the back of the line.
+        self._pool.schedule(self)
+    # _drain()
+# class PoolDispatcher
+
+def make_dispatcher(policy=INLINE, maxsize=DEFAULT_MAXSIZE, overflow=BLOCK, pool=None, name=None, ordered=True):
+    '''Return a dispatcher for the given execution policy. pool is required for the pool policy. ordered only affects the pool policy.'''
+    if policy == INLINE:
+        return InlineDispatcher()
+    elif policy == THREAD:
+        return ThreadDispatcher(maxsize, overflow, name=name)
+    elif policy == POOL:
+        if pool is None:
+            raise ValueError('The pool execution policy requires a DispatchPool.')
+        return PoolDispatcher(pool, maxsize, overflow, ordered)
+    raise ValueError('Unknown execution policy "%s". Use one of %s.'%(policy, ', '.join(POLICIES)))
+# make_dispatcher()
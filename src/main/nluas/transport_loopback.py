@@ -0,0 +1,219 @@
+######################################################################
+#
+# File: transport_loopback.py
+#
+# In-process stand-in for Pyre, for Transports that live in the same
+# process (tests, batch evaluation, embedded deployments). Select it
+# with Transport(name, backend='inproc').
+#
+# A LoopbackNode has the subset of the Pyre interface that Transport
+# uses, and produces the same events (ENTER, JOIN, SHOUT, WHISPER,
+# LEAVE, EXIT) in the same format, so everything above the node
+# (subscriptions, dispatch, requests, batching, stats) works
+# unchanged. Nodes find each other through a LoopbackRouter instead
+# of UDP beacons, so there's no discovery delay and no network at all.
+#
+# Messages are not serialized. Transport uses the "reference" codec
+# with this backend, so the receiving callback gets the very object
+# that was sent. If the sender or the receivers might modify it, pass
+# copy=True and every receiver gets its own deep copy, made when the
+# message is sent.
+#
+# NOTES:
+#
+# Each node's socket() is the read end of an inproc zmq pair, so
+# Transport's reader loop can poll it exactly like a Pyre socket. The
+# events themselves are kept in a deque. The pair holds one message
+# while the deque is non-empty and none while it's empty, so a burst
+# of events costs one zmq message rather than one each.
+#
+# Like Pyre, a node doesn't receive its own shouts.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import collections
+import copy
+import json
+import threading
+import uuid
+
+import zmq
+
+# What a loopback peer reports as its endpoint. Transport checks that
+# ENTER events come from an acceptable address.
+LOOPBACK_URL = 'tcp://127.0.0.1:0'
+
+class LoopbackRouter(object):
+    '''Tracks running LoopbackNodes and their groups, and delivers events between them.'''
+
+    def __init__(self):
+        # dict of UUID => LoopbackNode, for started nodes
+        self._nodes = {}
+        self._lock = threading.RLock()
+    # __init__()
+
+    def start(self, node):
+        with self._lock:
+            for other in self._nodes.values():
+                node._deliver(other._enter_event())
+                for group in other._groups:
+                    node._deliver([b'JOIN', other._uuid.bytes, other._name_bytes, group.encode('utf-8')])
+                other._deliver(node._enter_event())
+                for group in node._groups:
+                    other._deliver([b'JOIN', node._uuid.bytes, node._name_bytes, group.encode('utf-8')])
+            self._nodes[node._uuid] = node
+    # start()
+
+    def stop(self, node):
+        with self._lock:
+            if self._nodes.pop(node._uuid, None) is None:
+                return
+            for other in self._nodes.values():
+                for group in node._groups:
+                    other._deliver([b'LEAVE', node._uuid.bytes, node._name_bytes, group.encode('utf-8')])
+                other._deliver([b'EXIT', node._uuid.bytes, node._name_bytes])
+    # stop()
+
+    def group_event(self, node, eventtype, group):
+        '''Tell the other nodes that node joined or left group.'''
+        with self._lock:
+            if node._uuid not in self._nodes:
+                return
+            for other in self._nodes.values():
+                if other is not node:
+                    other._deliver([eventtype, node._uuid.bytes, node._name_bytes, group.encode('utf-8')])
+    # group_event()
+
+    def shout(self, node, group, frames):
+        with self._lock:
+            members = [n for n in self._nodes.values() if n is not node and group in n._groups]
+        prefix = [b'SHOUT', node._uuid.bytes, node._name_bytes, group.encode('utf-8')]
+        for member in members:
+            if node._copy:
+                payload = copy.deepcopy(frames)
+            else:
+                payload = frames
+            member._deliver(prefix + payload)
+    # shout()
+
+    def whisper(self, node, peer, frames):
+        with self._lock:
+            member = self._nodes.get(peer)
+        if member is None:
+            # Gone already. Pyre drops these too.
+            return
+        if node._copy:
+            frames = copy.deepcopy(frames)
+        member._deliver([b'WHISPER', node._uuid.bytes, node._name_bytes] + frames)
+    # whisper()
+# class LoopbackRouter
+
+# Used by Transports that don't ask for a specific router.
+_default_router = LoopbackRouter()
+
+def default_router():
+    '''Return the process-wide LoopbackRouter.'''
+    return _default_router
+# default_router()
+
+class LoopbackNode(object):
+    '''Drop-in replacement for the parts of pyre.Pyre that Transport uses.'''
+
+    def __init__(self, name, router=None, copy=False):
+        self._router = router if router is not None else _default_router
+        self._copy = copy
+        self._uuid = uuid.uuid4()
+        self._name = name
+        self._name_bytes = name.encode('utf-8')
+        self._groups = set()
+        self._events = collections.deque()
+        # Doorbell pair: _bell is rung when _events becomes non-empty,
+        # and recv() takes the ring back when it empties _events.
+        ctx = zmq.Context.instance()
+        self._inbox = ctx.socket(zmq.PAIR)
+        self._bell = ctx.socket(zmq.PAIR)
+        endpoint = 'inproc://transport-loopback-%s'%(self._uuid.hex)
+        self._inbox.bind(endpoint)
+        self._bell.connect(endpoint)
+        self._belllock = threading.Lock()
+    # __init__()
+
+    def uuid(self):
+        return self._uuid
+    # uuid()
+
+    def name(self):
+        return self._name
+    # name()
+
+    def join(self, group):
+        if group not in self._groups:
+            self._groups.add(group)
+            self._router.group_event(self, b'JOIN', group)
+    # join()
+
+    def leave(self, group):
+        if group in self._groups:
+            self._groups.discard(group)
+            self._router.group_event(self, b'LEAVE', group)
+    # leave()
+
+    def start(self):
+        self._router.start(self)
+    # start()
+
+    def stop(self):
+        self._router.stop(self)
+        with self._belllock:
+            if self._bell is None:
+                return
+            self._bell.close(linger=0)
+            self._bell = None
+        self._inbox.close(linger=0)
+    # stop()
+
+    def shout(self, group, frames):
+        if not isinstance(frames, list):
+            frames = [frames]
+        self._router.shout(self, group, frames)
+    # shout()
+
+    def whisper(self, peer, frames):
+        if not isinstance(frames, list):
+            frames = [frames]
+        self._router.whisper(self, peer, frames)
+    # whisper()
+
+    def shouts(self, group, string):
+        self._router.shout(self, group, [string.encode('utf-8')])
+    # shouts()
+
+    def socket(self):
+        return self._inbox
+    # socket()
+
+    def recv(self):
+        with self._belllock:
+            event = self._events.popleft()
+            if not self._events:
+                self._inbox.recv()
+        return event
+    # recv()
+
+    def _enter_event(self):
+        return [b'ENTER', self._uuid.bytes, self._name_bytes, json.dumps({}).encode('utf-8'), LOOPBACK_URL.encode('utf-8')]
+    # _enter_event()
+
+    def _deliver(self, event):
+        with self._belllock:
+            if self._bell is None:
+                # Already stopped.
+                return
+            self._events.append(event)
+            if len(self._events) == 1:
+                self._bell.send(b'')
+    # _deliver()
+# class LoopbackNode
@@ -0,0 +1,288 @@
+######################################################################
+#
+# File: transport_record.py
+#
+# Recording and replay of Transport traffic. See
+# Transport.start_recording() and Replayer below.
+#
+# A log is an append-only binary file of records, one per ntuple
+# received or sent, plus an index file (same name + '.idx') with the
+# offset and time of every record so a replay can start part way in
+# without reading everything before it.
+#
+# Log layout (network byte order):
+#
+#   8 bytes  magic, b'NLUASLOG'
+#   1 byte   log version
+#
+# then records:
+#
+#   8 bytes  time (float seconds since the epoch)
+#   1 byte   direction (RECEIVED or SENT)
+#   1 byte   codec id of the payload (see transport_codec.py)
+#   2 bytes  length of name
+#   2 bytes  length of channel
+#   4 bytes  length of payload
+#   name, channel (utf-8), payload
+#
+# name is the sender, channel the destination (for received messages,
+# the receiving Transport). Both are without the Transport prefix, as
+# in the Transport API.
+#
+# Index layout: 8 byte offset and 8 byte time per record.
+#
+# NOTES:
+#
+# The payload codec is picked when recording starts ("binary" by
+# default) and is independent of the Transport's own codec. ntuples
+# that the codec can't encode are skipped with a warning.
+#
+# Replayer.replay() is deterministic: records are delivered in log
+# order from the calling thread, so a replay at speed=None is a
+# repeatable load test.
+#
+# From the command line (run from src/main):
+#
+#   python -m nluas.transport_record dump session.log
+#   python -m nluas.transport_record replay session.log -speed 2
+#
+# replay re-sends the received messages in the log over the
+# federation, from Transports named after the original senders, so a
+# running agent (e.g. the ProblemSolver) sees the same traffic again.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+from __future__ import print_function
+
+import argparse
+import bisect
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+
+from nluas import transport_codec
+
+logger = logging.getLogger('Transport')
+
+MAGIC = b'NLUASLOG'
+LOG_VERSION = 1
+
+RECEIVED = 0
+SENT = 1
+
+_FILE_HEADER = struct.Struct('!8sB')
+_RECORD = struct.Struct('!dBBHHI')
+_INDEX = struct.Struct('!Qd')
+
+# One entry of a log. ntuple is decoded.
+LogRecord = collections.namedtuple('LogRecord', ['time', 'direction', 'name', 'channel', 'ntuple'])
+
+class RecordError(Exception):
+    '''Raised if a log is malformed.'''
+    pass
+
+def index_path(path):
+    return path + '.idx'
+# index_path()
+
+class Recorder(object):
+    '''Appends records to the log at path (creating it if needed). Thread safe.'''
+
+    def __init__(self, path, codec='binary'):
+        self.path = path
+        self._codec = transport_codec.get_codec(codec)
+        if self._codec.codec_id == transport_codec.CODEC_REFERENCE:
+            raise transport_codec.CodecError('Recordings need a codec that serializes.')
+        self.count = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._log = open(path, 'ab')
+        self._index = open(index_path(path), 'ab')
+        if self._log.tell() == 0:
+            self._log.write(_FILE_HEADER.pack(MAGIC, LOG_VERSION))
+    # __init__()
+
+    def record(self, direction, name, channel, ntuple):
+        try:
+            payload = self._codec.encode(ntuple)
+        except (transport_codec.CodecError, TypeError, ValueError) as e:
+            self.skipped += 1
+            logger.warning('Not recording ntuple from %s to %s: %s'%(name, channel, e))
+            return
+        name = name.encode('utf-8')
+        channel = channel.encode('utf-8')
+        with self._lock:
+            if self._log is None:
+                return
+            # Taken under the lock, so times in the log never go back.
+            now = time.time()
+            offset = self._log.tell()
+            self._log.write(_RECORD.pack(now, direction, self._codec.codec_id, len(name), len(channel), len(payload)))
+            self._log.write(name)
+            self._log.write(channel)
+            self._log.write(payload)
+            self._index.write(_INDEX.pack(offset, now))
+            self.count += 1
+    # record()
+
+    def flush(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.flush()
+                self._index.flush()
+    # flush()
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._index.close()
+                self._log = None
+                self._index = None
+    # close()
+# class Recorder
+
+class Replayer(object):
+    '''Reads the log at path. Use records() to iterate over it, or replay() to feed it to a Transport.'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(_FILE_HEADER.size)
+        if len(header) < _FILE_HEADER.size:
+            raise RecordError('%s is not a Transport log'%(path))
+        (magic, version) = _FILE_HEADER.unpack(header)
+        if magic != MAGIC:
+            raise RecordError('%s is not a Transport log'%(path))
+        if version != LOG_VERSION:
+            raise RecordError('Unsupported Transport log version %d in %s'%(version, path))
+    # __init__()
+
+    def _load_index(self):
+        '''Return (offsets, times) from the index, or None if there's no index.'''
+        path = index_path(self.path)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Ignore a partly written last entry.
+        n = len(data) // _INDEX.size
+        offsets = [0] * n
+        times = [0.0] * n
+        for i in range(n):
+            (offsets[i], times[i]) = _INDEX.unpack_from(data, i * _INDEX.size)
+        return (offsets, times)
+    # _load_index()
+
+    def records(self, direction=None, start=None, end=None):
+        '''Yield LogRecords in order. direction (RECEIVED or SENT) filters, start and end limit times (seconds since the epoch).'''
+        offset = _FILE_HEADER.size
+        if start is not None:
+            index = self._load_index()
+            if index is not None:
+                (offsets, times) = index
+                i = bisect.bisect_left(times, start)
+                if i == len(offsets):
+                    return
+                offset = offsets[i]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                fixed = f.read(_RECORD.size)
+                if len(fixed) < _RECORD.size:
+                    # End of log, or a record still being written.
+                    return
+                (when, dirn, codec_id, namelen, channellen, payloadlen) = _RECORD.unpack(fixed)
+                rest = f.read(namelen + channellen + payloadlen)
+                if len(rest) < namelen + channellen + payloadlen:
+                    return
+                if end is not None and when > end:
+                    return
+                if (start is not None and when < start) or (direction is not None and dirn != direction):
+                    continue
+                name = rest[:namelen].decode('utf-8')
+                channel = rest[namelen:namelen+channellen].decode('utf-8')
+                try:
+                    ntuple = transport_codec.get_codec(codec_id).decode(rest[namelen+channellen:])
+                except (transport_codec.CodecError, ValueError) as e:
+                    raise RecordError('Undecodable record at offset %d of %s: %s'%(f.tell(), self.path, e))
+                yield LogRecord(when, dirn, name, channel, ntuple)
+    # records()
+
+    def replay(self, transport, speed=1.0, direction=RECEIVED, start=None, end=None):
+        '''Feed records to transport and return how many. RECEIVED records go to its subscribers as if they had just arrived (see Transport.inject()); SENT records are sent again. speed 1.0 keeps the original timing, 2.0 is twice as fast, and None is as fast as possible.'''
+        if speed is not None and speed <= 0:
+            raise ValueError('Replay speed must be positive (or None).')
+        count = 0
+        first = None
+        began = time.time()
+        for record in self.records(direction, start, end):
+            if speed is not None:
+                if first is None:
+                    first = record.time
+                delay = began + (record.time - first) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if record.direction == RECEIVED:
+                transport.inject(record.name, record.ntuple)
+            else:
+                transport.send(record.channel, record.ntuple)
+            count += 1
+        return count
+    # replay()
+# class Replayer
+
+def _replay_federation(replayer, speed, prefix):
+    # Imported here, since Transport imports this module.
+    from nluas.Transport import Transport
+    senders = {}
+    count = 0
+    first = None
+    began = time.time()
+    for record in replayer.records(RECEIVED):
+        t = senders.get(record.name)
+        if t is None:
+            t = senders[record.name] = Transport(record.name, prefix=prefix)
+            t.set_send_buffer()
+        if speed is not None:
+            if first is None:
+                first = record.time
+            delay = began + (record.time - first) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        t.send(record.channel, record.ntuple)
+        count += 1
+    return (count, senders)
+# _replay_federation()
+
+def main():
+    parser = argparse.ArgumentParser(description='Show or replay a Transport traffic log.')
+    parser.add_argument('command', choices=['dump', 'replay'])
+    parser.add_argument('log')
+    parser.add_argument('-speed', type=float, default=1.0, help='replay speed, 0 for as fast as possible')
+    parser.add_argument('-prefix', default=None, help='Transport prefix (federation) to replay into')
+    args = parser.parse_args()
+    replayer = Replayer(args.log)
+    if args.command == 'dump':
+        for record in replayer.records():
+            print('%.6f %s %s -> %s %r'%(record.time, 'SENT' if record.direction == SENT else 'RECV', record.name, record.channel, record.ntuple))
+        return
+    (count, senders) = _replay_federation(replayer, args.speed or None, args.prefix)
+    # Wait (a while) for messages held for destinations that haven't
+    # joined yet, then give the last ones time to go out.
+    deadline = time.time() + 10
+    while time.time() < deadline and any([t.stats()['held'] for t in senders.values()]):
+        time.sleep(0.1)
+    time.sleep(0.5)
+    print('Replayed %d messages from %d senders'%(count, len(senders)))
+    os._exit(0)
+# main()
+
+if __name__ == '__main__':
+    main()
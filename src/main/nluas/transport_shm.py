@@ -0,0 +1,263 @@
+######################################################################
+#
+# File: transport_shm.py
+#
+# Shared memory side channel for large payloads between Transports on
+# the same host. See Transport.set_shared_memory().
+#
+# The sender writes a payload of at least threshold bytes to a block
+# of shared memory (a file in /dev/shm) and sends only a small handle
+# naming it, with codec id CODEC_SHM in the header (see
+# transport_codec.py). The receiver maps the block read-only and
+# decodes straight from the mapping, so the payload is neither copied
+# through zmq nor copied again before decoding (except that the JSON
+# codec needs its own copy to decode utf-8).
+#
+# Handle layout (network byte order):
+#
+#   1 byte   codec id of the payload
+#   8 bytes  payload size
+#   4 bytes  sender's process id
+#   16 bytes block id
+#
+# A block is named PREFIX + '<pid>-<block id in hex>', so the handle
+# can only ever name a file in SHM_DIR.
+#
+# NOTES:
+#
+# Cleanup is reference counted. The sender counts the receivers a
+# block was sent to, and each receiver acknowledges as soon as it has
+# mapped the block (a header-only message with codec id CODEC_SHM,
+# FLAG_REPLY and the block id as correlation id). The block is
+# unlinked when the last one has; a mapping stays valid after its
+# name is unlinked, until the receiver drops the last reference to
+# the payload.
+#
+# If a receiver crashes (or leaves) before acknowledging, the sender
+# unlinks the block anyway once its lease runs out (the sending
+# Transport's read thread calls collect() every half lease). A
+# receiver that isn't listening to the sender still maps and
+# acknowledges the block. If the sender crashes, its blocks are left
+# behind, so every SharedMemoryWriter removes blocks of processes that
+# no longer exist when it starts.
+#
+# Peers know they share a host (and a /dev/shm) by comparing host_id(),
+# which every Pyre Transport advertises in its ENTER headers. Blocks
+# are created readable only by their owner, so host_id() includes the
+# user id too; Transports run by different users on one host send
+# inline rather than handles the receiver couldn't open.
+#
+# Python 3 only, like AsyncTransport. /dev/shm is Linux; elsewhere
+# the blocks are files in the temporary directory, which works but
+# isn't guaranteed to stay in memory.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import errno
+import logging
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import uuid
+
+from nluas import transport_codec
+
+logger = logging.getLogger('Transport')
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+PREFIX = 'nluas-shm-'
+
+# Pyre ENTER header carrying host_id().
+HOST_HEADER = 'X-NLUAS-Host'
+
+DEFAULT_THRESHOLD = 1 << 20
+DEFAULT_LEASE = 30.0
+
+_HANDLE = struct.Struct('!BQI16s')
+
+class SharedMemoryError(Exception):
+    '''Raised if a handle is malformed or its block can't be mapped.'''
+    pass
+
+def host_id():
+    '''Return a string that's the same for Transports that can share blocks in SHM_DIR, and different otherwise.'''
+    # The device and inode tell containers on one host apart, since
+    # each has its own /dev/shm. The user id keeps other users from
+    # being sent blocks they can't open (see put()).
+    st = os.stat(SHM_DIR)
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    return '%s:%x:%x:%d'%(socket.gethostname(), st.st_dev, st.st_ino, uid)
+# host_id()
+
+def _block_path(pid, block):
+    return os.path.join(SHM_DIR, '%s%d-%s'%(PREFIX, pid, block.hex))
+# _block_path()
+
+def pid_alive(pid):
+    '''Return true unless there's no process pid on this host. Also used by transport_discovery.py.'''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM means it exists but belongs to someone else.
+        return e.errno != errno.ESRCH
+    return True
+# pid_alive()
+
+def sweep():
+    '''Unlink blocks left behind by processes that no longer exist. Returns how many.'''
+    count = 0
+    try:
+        names = os.listdir(SHM_DIR)
+    except OSError:
+        return 0
+    for name in names:
+        if not name.startswith(PREFIX):
+            continue
+        try:
+            pid = int(name[len(PREFIX):].split('-')[0])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not pid_alive(pid):
+            try:
+                os.unlink(os.path.join(SHM_DIR, name))
+                count += 1
+            except OSError:
+                # Someone else swept it first.
+                pass
+    return count
+# sweep()
+
+class SharedMemoryWriter(object):
+    '''Sender side: puts payloads in shared memory blocks and unlinks them once every receiver has released them or their lease runs out. Thread safe.'''
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, lease=DEFAULT_LEASE):
+        if threshold < 1:
+            raise ValueError('Shared memory threshold must be at least 1 byte.')
+        self.threshold = threshold
+        self.lease = lease
+        # Counters, see stats().
+        self.blocks = 0
+        self.bytes = 0
+        self.released = 0
+        self.expired = 0
+        self.swept = sweep()
+        # dict of block id (uuid.UUID) => [receivers yet to release, lease end, path]
+        self._live = {}
+        self._lock = threading.Lock()
+    # __init__()
+
+    def put(self, codec_id, payload, receivers):
+        '''Write payload (encoded with codec_id) to a new block that receivers Transports will map, and return its handle.'''
+        block = uuid.uuid4()
+        pid = os.getpid()
+        path = _block_path(pid, block)
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+        except Exception:
+            os.unlink(path)
+            raise
+        size = transport_codec.frame_size(payload)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self._live[block] = [receivers, now + self.lease, path]
+            self.blocks += 1
+            self.bytes += size
+        return _HANDLE.pack(codec_id, size, pid, block.bytes)
+    # put()
+
+    def release(self, block):
+        '''A receiver has mapped the block with id block (a uuid.UUID).'''
+        with self._lock:
+            entry = self._live.get(block)
+            if entry is None:
+                return
+            entry[0] -= 1
+            if entry[0] > 0:
+                return
+            del self._live[block]
+            self.released += 1
+        unlink(entry[2])
+    # release()
+
+    def collect(self):
+        '''Unlink blocks whose lease has run out.'''
+        with self._lock:
+            self._expire(time.time())
+    # collect()
+
+    def _expire(self, now):
+        # Must be called with self._lock held.
+        for (block, entry) in list(self._live.items()):
+            if entry[1] <= now:
+                del self._live[block]
+                self.expired += 1
+                unlink(entry[2])
+    # _expire()
+
+    def close(self):
+        '''Unlink every block still live.'''
+        with self._lock:
+            live = list(self._live.values())
+            self._live = {}
+        for entry in live:
+            unlink(entry[2])
+    # close()
+
+    def stats(self):
+        '''Return a dict of counters: blocks and bytes written, blocks released by every receiver, blocks unlinked when their lease ran out, blocks still live, and blocks of dead processes swept at start.'''
+        with self._lock:
+            return {'blocks': self.blocks, 'bytes': self.bytes, 'released': self.released,
+                    'expired': self.expired, 'live': len(self._live), 'swept': self.swept,
+                    'threshold': self.threshold}
+    # stats()
+# class SharedMemoryWriter
+
+def unlink(path):
+    '''Remove the file at path, if it's still there. Also used by transport_discovery.py.'''
+    try:
+        os.unlink(path)
+    except OSError:
+        # Swept or unregistered already.
+        pass
+# unlink()
+
+def open_handles(handles):
+    '''Map the blocks named by handles, read-only. Returns (codec id, list of memoryviews of the payloads, list of block ids). Raises SharedMemoryError if a handle is malformed, the blocks use different codecs, or a block is gone.'''
+    codec_id = None
+    views = []
+    blocks = []
+    for handle in handles:
+        if transport_codec.frame_size(handle) != _HANDLE.size:
+            raise SharedMemoryError('Malformed shared memory handle of %d bytes'%(transport_codec.frame_size(handle)))
+        (cid, size, pid, block) = _HANDLE.unpack_from(handle)
+        if codec_id is not None and cid != codec_id:
+            raise SharedMemoryError('Shared memory blocks of one message use different codecs')
+        codec_id = cid
+        block = uuid.UUID(bytes=bytes(block))
+        views.append(_map(_block_path(pid, block), size))
+        blocks.append(block)
+    return (codec_id, views, blocks)
+# open_handles()
+
+def _map(path, size):
+    try:
+        with open(path, 'rb') as f:
+            if size == 0:
+                return memoryview(b'')
+            m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError) as e:
+        # Most likely unlinked because its lease ran out.
+        raise SharedMemoryError('Cannot map shared memory block %s: %s'%(path, e))
+    # The view keeps the mapping alive until the payload is dropped.
+    return memoryview(m)
+# _map()
@@ -0,0 +1,240 @@
+######################################################################
+#
+# File: transport_stats.py
+#
+# Counters and latency histograms for Transport. See Transport.stats().
+#
+# Everything here is cheap enough to be always on: a few additions
+# and one bisect per message, under a lock that's only contended by
+# stats() itself. The optional StatsExporter periodically writes
+# snapshots to the log or to a file. It's a thread that only exists
+# while exporting is turned on, so it costs nothing otherwise.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import bisect
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('Transport')
+
+# Histogram bucket upper bounds in seconds: 1us, 2us, 4us, ... ~33s.
+# Anything slower goes in a final overflow bucket.
+_BOUNDS = [1e-6 * (2 ** k) for k in range(26)]
+
+class Histogram(object):
+    '''Log-scale histogram of durations in seconds. Not thread safe by itself; TransportStats locks around it.'''
+
+    def __init__(self):
+        self.counts = [0] * (len(_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+    # __init__()
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+    # record()
+
+    def percentile(self, p):
+        '''Return the upper bound of the bucket holding the p-th percentile (0-100), or None if empty.'''
+        if self.count == 0:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n > 0:
+                return _BOUNDS[i] if i < len(_BOUNDS) else self.max
+        return self.max
+    # percentile()
+
+    def snapshot(self):
+        '''Return a dict summary. buckets lists [upper bound, count] for non-empty buckets (None bound means overflow).'''
+        buckets = []
+        for (i, n) in enumerate(self.counts):
+            if n:
+                buckets.append([_BOUNDS[i] if i < len(_BOUNDS) else None, n])
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': buckets,
+        }
+    # snapshot()
+# class Histogram
+
+class _RemoteStats(object):
+    '''Counters for one remote (sender or destination).'''
+
+    def __init__(self):
+        self.received = 0
+        self.received_bytes = 0
+        self.received_urgent = 0
+        # Received too late and dropped, and sent but reported late by
+        # the receiver.
+        self.expired = 0
+        self.expired_reported = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.decode = Histogram()
+        self.callback = Histogram()
+    # __init__()
+
+    def snapshot(self):
+        return {
+            'received': self.received,
+            'received_bytes': self.received_bytes,
+            'received_urgent': self.received_urgent,
+            'expired': self.expired,
+            'expired_reported': self.expired_reported,
+            'sent': self.sent,
+            'sent_bytes': self.sent_bytes,
+            'decode_time': self.decode.snapshot(),
+            'callback_time': self.callback.snapshot(),
+        }
+    # snapshot()
+# class _RemoteStats
+
+class TransportStats(object):
+    '''Per-remote message and byte counts, decode and callback time histograms.'''
+
+    def __init__(self):
+        self.started = time.time()
+        # dict of remote name => _RemoteStats
+        self._remotes = {}
+        # Reader lanes (see Transport notes on priorities): urgent
+        # messages handled ahead of held back normal ones, the normal
+        # messages they went ahead of, the most that were held back at
+        # once, and how often the starvation bound forced the held
+        # back ones through.
+        self._lanes = {'overtakes': 0, 'overtaken': 0, 'max_held_back': 0, 'forced': 0}
+        self._lock = threading.Lock()
+    # __init__()
+
+    def _remote(self, name):
+        # Must be called with self._lock held.
+        r = self._remotes.get(name)
+        if r is None:
+            r = self._remotes[name] = _RemoteStats()
+        return r
+    # _remote()
+
+    def record_sent(self, dest, nbytes):
+        with self._lock:
+            r = self._remote(dest)
+            r.sent += 1
+            r.sent_bytes += nbytes
+    # record_sent()
+
+    def record_received(self, remote, nbytes, decode_seconds=None, urgent=False):
+        with self._lock:
+            r = self._remote(remote)
+            r.received += 1
+            r.received_bytes += nbytes
+            if urgent:
+                r.received_urgent += 1
+            if decode_seconds is not None:
+                r.decode.record(decode_seconds)
+    # record_received()
+
+    def record_expired(self, remote):
+        with self._lock:
+            self._remote(remote).expired += 1
+    # record_expired()
+
+    def record_expiry_report(self, dest):
+        with self._lock:
+            self._remote(dest).expired_reported += 1
+    # record_expiry_report()
+
+    def record_callback(self, remote, seconds):
+        with self._lock:
+            self._remote(remote).callback.record(seconds)
+    # record_callback()
+
+    def record_overtake(self, held_back):
+        '''An urgent message was handled ahead of held_back normal ones.'''
+        with self._lock:
+            self._lanes['overtakes'] += 1
+            self._lanes['overtaken'] += held_back
+            if held_back > self._lanes['max_held_back']:
+                self._lanes['max_held_back'] = held_back
+    # record_overtake()
+
+    def record_forced(self):
+        '''Held back normal messages were let through to bound their wait.'''
+        with self._lock:
+            self._lanes['forced'] += 1
+    # record_forced()
+
+    def snapshot(self):
+        '''Return a dict of remote name => counters, plus uptime and lane counters.'''
+        with self._lock:
+            remotes = dict([(name, r.snapshot()) for (name, r) in self._remotes.items()])
+            lanes = dict(self._lanes)
+        return {'uptime': time.time() - self.started, 'remotes': remotes, 'lanes': lanes}
+    # snapshot()
+# class TransportStats
+
+class StatsExporter(object):
+    '''Calls snapshot() every interval seconds and writes the result as one JSON line, either appended to the file at path or logged at INFO level.'''
+
+    def __init__(self, snapshot, interval=10.0, path=None):
+        if interval <= 0:
+            raise ValueError('Stats export interval must be positive.')
+        self._snapshot = snapshot
+        self.interval = interval
+        self.path = path
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, name='Transport-stats')
+        self._thread.daemon = True
+        self._thread.start()
+    # __init__()
+
+    def stop(self):
+        '''Write one last snapshot and stop.'''
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+    # stop()
+
+    def export(self):
+        line = json.dumps(self._snapshot(), default=str)
+        if self.path is None:
+            logger.info('Transport stats %s'%(line))
+        else:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+    # export()
+
+    def _worker(self):
+        while not self._stop.wait(self.interval):
+            self._export_safely()
+        self._export_safely()
+    # _worker()
+
+    def _export_safely(self):
+        try:
+            self.export()
+        except Exception:
+            logger.exception('Transport stats export failed')
+    # _export_safely()
+# class StatsExporter
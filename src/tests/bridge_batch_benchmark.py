@@ -0,0 +1,141 @@
+"""
+Benchmark for link batching on the bridge (bridge_batch.py): a sending
+bridge client, the bridge server and a receiving bridge client, with
+batching off, on, and on with compression (same settings on the
+client and the server).
+
+The sender SHOUTs n raw messages (bridge_protocol.pack_raw()) holding
+the median ntuple from ntuple_tests.json, at -rate messages/sec, and
+flushes held batches on time as bridge_client.py does. For each
+setting it reports messages/sec, writes (sendall() calls) and bytes
+the sender put on its link, bytes the receiver read, frames per batch,
+the compression ratio, and the latency batching added (as reported by
+the sender's LinkBatcher) next to the measured end to end latency.
+Everything is on this host, so the link itself adds almost nothing;
+on a WAN, fewer, larger writes matter much more. Run from src/main,
+e.g.:
+
+    PYTHONPATH=. python ../tests/bridge_batch_benchmark.py -n 20000 -rate 5000 -batch 5 -compress 512
+"""
+
+from __future__ import print_function
+from nluas import bridge_batch
+from nluas import bridge_protocol
+from nluas import bridge_server
+import argparse
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def percentile(values, p):
+    '''values must be sorted.'''
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+# percentile()
+
+def receive(sock, n, result):
+    reader = bridge_protocol.FrameReader()
+    latencies = []
+    size = 0
+    while len(latencies) < n:
+        data = sock.recv(1 << 16)
+        if not data:
+            break
+        size += len(data)
+        for frame in reader.feed(data):
+            if bridge_protocol.frame_flags(frame) & bridge_protocol.FLAG_RAW:
+                (name, channel, frames) = bridge_protocol.unpack_raw(frame)
+                latencies.append(time.time() - json.loads(frames[0].decode('utf-8'))['sent'])
+    result.update({'latencies': sorted(latencies), 'bytes': size})
+# receive()
+
+def run(args, ntuple, batch, compress):
+    server = bridge_server.BridgeServer(batch=batch, compress=compress)
+    loop = asyncio.new_event_loop()
+    port = loop.run_until_complete(server.start('127.0.0.1', 0)).sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+
+    sender = socket.create_connection(('127.0.0.1', port))
+    receiver = socket.create_connection(('127.0.0.1', port))
+    receiver.sendall(bridge_protocol.pack_frame(json.dumps(['JOIN', 'R']).encode('utf-8')))
+    while len(server.channels.get('R', ())) < 1:
+        time.sleep(0.01)
+    result = {}
+    reading = threading.Thread(target=receive, args=(receiver, args.n, result))
+    reading.start()
+
+    batcher = None
+    if batch is not None or compress is not None:
+        batcher = bridge_batch.LinkBatcher(batch or 0, compress=compress)
+    counts = {'writes': 0, 'bytes': 0}
+    def send(frame):
+        if frame is not None:
+            sender.sendall(frame)
+            counts['writes'] += 1
+            counts['bytes'] += len(frame)
+    interval = 1.0 / args.rate if args.rate else 0
+    start = time.time()
+    for i in range(args.n):
+        # Sleep until the next message is due, flushing on time on the
+        # way.
+        target = start + i * interval
+        while True:
+            now = time.time()
+            due = batcher.due() if batcher is not None else None
+            if due is not None and due <= now:
+                send(batcher.flush())
+                continue
+            if now >= target:
+                break
+            time.sleep(min(target, due or target) - now)
+        payload = json.dumps({'sent': time.time(), 'ntuple': ntuple}).encode('utf-8')
+        frame = bridge_protocol.pack_raw('S', 'R', [payload])
+        send(batcher.add(frame) if batcher is not None else frame)
+    if batcher is not None:
+        send(batcher.flush())
+    reading.join(args.n * interval + 30)
+    elapsed = time.time() - start
+
+    sender.close()
+    receiver.close()
+    loop.call_soon_threadsafe(server.close)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    return (elapsed, counts, result, batcher.stats() if batcher is not None else None)
+# run()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000, help='messages')
+    parser.add_argument('-rate', type=float, default=5000, help='messages/sec, 0 for as fast as possible')
+    parser.add_argument('-batch', type=float, default=5, help='batch delay in ms for the batched runs')
+    parser.add_argument('-compress', type=int, default=512, help='compression threshold in bytes for the compressed run')
+    args = parser.parse_args()
+
+    with open(os.path.join(HERE, 'ntuple_tests.json')) as f:
+        ntuples = sorted(json.load(f).values(), key=lambda n: len(json.dumps(n)))
+    ntuple = ntuples[len(ntuples) // 2]
+
+    print('%-22s %9s %8s %10s %10s %8s %6s %10s %8s %8s'%('setting', 'msgs/sec', 'writes', 'sent KB', 'recvd KB',
+          'per batch', 'ratio', 'added ms', 'p50 ms', 'p99 ms'))
+    for (label, batch, compress) in [('off', None, None), ('batch %gms'%(args.batch), args.batch / 1000.0, None),
+                                     ('batch %gms + compress'%(args.batch), args.batch / 1000.0, args.compress)]:
+        (elapsed, counts, result, stats) = run(args, ntuple, batch, compress)
+        latencies = result['latencies']
+        print('%-22s %9.0f %8d %10d %10d %8s %6s %10s %8.2f %8.2f'%(label, len(latencies) / elapsed, counts['writes'],
+              counts['bytes'] // 1024, result['bytes'] // 1024,
+              '%.1f'%(stats['frames_per_batch']) if stats else '-', '%.2f'%(stats['ratio']) if stats else '-',
+              '%.2f'%(stats['delay_mean_ms']) if stats else '-',
+              1e3 * percentile(latencies, 50), 1e3 * percentile(latencies, 99)))
+        if len(latencies) < args.n:
+            print('  only %d of %d messages arrived'%(len(latencies), args.n))
+# main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Tests link batching for the bridge (bridge_batch.py).
+"""
+
+from nluas import bridge_batch
+from nluas import bridge_protocol
+from nluas.bridge_protocol import FrameReader, pack_frame
+import time
+import unittest
+
+class TestLinkBatcher(unittest.TestCase):
+
+    def test_batch(self):
+        batcher = bridge_batch.LinkBatcher(max_delay=0.05, max_bytes=900)
+        self.assertEqual(batcher.due(), None)
+        self.assertEqual(batcher.flush(), None)
+        frames = [pack_frame(b'x' * 100) for i in range(9)]
+        start = time.time()
+        for frame in frames[:5]:
+            self.assertEqual(batcher.add(frame), None)
+        self.assertTrue(start <= batcher.due() <= time.time() + 0.05)
+        time.sleep(0.01)
+        batch = batcher.flush()
+        self.assertEqual(bridge_protocol.frame_flags(batch), bridge_protocol.FLAG_BATCH)
+        self.assertEqual(FrameReader().feed(batch), frames[:5])
+        self.assertEqual(batcher.due(), None)
+        # Full at max_bytes.
+        for frame in frames[:8]:
+            self.assertEqual(batcher.add(frame), None)
+        batch = batcher.add(frames[8])
+        self.assertEqual(FrameReader().feed(batch), frames)
+        # A lone frame goes as it is.
+        batcher.add(frames[0])
+        self.assertEqual(batcher.flush(), frames[0])
+        stats = batcher.stats()
+        self.assertEqual((stats['batches'], stats['frames'], stats['compressed']), (3, 15, 0))
+        self.assertEqual(stats['frames_per_batch'], 5)
+        self.assertTrue(stats['delay_max_ms'] >= 10)
+        self.assertTrue(0 < stats['delay_mean_ms'] <= stats['delay_max_ms'])
+
+    def test_compress(self):
+        counts = bridge_batch.new_counts()
+        batcher = bridge_batch.LinkBatcher(max_delay=0, compress=200, counts=counts)
+        small = pack_frame(b'x' * 50)
+        self.assertEqual(batcher.add(small), small)
+        big = pack_frame(b'["SHOUT", "A", "B", "%s"]'%(b'x' * 1000))
+        compressed = batcher.add(big)
+        self.assertEqual(bridge_protocol.frame_flags(compressed), bridge_protocol.FLAG_BATCH | bridge_protocol.FLAG_COMPRESSED)
+        self.assertEqual(FrameReader().feed(compressed), [big])
+        # Shared counters.
+        other = bridge_batch.LinkBatcher(max_delay=0, compress=200, counts=counts)
+        other.add(big)
+        stats = bridge_batch.summarize(counts)
+        self.assertEqual((stats['batches'], stats['compressed']), (3, 2))
+        self.assertTrue(stats['ratio'] < 0.2)
+        self.assertRaises(ValueError, bridge_batch.LinkBatcher, max_delay=-1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Micro-benchmark for the CPU the bridge spends per forwarded SHOUT:
+packing it on the sending bridge client, routing it on the server,
+and unpacking it and handing it to the proxy Transport on the
+receiving bridge client. Compares
+
+    json (old)   what bridge_client.py did on python 3 before pass-through:
+                 the payload text put in the json list as a string, and
+                 the proxy encoding that string again (so the receiver
+                 got a string, not the ntuple)
+    json         -format json: the payload decoded, sent in the json list,
+                 and encoded again by the proxy
+    raw          -format raw: the Pyre frames passed through untouched
+
+for the smallest, median and largest ntuples in ntuple_tests.json.
+Sockets and Pyre are left out, since they cost the same either way.
+Run from src/main, e.g.:
+
+    PYTHONPATH=. python ../tests/bridge_client_benchmark.py -n 20000
+"""
+
+from __future__ import print_function
+from nluas import bridge_client
+from nluas import bridge_protocol
+from nluas import bridge_server
+from nluas import transport_codec
+import argparse
+import json
+import os
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+JSON = transport_codec.get_codec('json')
+
+def old_send(name, channel, frames):
+    decoded = frames[0].decode('utf-8')
+    return bridge_protocol.pack_frame(json.dumps(['SHOUT', name, channel, decoded]).encode('utf-8'))
+# old_send()
+
+def new_send(format):
+    return lambda name, channel, frames: bridge_client.shout_frame(name, channel, frames, format)
+# new_send()
+
+def route(frame):
+    if bridge_protocol.frame_flags(frame) & bridge_protocol.FLAG_RAW:
+        return bridge_protocol.raw_channel(frame)
+    return bridge_server.message_route(frame, bridge_protocol.HEADER_SIZE)
+# route()
+
+def deliver(rec):
+    '''What the receiving client's proxy does with rec.'''
+    if rec[0] == 'RAW':
+        return list(rec[3])
+    # Transport.send() encodes it.
+    return [JSON.encode(rec[3])]
+# deliver()
+
+def run(send, frames, n):
+    '''Return CPU seconds per message for (sending client, server, receiving client).'''
+    server_reader = bridge_protocol.FrameReader()
+    client_reader = bridge_protocol.FrameReader()
+    times = [0.0, 0.0, 0.0]
+    clock = time.process_time
+    for i in range(n):
+        start = clock()
+        frame = send('Speaker', 'Listener', frames)
+        sent = clock()
+        for message in server_reader.feed(frame):
+            route(message)
+        routed = clock()
+        for message in client_reader.feed(frame):
+            deliver(bridge_client.decode_frame(message))
+        done = clock()
+        times[0] += sent - start
+        times[1] += routed - sent
+        times[2] += done - routed
+    return [t / n for t in times]
+# run()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000, help='messages per run')
+    args = parser.parse_args()
+
+    with open(os.path.join(HERE, 'ntuple_tests.json')) as f:
+        ntuples = sorted(json.load(f).values(), key=lambda n: len(json.dumps(n)))
+    print('%-9s %-10s %7s %10s %10s %10s %10s'%('payload', 'path', 'bytes', 'send us', 'server us', 'recv us', 'total us'))
+    for (label, ntuple) in [('smallest', ntuples[0]), ('median', ntuples[len(ntuples) // 2]), ('largest', ntuples[-1])]:
+        # A plain JSON message, as Transport.send() puts it on Pyre.
+        frames = transport_codec.encode_message(JSON, ntuple)
+        for (path, send) in [('json (old)', old_send), ('json', new_send('json')), ('raw', new_send('raw'))]:
+            times = run(send, frames, args.n)
+            print('%-9s %-10s %7d %10.2f %10.2f %10.2f %10.2f'%(label, path, len(send('Speaker', 'Listener', frames)),
+                  1e6 * times[0], 1e6 * times[1], 1e6 * times[2], 1e6 * sum(times)))
+# main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Tests bridge client proxies (bridge_client.py). Uses tcp on localhost
+through registry discovery, but not UDP beacons or a bridge server.
+"""
+
+from nluas.Transport import Transport
+from nluas import bridge_client
+from nluas import bridge_protocol
+from nluas import transport_codec
+import shutil
+import socket
+import tempfile
+import unittest
+
+class TestProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        bridge_client.parse_arguments(['-host', '127.0.0.1'])
+        (bridge_client.Global.bridgesocket, self.server) = socket.socketpair()
+        self.server.settimeout(5)
+        bridge_client.Global.reader = bridge_protocol.FrameReader()
+
+    def tearDown(self):
+        bridge_client.Global.bridgesocket.close()
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def recv_frame(self, reader):
+        frames = []
+        while not frames:
+            frames = reader.feed(self.server.recv(1 << 16))
+        self.assertEqual(len(frames), 1)
+        return bridge_client.decode_frame(frames[0])
+
+    def test_whisper(self):
+        proxy = bridge_client.BridgeProxy('B', discovery='registry:' + self.dir)
+        a = Transport('A', discovery='registry:' + self.dir)
+        # The bridge client hasn't joined B here, so A whispers to the
+        # proxy, which passes the message on.
+        self.assertTrue(a.wait_for_peers('B', timeout=5))
+        a.send('B', {'n': 1})
+        reader = bridge_protocol.FrameReader()
+        (kind, name, channel, frames) = self.recv_frame(reader)
+        self.assertEqual((kind, name, channel), ('RAW', 'A', 'B'))
+        header = transport_codec.unpack_header(frames)
+        self.assertEqual(transport_codec.decode_messages(header, frames, None), [{'n': 1}])
+        a.quit_federation()
+        proxy._readthread.join(5)
+        self.assertFalse(proxy.is_running())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Micro-benchmark for reading bridge messages: the old ascii length
+read with recv(1) a byte at a time, against bridge_protocol.FrameReader
+fed from recv() of 64 KB.
+
+Writes n messages to one end of a socketpair and reads them from the
+other, counting recv() calls. Also times FrameReader.feed() alone on
+chunks already in memory, so parsing can be told apart from syscalls.
+Run from src/main, e.g.:
+
+    PYTHONPATH=. python ../tests/bridge_protocol_benchmark.py -n 100000 -size 200
+"""
+
+from __future__ import print_function
+from nluas import bridge_protocol
+import argparse
+import socket
+import threading
+import time
+
+def writer(sock, data):
+    sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+# writer()
+
+def read_old(sock, n):
+    '''The old bridge_client.server_recv(), n times. Returns (bodies, recv calls).'''
+    calls = 0
+    bodies = []
+    for i in range(n):
+        length_str = ''
+        char = sock.recv(1)
+        calls += 1
+        while char != b'\n':
+            length_str += char.decode('utf-8')
+            char = sock.recv(1)
+            calls += 1
+        total = int(length_str)
+        next_offset = 0
+        view = memoryview(bytearray(total))
+        while total - next_offset > 0:
+            next_offset += sock.recv_into(view[next_offset:], total - next_offset)
+            calls += 1
+        bodies.append(view.tobytes())
+    return (bodies, calls)
+# read_old()
+
+def read_new(sock, n):
+    reader = bridge_protocol.FrameReader()
+    calls = 0
+    frames = []
+    while len(frames) < n:
+        data = sock.recv(1 << 16)
+        calls += 1
+        if not data:
+            break
+        frames += reader.feed(data)
+    return ([bridge_protocol.frame_body(frame) for frame in frames], calls)
+# read_new()
+
+def run(read, stream, n):
+    (a, b) = socket.socketpair()
+    thread = threading.Thread(target=writer, args=(a, stream))
+    start = time.time()
+    thread.start()
+    (bodies, calls) = read(b, n)
+    elapsed = time.time() - start
+    thread.join()
+    a.close()
+    b.close()
+    assert len(bodies) == n
+    return (elapsed, calls)
+# run()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000, help='messages')
+    parser.add_argument('-size', type=int, default=200, help='message body size in bytes')
+    args = parser.parse_args()
+
+    body = b'x' * args.size
+    old_stream = (b'%d\n'%(len(body)) + body) * args.n
+    new_stream = bridge_protocol.pack_frame(body) * args.n
+
+    for (label, read, stream) in [('recv(1) length (old)', read_old, old_stream), ('FrameReader', read_new, new_stream)]:
+        (elapsed, calls) = run(read, stream, args.n)
+        print('%s: %d messages in %.3f s, %.0f/sec, %d recv calls (%.3f per message)'%(label, args.n, elapsed, args.n / elapsed,
+              calls, calls / float(args.n)))
+
+    # Parsing alone, on 64 KB chunks.
+    chunks = [new_stream[i:i + (1 << 16)] for i in range(0, len(new_stream), 1 << 16)]
+    reader = bridge_protocol.FrameReader()
+    start = time.time()
+    count = 0
+    for chunk in chunks:
+        count += len(reader.feed(chunk))
+    elapsed = time.time() - start
+    print('FrameReader.feed() alone: %d frames in %.3f s, %.2f us each, %.0f MB/sec'%(count, elapsed, 1e6 * elapsed / count,
+          len(new_stream) / elapsed / 1e6))
+# main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Tests bridge frames (bridge_protocol.py).
+"""
+
+from nluas import bridge_protocol
+from nluas.bridge_protocol import FrameReader, FrameError, pack_frame
+import unittest
+import zlib
+
+class TestFrames(unittest.TestCase):
+
+    def test_feed(self):
+        frames = [pack_frame(b'["JOIN", "A"]'), pack_frame(b''), pack_frame(b'x' * 1000)]
+        stream = b''.join(frames)
+        # Many frames in one recv().
+        self.assertEqual(FrameReader().feed(stream), frames)
+        # Split at every possible place.
+        for split in range(len(stream)):
+            reader = FrameReader()
+            got = reader.feed(stream[:split]) + reader.feed(stream[split:])
+            self.assertEqual(got, frames)
+            self.assertEqual(reader.pending(), 0)
+        # A byte at a time.
+        reader = FrameReader()
+        got = []
+        for i in range(len(stream)):
+            got += reader.feed(stream[i:i + 1])
+        self.assertEqual(got, frames)
+        self.assertEqual(bridge_protocol.frame_body(got[0]), b'["JOIN", "A"]')
+        self.assertEqual(bridge_protocol.frame_flags(got[0]), 0)
+
+    def test_raw(self):
+        frames = [b'\xffT\x01\x01\x00', b'\x81\xa1a\x01', b'']
+        frame = bridge_protocol.pack_raw(u'Caf\u00e9', u'B', frames)
+        self.assertEqual(bridge_protocol.frame_flags(frame), bridge_protocol.FLAG_RAW)
+        self.assertEqual(FrameReader().feed(frame), [frame])
+        self.assertEqual(bridge_protocol.raw_channel(frame), u'B')
+        self.assertEqual(bridge_protocol.unpack_raw(frame), (u'Caf\u00e9', u'B', frames))
+        # Lengths that don't add up.
+        self.assertRaises(FrameError, bridge_protocol.unpack_raw, frame[:-1])
+        self.assertRaises(FrameError, bridge_protocol.unpack_raw, frame + b'x')
+        self.assertRaises(FrameError, bridge_protocol.raw_channel, frame[:bridge_protocol.HEADER_SIZE + 7])
+
+    def test_batch(self):
+        frames = [pack_frame(b'["JOIN", "A"]'), bridge_protocol.pack_raw('A', 'B', [b'x' * 100])]
+        body = b''.join(frames)
+        batch = pack_frame(body, bridge_protocol.FLAG_BATCH)
+        compressed = pack_frame(zlib.compress(body), bridge_protocol.FLAG_BATCH | bridge_protocol.FLAG_COMPRESSED)
+        reader = FrameReader()
+        self.assertEqual(reader.feed(batch + frames[0] + compressed[:10]), frames + frames[:1])
+        self.assertEqual(reader.feed(compressed[10:]), frames)
+        stats = reader.stats()
+        self.assertEqual((stats['frames'], stats['batches'], stats['compressed']), (5, 2, 1))
+        self.assertEqual(stats['compressed_bytes_out'], len(body))
+        # No batches in batches, no compression outside batches, and
+        # no decompressing past the limit.
+        self.assertRaises(FrameError, FrameReader().feed, pack_frame(batch, bridge_protocol.FLAG_BATCH))
+        self.assertRaises(FrameError, FrameReader().feed, pack_frame(zlib.compress(b'x'), bridge_protocol.FLAG_COMPRESSED))
+        self.assertRaises(FrameError, FrameReader().feed, pack_frame(body[:-1], bridge_protocol.FLAG_BATCH))
+        bomb = pack_frame(zlib.compress(pack_frame(b'\0' * 10000)), bridge_protocol.FLAG_BATCH | bridge_protocol.FLAG_COMPRESSED)
+        self.assertRaises(FrameError, FrameReader(maxframe=1000).feed, bomb)
+
+    def test_errors(self):
+        self.assertRaises(FrameError, FrameReader().feed, b'13\n["JOIN", "A"]')
+        bad_version = bytearray(pack_frame(b'x'))
+        bad_version[2] = 99
+        self.assertRaises(FrameError, FrameReader().feed, bytes(bad_version))
+        self.assertRaises(FrameError, FrameReader().feed, pack_frame(b'x', flags=0x80))
+        # Too big is caught from the header alone.
+        reader = FrameReader(maxframe=100)
+        self.assertEqual(reader.feed(pack_frame(b'x' * 100)), [pack_frame(b'x' * 100)])
+        self.assertRaises(FrameError, reader.feed, pack_frame(b'x' * 101)[:bridge_protocol.HEADER_SIZE])
+
+if __name__ == '__main__':
+    unittest.main()
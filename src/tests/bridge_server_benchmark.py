@@ -0,0 +1,112 @@
+"""
+Benchmark for the bridge server: aggregate forwarding throughput with
+one deliberately slow client attached.
+
+Starts a bridge server in this process (in its own thread), connects
+senders, fast readers and, unless -slow 0, clients that join and
+never read (like a stalled WAN link). Each sender SHOUTs n messages
+on one channel, which the readers and slow clients have joined.
+Reports messages forwarded per second to the fast readers, and how
+many slow clients were evicted. -idle adds clients that read but
+haven't joined the channel (sites with no listeners for it); the
+server sends them nothing, so they shouldn't change the numbers. Run
+from src/main, e.g.:
+
+    PYTHONPATH=. python ../tests/bridge_server_benchmark.py -n 20000 -size 500
+    PYTHONPATH=. python ../tests/bridge_server_benchmark.py -slow 0 -idle 8
+
+With the old server, which sent to each client in turn with sendall(),
+a client that never reads stops all forwarding once its socket buffer
+fills, so the run with -slow 1 never finishes.
+"""
+
+from __future__ import print_function
+from nluas import bridge_protocol
+from nluas import bridge_server
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+
+def connect(port, rcvbuf=None, join=None):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if rcvbuf:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    s.connect(('127.0.0.1', port))
+    if join:
+        s.sendall(bridge_protocol.pack_frame(json.dumps(['JOIN', join]).encode('utf-8')))
+    return s
+# connect()
+
+def read(s, expected, counts, index):
+    '''Read until expected bytes have arrived, counting them in counts[index].'''
+    while counts[index] < expected:
+        data = s.recv(1 << 16)
+        if not data:
+            break
+        counts[index] += len(data)
+# read()
+
+def send(s, message, n):
+    for i in range(n):
+        s.sendall(message)
+# send()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000, help='messages from each sender')
+    parser.add_argument('-size', type=int, default=500, help='message body size in bytes')
+    parser.add_argument('-senders', type=int, default=2, help='sending clients')
+    parser.add_argument('-readers', type=int, default=4, help='fast reading clients')
+    parser.add_argument('-slow', type=int, default=1, help='clients that never read')
+    parser.add_argument('-idle', type=int, default=0, help='clients that read, but have not joined the channel')
+    parser.add_argument('-highwater', type=int, default=1 << 20, help='server -highwater')
+    parser.add_argument('-maxbuffer', type=int, default=16 << 20, help='server -maxbuffer')
+    parser.add_argument('-stall', type=float, default=2.0, help='server -stall')
+    args = parser.parse_args()
+
+    server = bridge_server.BridgeServer(args.highwater, args.maxbuffer, args.stall)
+    loop = asyncio.new_event_loop()
+    port = loop.run_until_complete(server.start('127.0.0.1', 0)).sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    message = bridge_protocol.pack_frame(json.dumps(['SHOUT', 'S', 'R', 'x' * args.size]).encode('utf-8'))
+    senders = [connect(port) for i in range(args.senders)]
+    idle = [connect(port) for i in range(args.idle)]
+    slow = [connect(port, rcvbuf=4096, join='R') for i in range(args.slow)]
+    readers = [connect(port, join='R') for i in range(args.readers)]
+    while len(server.channels.get('R', ())) < len(readers) + len(slow):
+        time.sleep(0.01)
+
+    # Readers also get the JOINs of readers after them.
+    join = len(bridge_protocol.pack_frame(json.dumps(['JOIN', 'R']).encode('utf-8')))
+    expected = args.senders * args.n * len(message)
+    counts = [0] * len(readers)
+    threads = [threading.Thread(target=read, args=(s, expected + join * (len(readers) - i - 1), counts, i)) for (i, s) in enumerate(readers)]
+    # Senders and idle clients only get JOINs, but drain them anyway.
+    threads += [threading.Thread(target=read, args=(s, 1 << 62, [0], 0), daemon=True) for s in senders + idle]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    sending = [threading.Thread(target=send, args=(s, message, args.n)) for s in senders]
+    for thread in sending:
+        thread.start()
+    for thread in sending + threads[:len(readers)]:
+        thread.join()
+    elapsed = time.time() - start
+
+    stats = server.stats()
+    delivered = sum(counts) // len(message)
+    print('%d senders x %d messages of %d bytes, %d fast readers, %d slow clients, %d idle clients'%(args.senders, args.n, len(message), args.readers, args.slow, args.idle))
+    print('forwarded to fast readers: %d in %.3f s, %.0f msgs/sec, %.1f MB/sec'%(delivered, elapsed, delivered / elapsed,
+          delivered * len(message) / elapsed / 1e6))
+    print('all forwarding: %.0f msgs/sec; slow clients evicted: %d of %d'%(stats['forwarded'] / elapsed, stats['evicted'], args.slow))
+    for s in senders + readers + slow + idle:
+        s.close()
+    loop.call_soon_threadsafe(server.close)
+# main()
+
+if __name__ == '__main__':
+    main()
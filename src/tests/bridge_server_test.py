@@ -0,0 +1,162 @@
+"""
+Tests the bridge server (bridge_server.py) over tcp on localhost.
+"""
+
+from nluas import bridge_protocol
+from nluas import bridge_server
+import asyncio
+import json
+import socket
+import threading
+import time
+import unittest
+
+def frame(*fields):
+    return bridge_protocol.pack_frame(json.dumps(list(fields)).encode('utf-8'))
+
+def pack_batch(frames):
+    return bridge_protocol.pack_frame(b''.join(frames), bridge_protocol.FLAG_BATCH)
+
+def wait_for(condition, timeout=5):
+    '''Poll until condition() is true. Fails the test on timeout.'''
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.001)
+
+class TestBridgeServer(unittest.TestCase):
+
+    def start(self, **kw):
+        self.server = bridge_server.BridgeServer(**kw)
+        self.loop = asyncio.new_event_loop()
+        server = self.loop.run_until_complete(self.server.start('127.0.0.1', 0))
+        self.port = server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for s in self.sockets:
+            s.close()
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+    def connect(self, rcvbuf=None):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if rcvbuf:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        s.connect(('127.0.0.1', self.port))
+        s.settimeout(5)
+        self.sockets.append(s)
+        return s
+
+    def read(self, s, n):
+        data = b''
+        while len(data) < n:
+            data += s.recv(n - len(data))
+        return data
+
+    def test_forward(self):
+        self.start()
+        a = self.connect()
+        b = self.connect()
+        c = self.connect()
+        wait_for(lambda: len(self.server.clients) == 3)
+        join = frame('JOIN', 'A')
+        a.sendall(join)
+        self.assertEqual(self.read(b, len(join)), join)
+        self.assertEqual(self.read(c, len(join)), join)
+        b.sendall(frame('JOIN', 'B'))
+        self.assertEqual(self.read(a, len(join)), frame('JOIN', 'B'))
+        self.assertEqual(self.read(c, len(join)), frame('JOIN', 'B'))
+        # Split across sends; only whole messages are forwarded.
+        message = frame('SHOUT', 'A', 'B', {'n': 1, 'text': '"B"'})
+        a.sendall(message[:5])
+        time.sleep(0.01)
+        a.sendall(message[5:] + frame('SHOUT', 'C', 'A', 'x'))
+        self.assertEqual(self.read(b, len(message)), message)
+        # c hasn't joined either channel.
+        c.sendall(frame('SHOUT', 'C', 'A', 'y'))
+        self.assertEqual(self.read(a, len(frame('SHOUT', 'C', 'A', 'y'))), frame('SHOUT', 'C', 'A', 'y'))
+        stats = self.server.stats()
+        self.assertEqual(stats['channels'], {'A': {'members': 1, 'shouts': 2, 'forwarded': 1},
+                                             'B': {'members': 1, 'shouts': 1, 'forwarded': 1}})
+        # Raw SHOUTs are routed the same way, and passed on unchanged.
+        raw = bridge_protocol.pack_raw('C', 'B', [b'\xffT\x01\x01\x00', b'\x81'])
+        c.sendall(raw)
+        self.assertEqual(self.read(b, len(raw)), raw)
+        wait_for(lambda: self.server.stats()['channels']['B']['shouts'] == 2)
+        # A client that connects later hears about joined channels.
+        d = self.connect()
+        self.assertEqual(self.read(d, 2 * len(join)), frame('JOIN', 'A') + frame('JOIN', 'B'))
+        # A bad message disconnects only the sender, and leaves its
+        # channels.
+        b.sendall(b'nonsense\n')
+        wait_for(lambda: len(self.server.clients) == 3)
+        self.assertEqual(sorted(self.server.channels), ['A'])
+
+    def test_evict(self):
+        self.start(highwater=16384, maxbuffer=65536, stall=0.2)
+        sender = self.connect()
+        fast = self.connect()
+        slow = self.connect(rcvbuf=4096)
+        wait_for(lambda: len(self.server.clients) == 3)
+        fast.sendall(frame('JOIN', 'A'))
+        slow.sendall(frame('JOIN', 'A'))
+        wait_for(lambda: len(self.server.channels.get('A', ())) == 2)
+        message = frame('SHOUT', 'B', 'A', 'x' * 1000)
+        received = [0]
+        def drain():
+            # Includes slow's JOIN.
+            while received[0] < 4000 * len(message) + len(frame('JOIN', 'A')):
+                received[0] += len(fast.recv(65536))
+        thread = threading.Thread(target=drain)
+        thread.start()
+        # The slow client never reads, but the fast one gets everything.
+        for i in range(4000):
+            sender.sendall(message)
+        thread.join(10)
+        self.assertEqual(received[0], 4000 * len(message) + len(frame('JOIN', 'A')))
+        self.assertEqual(self.server.stats()['evicted'], 1)
+        self.assertEqual(len(self.server.clients), 2)
+        self.assertEqual(self.server.stats()['channels']['A']['members'], 1)
+
+    def test_batch(self):
+        self.start(batch=0.02, compress=1000)
+        a = self.connect()
+        b = self.connect()
+        wait_for(lambda: len(self.server.clients) == 2)
+        b.sendall(frame('JOIN', 'A'))
+        # A lone frame goes as it is, once the batch delay is up.
+        self.assertEqual(self.read(a, len(frame('JOIN', 'A'))), frame('JOIN', 'A'))
+        # Sent together, as a single frame.
+        messages = [frame('SHOUT', 'B', 'A', 'x' * 100 + str(i)) for i in range(20)]
+        a.sendall(pack_batch(messages))
+        reader = bridge_protocol.FrameReader()
+        got = []
+        while len(got) < 20:
+            got += reader.feed(b.recv(65536))
+        self.assertEqual(got, messages)
+        self.assertEqual(reader.stats()['batches'], 1)
+        self.assertEqual(reader.stats()['compressed'], 1)
+        stats = self.server.stats()['batching']
+        self.assertEqual((stats['batches'], stats['frames']), (2, 21))
+
+class TestRoute(unittest.TestCase):
+
+    def test_route(self):
+        route = bridge_server.message_route
+        self.assertEqual(route(b'2\n["JOIN", "A"]', 2), ('JOIN', 'A'))
+        self.assertEqual(route(json.dumps(['SHOUT', 'A\n"', 'B\u00e9', {}]).encode('utf-8')), ('SHOUT', 'B\u00e9'))
+        self.assertEqual(route(b'["SHOUT",\n"A", \n "B", 1]'), ('SHOUT', 'B'))
+        # Channel cut off by the prefix read.
+        self.assertEqual(route(json.dumps(['SHOUT', 'A', 'C' * 5000, 1]).encode('utf-8')), ('SHOUT', 'C' * 5000))
+        self.assertEqual(route(b'["PING"]'), ('PING', None))
+        self.assertRaises(bridge_server.BridgeError, route, b'{"type": "SHOUT"}')
+        self.assertRaises(bridge_server.BridgeError, route, b'["SHOUT", "A"]')
+
+if __name__ == '__main__':
+    unittest.main()
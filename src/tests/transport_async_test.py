@@ -0,0 +1,102 @@
+"""
+Tests a Transport and an AsyncTransport in one federation. Uses tcp
+on localhost through registry discovery, but not UDP beacons.
+"""
+
+from nluas.Transport import Transport, TransportError, TransportProtocolError
+from nluas.AsyncTransport import AsyncTransport
+import asyncio
+import shutil
+import tempfile
+import time
+import unittest
+
+def wait_for(condition, timeout=5):
+    '''Poll until condition() is true. Fails the test on timeout.'''
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.001)
+
+class TestMixed(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_whisper(self):
+        async def run():
+            b = AsyncTransport('B', discovery='registry:' + self.dir)
+            sub = b.subscribe('A')
+            a = Transport('A', discovery='registry:' + self.dir)
+            got = []
+            a.subscribe('B', got.append)
+            # B is A's only peer in group B, so A whispers to it.
+            self.assertTrue(await asyncio.get_event_loop().run_in_executor(None, a.wait_for_peers, 'B', 5))
+            self.assertEqual(len(a._group_peers['B']), 1)
+            a.send('B', {'n': 1})
+            a.send_many('B', [{'n': 2}, {'n': 3}])
+            received = [await asyncio.wait_for(sub.__anext__(), 5) for i in range(3)]
+            self.assertEqual(received, [{'n': 1}, {'n': 2}, {'n': 3}])
+            await b.send('A', {'n': 4})
+            await asyncio.get_event_loop().run_in_executor(None, wait_for, lambda: got == [{'n': 4}])
+            # The reader survived the whispers.
+            self.assertFalse(b._reader.done())
+            a.quit_federation()
+            await asyncio.wait_for(b._reader, 5)
+            self.assertFalse(b.is_running())
+        asyncio.run(run())
+
+    def test_deadline(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            b = AsyncTransport('B', discovery='registry:' + self.dir)
+            sub = b.subscribe('A')
+            a = Transport('A', discovery='registry:' + self.dir)
+            reports = []
+            a.set_expiry_callback(lambda dest, late: reports.append((dest, late)))
+            self.assertTrue(await loop.run_in_executor(None, a.wait_for_peers, 'B', 5))
+            # Already late: dropped, and A is told.
+            a.send('B', {'n': 1}, deadline=time.time() - 1)
+            a.send('B', {'n': 2}, ttl=60)
+            self.assertEqual(await asyncio.wait_for(sub.__anext__(), 5), {'n': 2})
+            await loop.run_in_executor(None, wait_for, lambda: len(reports) == 1)
+            self.assertEqual(reports[0][0], 'B')
+            self.assertTrue(reports[0][1] >= 1)
+            self.assertFalse(b._reader.done())
+            a.quit_federation()
+            await asyncio.wait_for(b._reader, 5)
+        asyncio.run(run())
+
+    def test_reader_failure(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            b = AsyncTransport('B', discovery='registry:' + self.dir)
+            sub = b.subscribe('A')
+            a = Transport('A', discovery='registry:' + self.dir)
+            self.assertTrue(await loop.run_in_executor(None, a.wait_for_peers, 'B', 5))
+            a.send('B', {'n': 1})
+            self.assertEqual(await asyncio.wait_for(sub.__anext__(), 5), {'n': 1})
+            getter = asyncio.ensure_future(b.get('A', timeout=5))
+            await asyncio.sleep(0)
+            # Forget A's ENTER, so its next message is a protocol
+            # error that stops the reader.
+            b._uuid2ip.clear()
+            a.send('B', {'n': 2})
+            with self.assertRaises(TransportError) as cm:
+                await getter
+            self.assertTrue(isinstance(cm.exception.__cause__, TransportProtocolError))
+            with self.assertRaises(TransportError):
+                await asyncio.wait_for(sub.__anext__(), 5)
+            with self.assertRaises(TransportError):
+                await b.get('A', timeout=5)
+            await asyncio.wait_for(b._reader, 5)
+            self.assertFalse(b.is_running())
+            a.quit_federation()
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
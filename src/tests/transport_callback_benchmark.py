@@ -0,0 +1,65 @@
+"""
+Micro-benchmark for calling subscribed callbacks: the cost per message
+of each way a callback can be subscribed (plain, **kw, envelope=True),
+next to inspecting the callback on every message as Transport used to.
+
+Messages are delivered with Transport.inject(), so the numbers are for
+dispatch and the call alone, without the reader or a network. Run from
+src/main, e.g.:
+
+    PYTHONPATH=. python ../tests/transport_callback_benchmark.py -n 100000
+"""
+
+from __future__ import print_function
+from nluas.Transport import Transport, takes_keywords
+import argparse
+import time
+
+def plain(ntuple):
+    pass
+
+def keywords(ntuple, **kw):
+    pass
+
+def envelope(env):
+    pass
+
+def reflect(ntuple, uuid=None, name=None, ip=None, datetime=None):
+    # What _call_callback() did before callbacks were inspected at
+    # subscribe time: inspect on every message.
+    if takes_keywords(keywords):
+        keywords(ntuple, uuid=uuid, name=name, ip=ip, datetime=datetime)
+    else:
+        plain(ntuple)
+
+def run(args, callback, **kw):
+    t = Transport('CB', backend='inproc')
+    t.subscribe('A', callback, **kw)
+    msg = {'text': 'hello', 'type': 'benchmark'}
+    start = time.time()
+    for i in range(args.n):
+        t.inject('A', msg)
+    elapsed = time.time() - start
+    t.quit_federation()
+    return elapsed
+# run()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000, help='messages per run')
+    parser.add_argument('-repeat', type=int, default=3, help='runs of each (best is reported)')
+    args = parser.parse_args()
+
+    results = []
+    for (label, callback, kw) in [('inspect per message (old)', reflect, {}),
+                                  ('plain callback', plain, {}),
+                                  ('**kw callback', keywords, {}),
+                                  ('envelope=True', envelope, {'envelope': True})]:
+        elapsed = min([run(args, callback, **kw) for r in range(args.repeat)])
+        results.append(elapsed)
+        print('%s: %d in %.3f s, %.0f/sec (%.2f us each)'%(label, args.n, elapsed, args.n / elapsed, 1e6 * elapsed / args.n))
+    print('**kw callback vs inspecting per message: %.1fx faster'%(results[0] / results[2]))
+# main()
+
+if __name__ == '__main__':
+    main()
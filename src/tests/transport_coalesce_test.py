@@ -0,0 +1,45 @@
+"""
+Tests coalescing of outgoing Transport messages (transport_coalesce.py).
+Does not need a running federation.
+"""
+
+from nluas.transport_coalesce import Coalescer
+import threading
+import unittest
+
+class TestCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.event = threading.Event()
+        def send(dest, payloads):
+            self.sent.append((dest, payloads))
+            self.event.set()
+        self.send = send
+
+    def test_max_count(self):
+        c = Coalescer(self.send, max_delay=60, max_count=3)
+        for i in range(7):
+            c.add('B', b'%d'%(i))
+        self.assertEqual(self.sent, [('B', [b'0', b'1', b'2']), ('B', [b'3', b'4', b'5'])])
+        c.close()
+        self.assertEqual(self.sent[-1], ('B', [b'6']))
+
+    def test_max_bytes(self):
+        c = Coalescer(self.send, max_delay=60, max_bytes=4)
+        c.add('B', b'ab')
+        c.add('C', b'abcd')
+        c.add('B', b'cd')
+        self.assertEqual(self.sent, [('C', [b'abcd']), ('B', [b'ab', b'cd'])])
+        c.close()
+
+    def test_max_delay(self):
+        c = Coalescer(self.send, max_delay=0.05)
+        c.add('B', b'x')
+        c.add('B', b'y')
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual(self.sent, [('B', [b'x', b'y'])])
+        c.close()
+
+if __name__ == '__main__':
+    unittest.main()
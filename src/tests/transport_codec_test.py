@@ -0,0 +1,114 @@
+"""
+Tests the Transport wire codecs (transport_codec.py). Does not need
+a running federation.
+"""
+
+from nluas import transport_codec
+import json
+import unittest
+import uuid
+
+ntuple = {"predicate_type": "command",
+          "eventDescriptor": {"eventProcess": {"actionary": "move", "distance": 3.5}},
+          "return_type": "error_descriptor",
+          "parameters": [1, 2, None, True]}
+
+class TestTransportCodec(unittest.TestCase):
+
+    def test_json_is_bare_frame(self):
+        codec = transport_codec.get_codec('json')
+        frames = transport_codec.encode_message(codec, ntuple)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(json.loads(frames[0].decode('utf-8')), ntuple)
+        self.assertEqual(transport_codec.decode_message(frames), ntuple)
+
+    def test_binary_roundtrip(self):
+        for name in ['binary', 'marshal']:
+            codec = transport_codec.get_codec(name)
+            frames = transport_codec.encode_message(codec, ntuple)
+            self.assertTrue(transport_codec.has_header(frames))
+            self.assertEqual(transport_codec.decode_message(frames), ntuple)
+
+    def test_correlation_header(self):
+        cid = uuid.uuid4()
+        codec = transport_codec.get_codec('json')
+        flags = transport_codec.FLAG_REPLY | transport_codec.FLAG_ERROR
+        frames = transport_codec.encode_message(codec, "failed", flags, cid)
+        header = transport_codec.unpack_header(frames)
+        self.assertEqual(header.flags, flags)
+        self.assertEqual(header.correlation_id, cid)
+        self.assertEqual(transport_codec.decode_payload(header, frames), "failed")
+
+    def test_deadline_header(self):
+        cid = uuid.uuid4()
+        codec = transport_codec.get_codec('json')
+        frames = transport_codec.pack_payloads(codec.codec_id, [codec.encode("late")], transport_codec.FLAG_REQUEST, cid, deadline=1234.5)
+        header = transport_codec.unpack_header(frames)
+        self.assertTrue(header.flags & transport_codec.FLAG_DEADLINE)
+        self.assertEqual((header.correlation_id, header.deadline), (cid, 1234.5))
+        self.assertEqual(transport_codec.decode_payload(header, frames), "late")
+        self.assertEqual(transport_codec.unpack_header(transport_codec.encode_message(codec, ntuple)).deadline, None)
+
+    def test_batch(self):
+        for name in ['json', 'binary']:
+            codec = transport_codec.get_codec(name)
+            items = [ntuple, "ready", {"i": 3}]
+            frames = transport_codec.encode_batch(codec, items)
+            header = transport_codec.unpack_header(frames)
+            self.assertTrue(header.flags & transport_codec.FLAG_BATCH)
+            self.assertEqual(transport_codec.decode_messages(header, frames), items)
+            # A batch of one is an ordinary message.
+            frames = transport_codec.encode_batch(codec, [ntuple])
+            self.assertEqual(transport_codec.decode_message(frames), ntuple)
+
+    def test_compression(self):
+        codec = transport_codec.get_codec('json')
+        compressor = transport_codec.Compressor(threshold=200)
+        small = transport_codec.encode_message(codec, ntuple, compressor=compressor)
+        self.assertEqual(len(small), 1)
+        big = {"original": ["word"] * 500}
+        frames = transport_codec.encode_message(codec, big, compressor=compressor)
+        header = transport_codec.unpack_header(frames)
+        self.assertTrue(header.flags & transport_codec.FLAG_COMPRESSED)
+        self.assertEqual(transport_codec.decode_payload(header, frames, compressor), big)
+        stats = compressor.stats()
+        self.assertEqual((stats['compressed'], stats['skipped'], stats['decompressed']), (1, 1, 1))
+        self.assertTrue(stats['ratio'] < 0.5)
+
+    def test_legacy_message(self):
+        self.assertEqual(transport_codec.decode_message([b'"ready"']), "ready")
+
+    def test_binary_is_marshal(self):
+        # The same codec on every host, whatever is installed.
+        self.assertEqual(transport_codec.get_codec('binary').name, 'marshal')
+
+    def test_decode_errors(self):
+        for (name, data) in [('json', b'{"type": '), ('json', b'\xff'), ('marshal', b''), ('marshal', b'\x00')]:
+            codec = transport_codec.get_codec(name)
+            self.assertRaises(transport_codec.CodecError, codec.decode, data)
+        frames = transport_codec.pack_payloads(transport_codec.CODEC_MARSHAL, [b''])
+        self.assertRaises(transport_codec.CodecError, transport_codec.decode_message, frames)
+
+    def test_unknown_codec(self):
+        self.assertRaises(transport_codec.CodecError, transport_codec.get_codec, 'nope')
+        frames = [b'\xffT\x01\x63\x00', b'']
+        self.assertRaises(transport_codec.CodecError, transport_codec.decode_message, frames)
+
+    def test_lazy_peek(self):
+        raw = json.dumps({"text": "a, \"b\" }", "nested": {"type": "inner"}, "type": "outer"}).encode('utf-8')
+        lazy = transport_codec.LazyNtuple(transport_codec.CODEC_JSON, raw)
+        self.assertEqual(lazy.peek('type'), 'outer')
+        self.assertEqual(lazy.peek('missing', 'default'), 'default')
+        self.assertFalse(lazy.decoded())
+        self.assertEqual(lazy['nested'], {"type": "inner"})
+        self.assertTrue(lazy.decoded())
+        self.assertEqual(sorted(lazy.keys()), ['nested', 'text', 'type'])
+        self.assertEqual(transport_codec.LazyNtuple(transport_codec.CODEC_JSON, b'[1, 2]').peek('type'), None)
+        self.assertRaises(transport_codec.CodecError, transport_codec.LazyNtuple(transport_codec.CODEC_JSON, b'{"type": ').peek, 'type')
+        codec = transport_codec.get_codec('binary')
+        lazy = transport_codec.LazyNtuple(codec.codec_id, codec.encode(ntuple))
+        self.assertEqual(lazy.peek('predicate_type'), 'command')
+        self.assertEqual(lazy, ntuple)
+
+if __name__ == '__main__':
+    unittest.main()
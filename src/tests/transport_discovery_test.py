@@ -0,0 +1,110 @@
+"""
+Tests discovery backends (transport_discovery.py). Uses tcp on
+localhost, but not UDP beacons.
+"""
+
+from nluas.Transport import Transport, TransportError
+from nluas import transport_discovery
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+def wait_for(condition, timeout=5):
+    '''Poll until condition() is true. Fails the test on timeout.'''
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.001)
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def stop(t):
+    '''Stop Transport t without telling the federation to quit.'''
+    t._run = False
+    t._wake()
+    t._readthread.join(5)
+    t._shutdown()
+
+class TestDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_specs(self):
+        d = transport_discovery.get_discovery('static:A=tcp://localhost:5701,B=tcp://127.0.0.1:5702')
+        self.assertEqual(repr(d), 'static:A=tcp://127.0.0.1:5701,B=tcp://127.0.0.1:5702')
+        self.assertEqual(d.configure('A')[:3], ('*', 5701, '127.0.0.1'))
+        self.assertEqual(d.configure('C')[1], None)
+        path = os.path.join(self.dir, 'peers')
+        with open(path, 'w') as f:
+            f.write('# federation\nA tcp://127.0.0.1:5701\n\nB tcp://127.0.0.1:5702  # solver\n')
+        self.assertEqual(repr(transport_discovery.get_discovery('static:' + path)), repr(d))
+        self.assertEqual(transport_discovery.get_discovery('beacon:5671').port, 5671)
+        for spec in ['static:A=tcp://127.0.0.1', 'static:A=tcp://127.0.0.1:1,B=tcp://127.0.0.1:1', 'beacon:x', 'carrier-pigeon']:
+            self.assertRaises(transport_discovery.DiscoveryError, transport_discovery.get_discovery, spec)
+        self.assertRaises(TransportError, Transport, 'A', discovery='beacon', backend='inproc')
+        self.assertRaises(TransportError, Transport, 'A', discovery='beacon', port=5671)
+
+    def test_registry(self):
+        a = Transport('A', discovery='registry:' + self.dir)
+        b = Transport('B', discovery='registry:' + self.dir)
+        got = []
+        b.subscribe('A', got.append)
+        self.assertTrue(a.wait_for_peers('B', timeout=5))
+        a.send('B', {'n': 1})
+        wait_for(lambda: got == [{'n': 1}])
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+        # Peers stop routing to a Transport as soon as it stops.
+        stop(b)
+        wait_for(lambda: not a._group_peers.get('B'))
+        self.assertEqual(os.listdir(self.dir), [a._pyre.uuid().hex])
+        a.quit_federation()
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_registry_sweep(self):
+        child = subprocess.Popen([sys.executable, '-c', 'pass'])
+        child.wait()
+        path = os.path.join(self.dir, '0' * 32)
+        with open(path, 'w') as f:
+            json.dump({'name': 'X', 'endpoint': 'tcp://127.0.0.1:1', 'pid': child.pid, 'host': socket.gethostname()}, f)
+        self.assertEqual(transport_discovery.RegistryDiscovery(self.dir).peers(), [])
+        self.assertFalse(os.path.exists(path))
+
+    def test_static(self):
+        table = {'A': 'tcp://127.0.0.1:%d'%(free_port()), 'B': 'tcp://127.0.0.1:%d'%(free_port())}
+        discovery = transport_discovery.StaticDiscovery(table)
+        # B starts first, and finds A once A starts.
+        b = Transport('B', discovery=discovery)
+        a = Transport('A', discovery=discovery)
+        # Not in the table, so only the Transports in it find C.
+        c = Transport('C', discovery=discovery)
+        self.assertEqual(a._pyre.uuid(), discovery.peers()[0][0] if discovery.peers()[0][1] == table['A'] else discovery.peers()[1][0])
+        got = []
+        a.subscribe_all(lambda ntuple, **kw: got.append(kw['name']))
+        self.assertTrue(b.wait_for_peers(['A', 'C'], timeout=5))
+        self.assertTrue(c.wait_for_peers(['A', 'B'], timeout=5))
+        b.send('A', 1)
+        c.send('A', 2)
+        wait_for(lambda: sorted(got) == ['B', 'C'])
+        # A second Transport can't take A's endpoint.
+        self.assertRaises(TransportError, Transport, 'A', discovery=discovery)
+        a.quit_federation()
+        wait_for(lambda: not b.is_running() and not c.is_running())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+Tests the Transport callback dispatchers (transport_dispatch.py). Does
+not need a running federation.
+"""
+
+from nluas import transport_dispatch
+import threading
+import time
+import unittest
+
+class TestDispatchQueue(unittest.TestCase):
+
+    def test_drop_oldest(self):
+        q = transport_dispatch.DispatchQueue(2, 'drop_oldest')
+        for i in range(4):
+            self.assertTrue(q.put(i))
+        self.assertEqual([q.get(), q.get()], [2, 3])
+        self.assertEqual(q.dropped, 2)
+
+    def test_reject(self):
+        q = transport_dispatch.DispatchQueue(2, 'reject')
+        results = [q.put(i) for i in range(4)]
+        self.assertEqual(results, [True, True, False, False])
+        self.assertEqual([q.get(), q.get()], [0, 1])
+        self.assertEqual(q.dropped, 2)
+
+    def test_close(self):
+        q = transport_dispatch.DispatchQueue(2)
+        q.put(1)
+        q.close()
+        self.assertFalse(q.put(2))
+        self.assertEqual(q.get(), 1)
+        self.assertEqual(q.get(), None)
+
+    def test_oldest(self):
+        q = transport_dispatch.DispatchQueue(2)
+        self.assertEqual(q.oldest(), None)
+        q.put((10.0, 'a'))
+        q.put((11.0, 'b'))
+        self.assertEqual(q.oldest(), 10.0)
+
+    def test_urgent_lane(self):
+        q = transport_dispatch.DispatchQueue(10, max_overtake=2)
+        for i in range(3):
+            q.put('normal%d'%(i))
+        for i in range(4):
+            q.put('urgent%d'%(i), urgent=True)
+        self.assertEqual((len(q), q.urgent()), (7, 4))
+        # At most two urgent items in a row while normal ones wait.
+        self.assertEqual([q.get() for i in range(7)],
+                         ['urgent0', 'urgent1', 'normal0', 'urgent2', 'urgent3', 'normal1', 'normal2'])
+        self.assertEqual(q.overtaken, 4)
+        # Overflow drops normal items first.
+        q = transport_dispatch.DispatchQueue(2, 'drop_oldest')
+        q.put('urgent', urgent=True)
+        q.put('normal0')
+        q.put('normal1')
+        self.assertEqual([q.get(), q.get()], ['urgent', 'normal1'])
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, transport_dispatch.DispatchQueue, 2, 'sometimes')
+        self.assertRaises(ValueError, transport_dispatch.make_dispatcher, 'fork')
+
+class TestDispatchers(unittest.TestCase):
+
+    def check_order(self, dispatcher):
+        got = []
+        done = threading.Event()
+        def cb(i):
+            got.append(i)
+            if i == 99:
+                done.set()
+        for i in range(100):
+            dispatcher.submit(cb, i)
+        self.assertTrue(done.wait(5))
+        dispatcher.close()
+        self.assertEqual(got, list(range(100)))
+
+    def test_thread(self):
+        self.check_order(transport_dispatch.make_dispatcher('thread'))
+
+    def test_pool(self):
+        pool = transport_dispatch.DispatchPool(3)
+        self.check_order(transport_dispatch.make_dispatcher('pool', pool=pool))
+        pool.close()
+
+    def test_pool_unordered(self):
+        # Two callbacks that each wait for the other can only finish if
+        # they run at the same time.
+        pool = transport_dispatch.DispatchPool(2)
+        d = transport_dispatch.make_dispatcher('pool', pool=pool, ordered=False)
+        first, second = threading.Event(), threading.Event()
+        done = []
+        def cb(mine, other):
+            mine.set()
+            done.append(other.wait(5))
+        d.submit(cb, first, second)
+        d.submit(cb, second, first)
+        for i in range(50):
+            if len(done) == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(done, [True, True])
+        pool.close()
+
+    def test_callback_exception(self):
+        d = transport_dispatch.make_dispatcher('thread')
+        done = threading.Event()
+        d.submit(lambda: 1/0)
+        d.submit(done.set)
+        self.assertTrue(done.wait(5))
+        d.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,439 @@
+"""
+Tests Transport with the in-process backend (transport_loopback.py).
+Does not need a network.
+"""
+
+from nluas.Transport import Transport, TransportError
+from nluas import Transport as Transport_module
+from nluas import transport_codec
+from nluas import transport_loopback
+import json
+import threading
+import time
+import unittest
+
+def wait_for(condition, timeout=5):
+    '''Poll until condition() is true. Fails the test on timeout.'''
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.001)
+
+class TestLoopback(unittest.TestCase):
+
+    def setUp(self):
+        # Each test gets its own router, so leftover Transports from
+        # other tests can't interfere.
+        self.router = transport_loopback.LoopbackRouter()
+        self.transports = []
+
+    def tearDown(self):
+        for t in self.transports:
+            if t.is_running():
+                t.quit_federation()
+
+    def make(self, name, **kw):
+        t = Transport(name, backend='inproc', router=self.router, **kw)
+        self.transports.append(t)
+        return t
+
+    def test_by_reference(self):
+        a = self.make('A')
+        b = self.make('B')
+        got = []
+        done = threading.Event()
+        def cb(ntuple, **kw):
+            got.append((ntuple, kw['name'], kw['ip']))
+            done.set()
+        b.subscribe('A', cb)
+        msg = {'text': 'hello', 'parts': [1, 2]}
+        a.send('B', msg)
+        self.assertTrue(done.wait(5))
+        self.assertTrue(got[0][0] is msg)
+        self.assertEqual(got[0][1:], ('A', '127.0.0.1'))
+        self.assertEqual(a.codec(), 'reference')
+        self.assertEqual(a.backend(), 'inproc')
+
+    def test_copy(self):
+        a = self.make('A', copy=True)
+        b = self.make('B')
+        msg = {'parts': [1, 2]}
+        result = []
+        thread = threading.Thread(target=lambda: result.append(b.get('A')))
+        thread.start()
+        # get() only listens once it's called.
+        wait_for(lambda: 'A' in b._subscribers)
+        a.send('B', msg)
+        msg['parts'].append(3)
+        thread.join(5)
+        self.assertEqual(result[0].object, {'parts': [1, 2]})
+        self.assertEqual(result[0].name, 'A')
+
+    def test_batch_and_request(self):
+        a = self.make('A')
+        b = self.make('B')
+        got = []
+        done = threading.Event()
+        def cb(ntuple):
+            got.append(ntuple)
+            if len(got) == 3:
+                done.set()
+        b.subscribe('A', cb)
+        b.serve(lambda ntuple: ntuple * 2)
+        a.send_many('B', [1, 2, 3])
+        self.assertTrue(done.wait(5))
+        self.assertEqual(got, [1, 2, 3])
+        self.assertEqual(a.request('B', 21, timeout=5), 42)
+
+    def test_quit_and_prefix(self):
+        a = self.make('A', prefix='X_')
+        b = self.make('B', prefix='X_')
+        # Same names in another federation don't see X_ traffic.
+        other = self.make('B', prefix='Y_')
+        got = []
+        other.subscribe('A', got.append)
+        a.send('B', 'ignored')
+        a.quit_federation()
+        b._readthread.join(5)
+        self.assertFalse(b.is_running())
+        self.assertTrue(other.is_running())
+        self.assertEqual(got, [])
+
+    def test_whisper_routing(self):
+        whispers = []
+        real_whisper = self.router.whisper
+        def whisper(node, peer, frames):
+            whispers.append(peer)
+            real_whisper(node, peer, frames)
+        self.router.whisper = whisper
+        a = self.make('A')
+        b1 = self.make('B')
+        wait_for(lambda: len(a._group_peers.get('B', ())) == 1)
+        got = []
+        done = threading.Event()
+        def cb(ntuple, **kw):
+            got.append((ntuple, kw['uuid']))
+            done.set()
+        b1.subscribe('A', cb)
+        a.send('B', 1)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(whispers, [b1._pyre.uuid()])
+        # With two Transports named B, both get the message.
+        b2 = self.make('B')
+        wait_for(lambda: len(a._group_peers.get('B', ())) == 2)
+        b2.subscribe('A', cb)
+        done.clear()
+        a.send('B', 2)
+        wait_for(lambda: len(got) == 3)
+        self.assertEqual(len(whispers), 1)
+        # Once one leaves the group, whispering resumes. (quit_federation()
+        # would stop everyone.)
+        b2._pyre.leave('B')
+        wait_for(lambda: len(a._group_peers.get('B', ())) == 1)
+        a.send('B', 3)
+        wait_for(lambda: len(got) == 4)
+        self.assertEqual(whispers, [b1._pyre.uuid()] * 2)
+
+    def test_reply_routing(self):
+        # A node in group A besides A itself, as a bridge client is.
+        bridge = transport_loopback.LoopbackNode('bridge', self.router)
+        bridge.join('A')
+        bridge.start()
+        a = self.make('A')
+        b = self.make('B')
+        b.serve(lambda ntuple: 2 * ntuple)
+        wait_for(lambda: len(b._group_peers.get('A', ())) == 2)
+        self.assertEqual(a.request('B', 21, timeout=5), 42)
+        a.send('B', 'late', ttl=-1)
+        # Replies and expiry reports are shouted to A, so the bridge
+        # hears them too.
+        flags = []
+        while len(flags) < 2:
+            self.assertTrue(bridge.socket().poll(5000))
+            event = bridge.recv()
+            if event[0] == b'SHOUT' and event[3] == b'A':
+                flags.append(transport_codec.unpack_header(event[4:]).flags)
+        bridge.stop()
+        self.assertTrue(flags[0] & transport_codec.FLAG_REPLY)
+        self.assertTrue(flags[1] & transport_codec.FLAG_EXPIRED)
+
+    def test_send_buffer(self):
+        a = self.make('A')
+        a.set_send_buffer(2)
+        a.send('B', 1)
+        a.send('B', 2)
+        a.send('B', 3)
+        snap = a.stats()
+        self.assertEqual((snap['held'], snap['held_dropped']), ({'B': 2}, 1))
+        self.assertFalse(a.wait_for_peers('B', timeout=0.01))
+        got = []
+        # Keep A from seeing B's JOIN until B has subscribed.
+        with a._peers_cond:
+            b = self.make('B')
+            b.subscribe('A', got.append)
+        self.assertTrue(a.wait_for_peers(['B'], timeout=5))
+        a.send('B', 4)
+        wait_for(lambda: len(got) == 3)
+        self.assertEqual(got, [2, 3, 4])
+        self.assertEqual(a.stats()['held'], {})
+
+    def test_late_subscriber(self):
+        a = self.make('A')
+        c = self.make('C')
+        a.set_send_buffer()
+        a.send('B', 1)
+        # B joins, and gets what A held, before it subscribes.
+        b = self.make('B')
+        wait_for(lambda: b.stats()['early'] == {'A': 1})
+        a.send('B', 2)
+        self.assertTrue(c.wait_for_peers('B', timeout=5))
+        c.send('B', 'c1')
+        wait_for(lambda: b.stats()['early'] == {'A': 2, 'C': 1})
+        self.assertEqual(a.stats()['held'], {})
+        got = []
+        threads = []
+        def cb(ntuple):
+            got.append(ntuple)
+            threads.append(threading.current_thread())
+        b.subscribe('A', cb)
+        a.send('B', 3)
+        wait_for(lambda: len(got) == 3)
+        self.assertEqual(got, [1, 2, 3])
+        # C's are still kept until C is subscribed to as well.
+        self.assertEqual(b.stats()['early'], {'C': 1})
+        b.subscribe('C', cb)
+        wait_for(lambda: len(got) == 4)
+        self.assertEqual(got[3], 'c1')
+        # Handed over by the read thread, as any other message.
+        self.assertEqual(set(threads), set([b._readthread]))
+        snap = b.stats()
+        self.assertEqual((snap['early'], snap['early_dropped']), ({}, 0))
+        # Only until the remote is first subscribed to.
+        b.unsubscribe('A')
+        a.send('B', 4)
+        wait_for(lambda: b.stats()['remotes']['A']['received'] == 4)
+        self.assertEqual(b.stats()['early'], {})
+        b.subscribe('A', cb)
+        self.assertEqual(got, [1, 2, 3, 'c1'])
+
+    def test_fast_shutdown(self):
+        # Nothing but quit_federation() itself wakes a lone Transport.
+        a = self.make('A')
+        start = time.time()
+        a.quit_federation()
+        self.assertLess(time.time() - start, 0.5)
+        self.assertFalse(a._readthread.is_alive())
+
+    def test_lazy(self):
+        a = self.make('A')
+        b = self.make('B')
+        c = self.make('C')
+        got = []
+        def route(ntuple):
+            # Forward without decoding.
+            self.assertFalse(ntuple.decoded())
+            b.send('C', ntuple)
+        b.subscribe('A', route, lazy=True)
+        c.subscribe('B', got.append, lazy=True)
+        msg = {'type': 'move', 'distance': 3}
+        a.send('B', transport_codec.LazyNtuple(transport_codec.CODEC_JSON, json.dumps(msg).encode('utf-8')))
+        wait_for(lambda: len(got) == 1)
+        self.assertEqual(got[0].peek('type'), 'move')
+        self.assertEqual(got[0], msg)
+        # By reference, a lazy subscriber gets the object that was sent.
+        c.subscribe('A', got.append, lazy=True)
+        a.send('C', msg)
+        wait_for(lambda: len(got) == 2)
+        self.assertTrue(got[1].value is msg)
+
+    def test_fan_out(self):
+        a = self.make('A')
+        b = self.make('B')
+        calls = []
+        b.subscribe('A', lambda ntuple: calls.append(('main', ntuple)))
+        b.add_subscriber('A', lambda ntuple: calls.append(('log', ntuple)), order=-1, label='log')
+        queries = b.add_subscriber('A', lambda ntuple: calls.append(('query', ntuple)), where={'type': 'query'})
+        b.add_subscriber(None, lambda ntuple: calls.append(('all', ntuple.peek('type'))), lazy=True, order=1)
+        self.assertRaises(TransportError, b.add_subscriber, 'A', calls.append, where='query')
+        move = transport_codec.LazyNtuple(transport_codec.CODEC_JSON, b'{"type": "move"}')
+        query = transport_codec.LazyNtuple(transport_codec.CODEC_JSON, b'{"type": "query"}')
+        a.send('B', move)
+        a.send('B', query)
+        wait_for(lambda: len(calls) == 7)
+        self.assertEqual([(label, n if label == 'all' else n['type']) for (label, n) in calls], [
+            ('log', 'move'), ('main', 'move'), ('all', 'move'),
+            ('log', 'query'), ('main', 'query'), ('query', 'query'), ('all', 'query')])
+        # Decoded once, and shared.
+        self.assertTrue(calls[3][1] is calls[4][1] is calls[5][1])
+        self.assertEqual(sorted(b.stats()['subscriptions']), ['*#4', 'A', 'A#3', 'log'])
+
+        # get() doesn't take the message from the other subscribers.
+        b.remove_subscriber(queries)
+        del calls[:]
+        result = []
+        thread = threading.Thread(target=lambda: result.append(b.get('A')))
+        thread.start()
+        wait_for(lambda: len(b._subscribers['A']) == 3)
+        a.send('B', 'hello')
+        thread.join(5)
+        self.assertEqual(result[0].object, 'hello')
+        wait_for(lambda: len(calls) == 3)
+        self.assertEqual(len(b._subscribers['A']), 2)
+        b.unsubscribe('A')
+        self.assertEqual([sub.label for sub in b._subscribers['A']], ['log'])
+
+    def test_priority(self):
+        a = self.make('A')
+        b = self.make('B')
+        got = []
+        started = threading.Event()
+        release = threading.Event()
+        def cb(ntuple):
+            if ntuple == 'first':
+                # Let the rest pile up behind this one.
+                started.set()
+                release.wait(5)
+            got.append(ntuple)
+        b.subscribe('A', cb)
+        a.send('B', 'first')
+        self.assertTrue(started.wait(5))
+        for i in range(10):
+            a.send('B', i)
+        a.send('B', 'quit', priority='high')
+        release.set()
+        wait_for(lambda: len(got) == 12)
+        self.assertEqual(got, ['first', 'quit'] + list(range(10)))
+        snap = b.stats()
+        self.assertEqual(snap['lanes']['overtaken'], 10)
+        self.assertEqual(snap['remotes']['A']['received_urgent'], 1)
+        self.assertRaises(TransportError, a.send, 'B', 'x', priority='urgent')
+
+    def test_deadline(self):
+        a = self.make('A')
+        b = self.make('B')
+        reports = []
+        a.set_expiry_callback(lambda dest, late: reports.append((dest, late)))
+        got = []
+        started = threading.Event()
+        release = threading.Event()
+        def cb(ntuple):
+            if ntuple == 'slow':
+                started.set()
+                release.wait(5)
+            got.append(ntuple)
+        b.subscribe('A', cb, policy='thread')
+        a.send('B', 'late', ttl=-1)
+        a.send('B', 'in time', ttl=60)
+        wait_for(lambda: got == ['in time'])
+        wait_for(lambda: len(reports) == 1)
+        self.assertEqual(reports[0][0], 'B')
+        self.assertTrue(reports[0][1] >= 1)
+        # Expires while queued behind a slow callback.
+        a.send('B', 'slow')
+        self.assertTrue(started.wait(5))
+        a.send('B', 'queued', ttl=0.01)
+        a.send('B', 'no deadline')
+        time.sleep(0.05)
+        release.set()
+        wait_for(lambda: len(reports) == 2)
+        wait_for(lambda: len(got) == 3)
+        self.assertEqual(got, ['in time', 'slow', 'no deadline'])
+        self.assertEqual(b.stats()['remotes']['A']['expired'], 2)
+        self.assertEqual(a.stats()['remotes']['B']['expired_reported'], 2)
+
+    def test_deadline_coalesced(self):
+        a = self.make('A')
+        b = self.make('B')
+        got = []
+        b.subscribe('A', got.append)
+        self.assertTrue(a.wait_for_peers('B', timeout=5))
+        a.set_coalescing(True, max_delay=60)
+        # A deadline isn't coalesced, but doesn't overtake what is.
+        a.send('B', 1)
+        a.send('B', 2, ttl=60)
+        a.send('B', 3)
+        a.flush()
+        wait_for(lambda: len(got) == 3)
+        self.assertEqual(got, [1, 2, 3])
+
+    def test_deadline_fan_out(self):
+        a = self.make('A')
+        b = self.make('B')
+        reports = []
+        a.set_expiry_callback(lambda dest, late: reports.append(dest))
+        release = threading.Event()
+        got = []
+        def slow(ntuple):
+            release.wait(5)
+            got.append(ntuple)
+        b.subscribe('A', slow, policy='thread')
+        b.add_subscriber('A', slow, policy='thread')
+        a.send('B', 'first')
+        # Expires while queued for both callbacks, but counts once.
+        a.send('B', 'queued', ttl=0.01)
+        a.send('B', 'last')
+        time.sleep(0.05)
+        release.set()
+        wait_for(lambda: len(got) == 4)
+        self.assertEqual(sorted(got), ['first', 'first', 'last', 'last'])
+        wait_for(lambda: len(reports) == 1)
+        time.sleep(0.05)
+        self.assertEqual(reports, ['B'])
+        self.assertEqual(b.stats()['remotes']['A']['expired'], 1)
+
+    def test_envelope(self):
+        a = self.make('A')
+        b = self.make('B')
+        got = []
+        b.subscribe('A', got.append, envelope=True)
+        b.add_subscriber('A', lambda ntuple, **kw: got.append(kw['name']))
+        b.serve(lambda env: (env.name, env.object), envelope=True)
+        # Callbacks are inspected when they're subscribed, not per
+        # message.
+        inspected = []
+        real = Transport_module.takes_keywords
+        Transport_module.takes_keywords = lambda cb: inspected.append(cb) or real(cb)
+        try:
+            a.send('B', {'n': 1})
+            wait_for(lambda: len(got) == 2)
+            self.assertEqual(a.request('B', 2, timeout=5), ('A', 2))
+        finally:
+            Transport_module.takes_keywords = real
+        self.assertEqual(inspected, [])
+        self.assertEqual((got[0].object, got[0].name, got[0].ip, got[1]), ({'n': 1}, 'A', '127.0.0.1', 'A'))
+
+    def test_relay(self):
+        # As bridge_client.py does with frames from another site.
+        proxy = self.make('P')
+        b = self.make('B')
+        got = []
+        b.subscribe('P', got.append)
+        frames = transport_codec.encode_batch(transport_codec.get_codec('json'), [{'n': 1}, {'n': 2}])
+        proxy.relay('B', frames)
+        wait_for(lambda: len(got) == 2)
+        self.assertEqual(got, [{'n': 1}, {'n': 2}])
+
+    def test_undecodable(self):
+        proxy = self.make('P')
+        b = self.make('B')
+        got = []
+        b.subscribe('P', got.append)
+        # A truncated marshal payload, then a header of an unknown
+        # version. Both are dropped and the reader carries on.
+        proxy.relay('B', transport_codec.pack_payloads(transport_codec.CODEC_MARSHAL, [b'']))
+        proxy.relay('B', [b'\xffT\x63\x00\x00', b''])
+        proxy.relay('B', transport_codec.encode_message(transport_codec.get_codec('json'), {'n': 1}))
+        wait_for(lambda: got == [{'n': 1}])
+        self.assertTrue(b._readthread.is_alive())
+        self.assertEqual(b.stats()['undecodable'], 2)
+
+    def test_errors(self):
+        self.assertRaises(TransportError, Transport, 'A', backend='carrier-pigeon')
+        self.assertRaises(TransportError, Transport, 'A', codec='reference')
+        self.assertRaises(TransportError, Transport, 'A', backend='inproc', router=self.router, compress_threshold=100)
+        a = self.make('A')
+        self.assertRaises(TransportError, a.set_compression, 100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Micro-benchmark for the Transport reader thread: how many events per
+second it handles, and how long quit_federation() takes.
+
+Uses the inproc backend by default, so the numbers measure Transport
+itself rather than the network. Run from src/main, e.g.:
+
+    PYTHONPATH=. python ../tests/transport_reader_benchmark.py -n 100000
+    PYTHONPATH=. python ../tests/transport_reader_benchmark.py -backend pyre -n 10000
+"""
+
+from __future__ import print_function
+from nluas.Transport import Transport
+import argparse
+import os
+import threading
+import time
+
+# Stopped Transports are kept alive until exit. If Python collects a
+# Pyre node, its zmq context can block in term() from whatever thread
+# the garbage collector happens to run in.
+_stopped = []
+
+def throughput(args, prefix, callback):
+    a = Transport('A', prefix=prefix, backend=args.backend)
+    b = Transport('B', prefix=prefix, backend=args.backend)
+    count = [0]
+    done = threading.Event()
+    def cb(ntuple):
+        count[0] += 1
+        if count[0] == args.n:
+            done.set()
+    if callback:
+        b.subscribe('A', cb)
+    else:
+        # Nobody subscribes, so this measures just the reader. The
+        # request at the end can only be answered after every
+        # message ahead of it was handled.
+        b.serve(lambda ntuple: ntuple)
+    a.wait_for_peers('B')
+    b.wait_for_peers('A')
+    msg = {'text': 'hello', 'type': 'benchmark'}
+    start = time.time()
+    for i in range(args.n):
+        a.send('B', msg)
+    if callback:
+        done.wait()
+    else:
+        a.request('B', 'done')
+    elapsed = time.time() - start
+    a.quit_federation()
+    b._readthread.join()
+    _stopped.extend([a, b])
+    return elapsed
+# throughput()
+
+def shutdown(args, prefix):
+    # Alone, nothing but quit_federation() itself can wake the reader.
+    alone = Transport('A', prefix=prefix + 'ALONE_', backend=args.backend)
+    start = time.time()
+    alone.quit_federation()
+    lone = time.time() - start
+    a = Transport('A', prefix=prefix, backend=args.backend)
+    b = Transport('B', prefix=prefix, backend=args.backend)
+    a.wait_for_peers('B')
+    start = time.time()
+    a.quit_federation()
+    local = time.time() - start
+    b._readthread.join()
+    remote = time.time() - start
+    _stopped.extend([alone, a, b])
+    return (lone, local, remote)
+# shutdown()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000, help='messages to send')
+    parser.add_argument('-repeat', type=int, default=3, help='throughput runs (best is reported)')
+    parser.add_argument('-rounds', type=int, default=5, help='shutdowns to time')
+    parser.add_argument('-backend', default='inproc', help='inproc or pyre')
+    args = parser.parse_args()
+
+    for (i, (label, callback)) in enumerate([('events, no callback', False), ('messages with callback', True)]):
+        elapsed = min([throughput(args, 'BENCH%d_%d_'%(i, r), callback) for r in range(args.repeat)])
+        print('%s: %d in %.3f s, %.0f/sec (%.1f us each)'%(label, args.n, elapsed, args.n / elapsed, 1e6 * elapsed / args.n))
+
+    times = [shutdown(args, 'SHUTDOWN%d_'%(i)) for i in range(args.rounds)]
+    for (i, label) in enumerate(['quit_federation(), no peers', 'quit_federation(), one peer', 'peer stopped after']):
+        t = [r[i] for r in times]
+        print('%s: mean %.1f ms, max %.1f ms'%(label, 1e3 * sum(t) / len(t), 1e3 * max(t)))
+# main()
+
+if __name__ == '__main__':
+    main()
+    # Pyre leaves non-daemon threads behind.
+    os._exit(0)
@@ -0,0 +1,91 @@
+"""
+Tests recording and replay of Transport traffic (transport_record.py),
+using the inproc backend.
+"""
+
+from nluas.Transport import Transport
+from nluas import transport_loopback
+from nluas import transport_record
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+class TestRecord(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'traffic.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip_and_index(self):
+        r = transport_record.Recorder(self.path)
+        r.record(transport_record.SENT, 'A', 'B', {'n': 1})
+        r.record(transport_record.RECEIVED, 'B', 'A', [1, 2])
+        middle = time.time()
+        time.sleep(0.01)
+        r.record(transport_record.RECEIVED, 'B', 'A', 'three')
+        r.close()
+        replayer = transport_record.Replayer(self.path)
+        records = list(replayer.records())
+        self.assertEqual([(x.direction, x.name, x.channel, x.ntuple) for x in records], [
+            (transport_record.SENT, 'A', 'B', {'n': 1}),
+            (transport_record.RECEIVED, 'B', 'A', [1, 2]),
+            (transport_record.RECEIVED, 'B', 'A', 'three'),
+        ])
+        self.assertEqual([x.ntuple for x in replayer.records(start=middle)], ['three'])
+        self.assertEqual(len(list(replayer.records(direction=transport_record.RECEIVED))), 2)
+        # Appending keeps what's there.
+        r = transport_record.Recorder(self.path)
+        r.record(transport_record.SENT, 'A', 'B', 4)
+        r.close()
+        self.assertEqual(len(list(replayer.records())), 4)
+
+    def test_not_a_log(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'hello world')
+        self.assertRaises(transport_record.RecordError, transport_record.Replayer, self.path)
+
+    def test_record_and_replay(self):
+        router = transport_loopback.LoopbackRouter()
+        a = Transport('A', backend='inproc', router=router)
+        b = Transport('B', backend='inproc', router=router)
+        b.start_recording(self.path)
+        got = []
+        done = threading.Event()
+        def cb(ntuple):
+            got.append(ntuple)
+            if len(got) == 3:
+                done.set()
+        b.subscribe('A', cb)
+        a.wait_for_peers('B')
+        a.send('B', {'i': 0})
+        time.sleep(0.05)
+        a.send_many('B', [{'i': 1}, {'i': 2}])
+        self.assertTrue(done.wait(5))
+        b.send('A', 'reply')
+        b.stop_recording()
+        a.quit_federation()
+
+        replayer = transport_record.Replayer(self.path)
+        self.assertEqual([(x.direction, x.name, x.channel) for x in replayer.records()],
+                         [(transport_record.RECEIVED, 'A', 'B')] * 3 + [(transport_record.SENT, 'B', 'A')])
+
+        # Into a fresh Transport, as fast as possible, then at 10x.
+        c = Transport('C', backend='inproc', router=transport_loopback.LoopbackRouter())
+        replayed = []
+        c.subscribe('A', replayed.append)
+        self.assertEqual(replayer.replay(c, speed=None), 3)
+        self.assertEqual(replayed, [{'i': 0}, {'i': 1}, {'i': 2}])
+        start = time.time()
+        replayer.replay(c, speed=10.0)
+        self.assertGreaterEqual(time.time() - start, 0.004)
+        self.assertEqual(len(replayed), 6)
+        c.quit_federation()
+
+if __name__ == '__main__':
+    unittest.main()
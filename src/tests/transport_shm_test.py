@@ -0,0 +1,110 @@
+"""
+Tests the shared memory side channel for large payloads
+(transport_shm.py).
+"""
+
+from nluas.Transport import Transport
+from nluas import transport_codec
+from nluas import transport_shm
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+def wait_for(condition, timeout=5):
+    '''Poll until condition() is true. Fails the test on timeout.'''
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.001)
+
+class TestSharedMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = transport_shm.SharedMemoryWriter(threshold=1, lease=60)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def test_roundtrip_and_release(self):
+        codec = transport_codec.get_codec('marshal')
+        msg = {'words': ['big'] * 1000}
+        handle = self.writer.put(codec.codec_id, codec.encode(msg), 2)
+        (codec_id, views, blocks) = transport_shm.open_handles([handle])
+        self.assertEqual(codec_id, codec.codec_id)
+        self.assertEqual(codec.decode(views[0]), msg)
+        self.assertEqual(self.writer.stats()['live'], 1)
+        # Unlinked once both receivers have released it, and the mapping
+        # outlives the name.
+        self.writer.release(blocks[0])
+        self.assertEqual(self.writer.stats()['live'], 1)
+        self.writer.release(blocks[0])
+        self.assertEqual(self.writer.stats()['live'], 0)
+        self.assertEqual(self.writer.stats()['released'], 1)
+        self.assertRaises(transport_shm.SharedMemoryError, transport_shm.open_handles, [handle])
+        self.assertEqual(codec.decode(views[0]), msg)
+
+    def test_lease(self):
+        writer = transport_shm.SharedMemoryWriter(threshold=1, lease=0.01)
+        handle = writer.put(transport_codec.CODEC_JSON, b'[1, 2]', 1)
+        time.sleep(0.02)
+        writer.collect()
+        self.assertEqual(writer.stats()['expired'], 1)
+        self.assertRaises(transport_shm.SharedMemoryError, transport_shm.open_handles, [handle])
+        self.assertRaises(transport_shm.SharedMemoryError, transport_shm.open_handles, [b'short'])
+
+    def test_sweep(self):
+        # A block left behind by a process that has exited.
+        child = subprocess.Popen([sys.executable, '-c', 'pass'])
+        child.wait()
+        path = os.path.join(transport_shm.SHM_DIR, '%s%d-%s'%(transport_shm.PREFIX, child.pid, '0' * 32))
+        with open(path, 'wb') as f:
+            f.write(b'left behind')
+        self.assertTrue(transport_shm.sweep() >= 1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_host_id(self):
+        # Blocks are private to their owner, so other users on the
+        # same host must not look local.
+        self.assertTrue(transport_shm.host_id().endswith(':%d'%(os.getuid())))
+
+class TestTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_release(self):
+        a = Transport('A', codec='marshal', discovery='registry:' + self.dir)
+        b = Transport('B', discovery='registry:' + self.dir)
+        try:
+            self.assertTrue(a.wait_for_peers('B', timeout=5))
+            a.set_shared_memory(threshold=1, lease=0.2)
+            msg = {'words': ['big'] * 1000}
+            # Before B subscribes, and after it stops listening, its
+            # blocks are still acknowledged.
+            a.send('B', msg)
+            wait_for(lambda: a.stats()['shared_memory']['released'] == 1)
+            got = []
+            b.subscribe('A', got.append)
+            wait_for(lambda: got == [msg])
+            b.unsubscribe('A')
+            a.send('B', msg)
+            wait_for(lambda: a.stats()['shared_memory']['released'] == 2)
+            self.assertEqual(b.stats()['shared_memory']['mapped'], 2)
+            # A block nobody acknowledges is unlinked once its lease
+            # runs out, without waiting for another send.
+            handle = a._shm.put(transport_codec.CODEC_MARSHAL, b'x', 1)
+            wait_for(lambda: a.stats()['shared_memory']['expired'] == 1)
+            self.assertRaises(transport_shm.SharedMemoryError, transport_shm.open_handles, [handle])
+        finally:
+            a.quit_federation()
+
+if __name__ == '__main__':
+    unittest.main()
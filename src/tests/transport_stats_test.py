@@ -0,0 +1,51 @@
+"""
+Tests Transport counters and histograms (transport_stats.py). Does not
+need a running federation.
+"""
+
+from nluas import transport_stats
+import json
+import os
+import tempfile
+import unittest
+
+class TestTransportStats(unittest.TestCase):
+
+    def test_histogram(self):
+        h = transport_stats.Histogram()
+        self.assertEqual(h.snapshot()['p50'], None)
+        for i in range(99):
+            h.record(0.0001)
+        h.record(0.5)
+        snap = h.snapshot()
+        self.assertEqual(snap['count'], 100)
+        self.assertTrue(0.0001 <= snap['p50'] < 0.0002)
+        self.assertTrue(snap['p99'] < 0.001)
+        self.assertEqual(snap['max'], 0.5)
+
+    def test_counters(self):
+        stats = transport_stats.TransportStats()
+        stats.record_sent('B', 10)
+        stats.record_received('B', 20, 0.001)
+        stats.record_received('B', 30)
+        stats.record_callback('B', 0.002)
+        b = stats.snapshot()['remotes']['B']
+        self.assertEqual((b['sent'], b['sent_bytes'], b['received'], b['received_bytes']), (1, 10, 2, 50))
+        self.assertEqual(b['decode_time']['count'], 1)
+        self.assertEqual(b['callback_time']['count'], 1)
+
+    def test_exporter(self):
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            exporter = transport_stats.StatsExporter(lambda: {'n': 1}, interval=0.01, path=path)
+            exporter.stop()
+            with open(path) as f:
+                lines = f.readlines()
+            self.assertTrue(len(lines) >= 1)
+            self.assertEqual(json.loads(lines[-1]), {'n': 1})
+        finally:
+            os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+"""
+Benchmark suite for Transport: N sender and M receiver Transports, each
+in its own process on this machine, sending real ntuples (from
+ntuple_tests.json) of a sweep of sizes. For each size it reports
+
+    messages/sec     received, over the whole run
+    latency          p50 and p99 one-way, send() to callback
+    CPU              per message, senders and receivers separately
+    memory growth    RSS of each process, from start to end of the run
+
+and appends one JSON record per size to a results file (JSON lines),
+so runs can be compared over time.
+
+Processes find each other through a registry directory (see
+transport_discovery.py), so no network or UDP broadcast is needed;
+messages go over tcp on the loopback interface. Run from src/main,
+e.g.:
+
+    PYTHONPATH=. python ../tests/transport_suite_benchmark.py -senders 2 -receivers 2 -n 5000
+    PYTHONPATH=. python ../tests/transport_suite_benchmark.py -codec binary -rate 1000 -out results.jsonl
+
+Each sender sends n messages to every receiver. With -rate 0 (the
+default) senders go as fast as they can, so latency includes queueing;
+set -rate to measure latency under a given load.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def rss():
+    '''Return the resident set size of this process in bytes (Linux).'''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+# rss()
+
+def percentile(values, p):
+    '''values must be sorted.'''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+# percentile()
+
+def payloads(bundles):
+    '''Return a list of (label, ntuple) from ntuple_tests.json: the smallest, median and largest ntuple, then the largest bundled k times for each k in bundles.'''
+    with open(os.path.join(HERE, 'ntuple_tests.json')) as f:
+        ntuples = sorted(json.load(f).values(), key=lambda n: len(json.dumps(n)))
+    points = [('smallest', ntuples[0]), ('median', ntuples[len(ntuples) // 2]), ('largest', ntuples[-1])]
+    for k in bundles:
+        points.append(('largest x%d'%(k), {'ntuples': [ntuples[-1]] * k}))
+    return points
+# payloads()
+
+def start(args, name, registry):
+    # Imported here, so the parent process never creates zmq state
+    # before forking.
+    from nluas.Transport import Transport
+    t = Transport(name, prefix=args.prefix, codec=args.codec, discovery='registry:' + registry)
+    t.set_send_buffer()
+    return t
+# start()
+
+def receiver(args, index, registry, expected, ready, go, results):
+    t = start(args, 'R%d'%(index), registry)
+    latencies = []
+    done = multiprocessing.Event()
+    def cb(ntuple):
+        latencies.append(time.time() - ntuple['sent'])
+        if len(latencies) == expected:
+            done.set()
+    t.subscribe_all(cb)
+    t.wait_for_peers(['S%d'%(i) for i in range(args.senders)], timeout=args.timeout)
+    ready.wait()
+    mem = rss()
+    go.wait()
+    cpu = time.process_time()
+    done.wait(args.timeout)
+    results.put({'role': 'receiver', 'received': len(latencies), 'latencies': latencies,
+                 'cpu': time.process_time() - cpu, 'end': time.time(), 'rss_growth': rss() - mem})
+    finish(results, ready)
+# receiver()
+
+def sender(args, index, registry, payload, ready, go, results):
+    t = start(args, 'S%d'%(index), registry)
+    dests = ['R%d'%(i) for i in range(args.receivers)]
+    t.wait_for_peers(dests, timeout=args.timeout)
+    ready.wait()
+    mem = rss()
+    go.wait()
+    cpu = time.process_time()
+    began = time.time()
+    interval = 1.0 / args.rate if args.rate else 0
+    for i in range(args.n):
+        if interval:
+            delay = began + i * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        for dest in dests:
+            t.send(dest, {'sent': time.time(), 'seq': i, 'ntuple': payload})
+    results.put({'role': 'sender', 'start': began, 'cpu': time.process_time() - cpu, 'rss_growth': rss() - mem})
+    finish(results, ready)
+# sender()
+
+def finish(results, ready):
+    # Make sure the report is written, then wait until every process
+    # has reported, so senders don't go away while receivers are
+    # still reading.
+    results.close()
+    results.join_thread()
+    ready.wait()
+    # Pyre leaves non-daemon threads behind, and stopping politely
+    # would only slow down the others.
+    os._exit(0)
+# finish()
+
+def run_point(args, label, payload):
+    '''Run one size point and return its record.'''
+    registry = tempfile.mkdtemp(prefix='nluas-bench-')
+    expected = args.senders * args.n
+    # ready is passed twice: once everyone has joined, and once every
+    # receiver has reported.
+    ready = multiprocessing.Barrier(args.senders + args.receivers + 1)
+    go = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=receiver, args=(args, i, registry, expected, ready, go, results)) for i in range(args.receivers)]
+    procs += [multiprocessing.Process(target=sender, args=(args, i, registry, payload, ready, go, results)) for i in range(args.senders)]
+    for p in procs:
+        p.start()
+    try:
+        ready.wait(args.timeout)
+        go.set()
+        reports = [results.get(timeout=args.timeout * 2) for p in procs]
+        ready.wait(args.timeout)
+        for p in procs:
+            p.join(args.timeout)
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        shutil.rmtree(registry, ignore_errors=True)
+    senders = [r for r in reports if r['role'] == 'sender']
+    receivers = [r for r in reports if r['role'] == 'receiver']
+    latencies = sorted([x for r in receivers for x in r['latencies']])
+    received = len(latencies)
+    sent = expected * args.receivers
+    elapsed = max([r['end'] for r in receivers]) - min([r['start'] for r in senders])
+    from nluas import transport_codec
+    size = len(transport_codec.get_codec(args.codec).encode({'sent': 0.0, 'seq': 0, 'ntuple': payload}))
+    return {
+        'payload': label,
+        'bytes': size,
+        'sent': sent,
+        'received': received,
+        'seconds': elapsed,
+        'msgs_per_sec': received / elapsed if elapsed > 0 else None,
+        'latency_p50_ms': 1e3 * percentile(latencies, 50) if latencies else None,
+        'latency_p99_ms': 1e3 * percentile(latencies, 99) if latencies else None,
+        'latency_max_ms': 1e3 * latencies[-1] if latencies else None,
+        'send_cpu_us_per_msg': 1e6 * sum([r['cpu'] for r in senders]) / sent,
+        'recv_cpu_us_per_msg': 1e6 * sum([r['cpu'] for r in receivers]) / max(received, 1),
+        'sender_rss_growth': [r['rss_growth'] for r in senders],
+        'receiver_rss_growth': [r['rss_growth'] for r in receivers],
+    }
+# run_point()
+
+def environment(args):
+    '''What the results depend on, besides the code.'''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE, stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.time(), 'host': socket.gethostname(), 'python': platform.python_version(),
+            'cpus': multiprocessing.cpu_count(), 'commit': commit,
+            'senders': args.senders, 'receivers': args.receivers, 'n': args.n,
+            'codec': args.codec, 'rate': args.rate}
+# environment()
+
+def main():
+    parser = argparse.ArgumentParser(description='Transport throughput, latency, CPU and memory benchmark.')
+    parser.add_argument('-senders', type=int, default=1, help='sender processes')
+    parser.add_argument('-receivers', type=int, default=1, help='receiver processes')
+    parser.add_argument('-n', type=int, default=10000, help='messages from each sender to each receiver')
+    parser.add_argument('-rate', type=float, default=0, help='messages/sec per sender, 0 for as fast as possible')
+    parser.add_argument('-codec', default='json', help='Transport codec')
+    parser.add_argument('-bundles', default='8,64', help='comma separated multiples of the largest ntuple to add to the sweep')
+    parser.add_argument('-timeout', type=float, default=120, help='seconds to wait for each size point')
+    parser.add_argument('-prefix', default='BENCH_', help='Transport prefix')
+    parser.add_argument('-out', default=None, help='append JSON records to this file')
+    args = parser.parse_args()
+
+    bundles = [int(k) for k in args.bundles.split(',') if k]
+    env = environment(args)
+    out = open(args.out, 'a') if args.out else None
+    print('%-14s %8s %10s %9s %9s %11s %11s %12s'%('payload', 'bytes', 'msgs/sec', 'p50 ms', 'p99 ms', 'send us/msg', 'recv us/msg', 'max RSS +KB'))
+    for (label, payload) in payloads(bundles):
+        record = run_point(args, label, payload)
+        growth = max(record['sender_rss_growth'] + record['receiver_rss_growth'])
+        print('%-14s %8d %10.0f %9.2f %9.2f %11.1f %11.1f %12d'%(label, record['bytes'], record['msgs_per_sec'] or 0,
+              record['latency_p50_ms'] or 0, record['latency_p99_ms'] or 0,
+              record['send_cpu_us_per_msg'], record['recv_cpu_us_per_msg'], growth // 1024))
+        if record['received'] < record['sent']:
+            print('  only %d of %d messages arrived'%(record['received'], record['sent']))
+        if out is not None:
+            record.update(env)
+            out.write(json.dumps(record, sort_keys=True) + '\n')
+            out.flush()
+    if out is not None:
+        out.close()
+# main()
+
+if __name__ == '__main__':
+    if not sys.platform.startswith('linux'):
+        print('The suite reads memory use from /proc, so it needs Linux.')
+        sys.exit(1)
+    main()